@@ -6,6 +6,8 @@ This script creates the database tables and sets up an initial admin user.
 
 import os
 import sys
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import select, func
 from sqlalchemy.orm import Session
 from passlib.context import CryptContext
 
@@ -15,11 +17,61 @@ sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 from models.database import engine, SessionLocal, Base, User
 from config import settings
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing (cheap rounds for local/dev bootstraps only)
+pwd_context = CryptContext(
+    schemes=["bcrypt"],
+    deprecated="auto",
+    **({"bcrypt__rounds": 4} if settings.debug else {})
+)
 
-def init_database():
-    """Initialize the database with tables and admin user."""
+ADMIN_USER = {
+    "email": "admin@legalai.com",
+    "username": "admin",
+    "full_name": "System Administrator",
+    "password": "admin123",  # Change this in production!
+    "is_superuser": True
+}
+
+TEST_USER = {
+    "email": "test@legalai.com",
+    "username": "testuser",
+    "full_name": "Test User",
+    "password": "test123",
+    "is_superuser": False
+}
+
+def create_users(db: Session, user_specs: list) -> list:
+    """Create the given users that don't exist yet in a single batch."""
+    usernames = [spec["username"] for spec in user_specs]
+    existing = {username for (username,) in db.query(User.username).filter(User.username.in_(usernames))}
+    missing = [spec for spec in user_specs if spec["username"] not in existing]
+    
+    if not missing:
+        return []
+    
+    # bcrypt releases the GIL, so the hashes run in parallel
+    with ThreadPoolExecutor(max_workers=len(missing)) as executor:
+        hashed_passwords = list(executor.map(pwd_context.hash, [spec["password"] for spec in missing]))
+    
+    users = [
+        User(
+            email=spec["email"],
+            username=spec["username"],
+            full_name=spec["full_name"],
+            hashed_password=hashed_password,
+            is_active=True,
+            is_superuser=spec["is_superuser"]
+        )
+        for spec, hashed_password in zip(missing, hashed_passwords)
+    ]
+    
+    db.add_all(users)
+    db.commit()
+    
+    return missing
+
+def init_database(with_test_user: bool = True):
+    """Initialize the database with tables, admin user and optional test user."""
     print("🚀 Initializing Legal AI Assistant database...")
     
     try:
@@ -30,36 +82,29 @@ def init_database():
         # Create database session
         db = SessionLocal()
         
-        # Check if admin user already exists
-        admin_user = db.query(User).filter(User.username == "admin").first()
+        user_specs = [ADMIN_USER, TEST_USER] if with_test_user else [ADMIN_USER]
+        created = {spec["username"] for spec in create_users(db, user_specs)}
         
-        if not admin_user:
-            # Create admin user
-            admin_password = "admin123"  # Change this in production!
-            hashed_password = pwd_context.hash(admin_password)
-            
-            admin_user = User(
-                email="admin@legalai.com",
-                username="admin",
-                full_name="System Administrator",
-                hashed_password=hashed_password,
-                is_active=True,
-                is_superuser=True
-            )
-            
-            db.add(admin_user)
-            db.commit()
-            db.refresh(admin_user)
-            
+        if ADMIN_USER["username"] in created:
             print("✅ Admin user created successfully")
-            print(f"   Username: admin")
-            print(f"   Password: {admin_password}")
+            print(f"   Username: {ADMIN_USER['username']}")
+            print(f"   Password: {ADMIN_USER['password']}")
             print("   ⚠️  IMPORTANT: Change this password after first login!")
         else:
             print("ℹ️  Admin user already exists")
         
+        if with_test_user:
+            if TEST_USER["username"] in created:
+                print("✅ Test user created successfully")
+                print(f"   Username: {TEST_USER['username']}")
+                print(f"   Password: {TEST_USER['password']}")
+            else:
+                print("ℹ️  Test user already exists")
+        
         # Check if any regular users exist
-        regular_users = db.query(User).filter(User.is_superuser == False).count()
+        regular_users = db.execute(
+            select(func.count()).select_from(User).where(User.is_superuser.is_(False))
+        ).scalar()
         print(f"ℹ️  Regular users in database: {regular_users}")
         
         db.close()
@@ -70,45 +115,6 @@ def init_database():
         print(f"❌ Error during database initialization: {e}")
         sys.exit(1)
 
-def create_test_user():
-    """Create a test user for development purposes."""
-    print("\n🔧 Creating test user...")
-    
-    try:
-        db = SessionLocal()
-        
-        # Check if test user already exists
-        test_user = db.query(User).filter(User.username == "testuser").first()
-        
-        if not test_user:
-            # Create test user
-            test_password = "test123"
-            hashed_password = pwd_context.hash(test_password)
-            
-            test_user = User(
-                email="test@legalai.com",
-                username="testuser",
-                full_name="Test User",
-                hashed_password=hashed_password,
-                is_active=True,
-                is_superuser=False
-            )
-            
-            db.add(test_user)
-            db.commit()
-            db.refresh(test_user)
-            
-            print("✅ Test user created successfully")
-            print(f"   Username: testuser")
-            print(f"   Password: {test_password}")
-        else:
-            print("ℹ️  Test user already exists")
-        
-        db.close()
-        
-    except Exception as e:
-        print(f"❌ Error creating test user: {e}")
-
 def show_database_info():
     """Show information about the database."""
     print("\n📊 Database Information:")
@@ -125,11 +131,8 @@ if __name__ == "__main__":
     # Show database configuration
     show_database_info()
     
-    # Initialize database
-    init_database()
-    
-    # Create test user (optional)
-    create_test_user()
+    # Initialize database (admin + optional test user)
+    init_database(with_test_user=True)
     
     print("\n" + "=" * 60)
     print("✅ Setup completed! You can now run the application with:")
@@ -1,13 +1,73 @@
+import os
+
+# OpenMP/BLAS read these when first loaded, so they must be set before numpy,
+# torch or FAISS are imported; passive waiting stops idle FAISS threads from
+# spinning against the request threads
+os.environ.setdefault("OMP_WAIT_POLICY", "PASSIVE")
+os.environ.setdefault("OMP_NUM_THREADS", str(os.cpu_count()))
+os.environ.setdefault("MKL_NUM_THREADS", str(os.cpu_count()))
+
 from fastapi import FastAPI, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.staticfiles import StaticFiles
-from fastapi.responses import HTMLResponse
-import os
+from fastapi.responses import HTMLResponse, ORJSONResponse
+from sqlalchemy.exc import SQLAlchemyError
+from contextlib import asynccontextmanager
+import asyncio
+from anyio import to_thread
+import hashlib
+import logging
 import uvicorn
 
 from config import settings
-from models.database import create_tables
+from models.database import create_tables, engine, async_engine
 from routers import auth, analysis, search, documents, cases, data_sync
+from services.cache import cache_service
+from services.query_batcher import query_batcher
+
+HOST = settings.host
+PORT = settings.port
+DEBUG = settings.debug
+ALLOWED_ORIGINS = settings.allowed_origins
+
+# Module loggers (e.g. routers.data_sync) emit at INFO; uvicorn keeps its own handlers
+logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
+
+def _create_directories():
+    """Create the directories used for models and synced data."""
+    os.makedirs("ml_models", exist_ok=True)
+    os.makedirs("data", exist_ok=True)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Initialize application on startup and release resources on shutdown."""
+    print("🚀 Starting Legal AI Assistant...")
+    
+    # Sync endpoints and offloaded model work all share this limiter
+    to_thread.current_default_thread_limiter().total_tokens = settings.threadpool_size
+    
+    try:
+        # Independent startup steps run concurrently on the threadpool
+        await asyncio.gather(
+            asyncio.to_thread(create_tables),
+            asyncio.to_thread(_create_directories)
+        )
+        print("✅ Database tables and directories created/verified")
+        
+        print("🎉 Legal AI Assistant started successfully!")
+        
+    except Exception as e:
+        print(f"❌ Error during startup: {e}")
+        raise e
+    
+    yield
+    
+    print("🛑 Shutting down Legal AI Assistant...")
+    await query_batcher.close()
+    await cache_service.close()
+    await async_engine.dispose()
+    engine.dispose()
 
 # Create FastAPI app
 app = FastAPI(
@@ -15,18 +75,23 @@ app = FastAPI(
     description="Intelligent legal document analysis and generation system",
     version="1.0.0",
     docs_url="/docs",
-    redoc_url="/redoc"
+    redoc_url="/redoc",
+    default_response_class=ORJSONResponse,
+    lifespan=lifespan
 )
 
 # Add CORS middleware
 app.add_middleware(
     CORSMiddleware,
-    allow_origins=["*"],  # Configure appropriately for production
+    allow_origins=ALLOWED_ORIGINS,
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
 )
 
+# Compress list and summary payloads; tiny responses aren't worth the CPU
+app.add_middleware(GZipMiddleware, minimum_size=512)
+
 # Include routers
 app.include_router(auth.router, prefix="/api/v1")
 app.include_router(analysis.router, prefix="/api/v1")
@@ -46,10 +111,7 @@ async def health_check():
     }
 
 # Root endpoint
-@app.get("/", response_class=HTMLResponse)
-async def root():
-    """Root endpoint with basic information."""
-    html_content = """
+ROOT_HTML = """
     <!DOCTYPE html>
     <html>
     <head>
@@ -144,62 +206,67 @@ async def root():
         </div>
     </body>
     </html>
-    """
-    return HTMLResponse(content=html_content)
+"""
 
-# Startup event
-@app.on_event("startup")
-async def startup_event():
-    """Initialize application on startup."""
-    print("🚀 Starting Legal AI Assistant...")
-    
-    try:
-        # Create database tables
-        create_tables()
-        print("✅ Database tables created/verified")
-        
-        # Create necessary directories
-        os.makedirs("ml_models", exist_ok=True)
-        os.makedirs("data", exist_ok=True)
-        print("✅ Directories created")
-        
-        print("🎉 Legal AI Assistant started successfully!")
-        
-    except Exception as e:
-        print(f"❌ Error during startup: {e}")
-        raise e
+# Built once at import; the page is static so every request can share it
+_ROOT_RESPONSE = HTMLResponse(
+    content=ROOT_HTML,
+    headers={
+        "Cache-Control": "public, max-age=3600",
+        "ETag": f'"{hashlib.md5(ROOT_HTML.encode()).hexdigest()}"'
+    }
+)
 
-# Shutdown event
-@app.on_event("shutdown")
-async def shutdown_event():
-    """Cleanup on application shutdown."""
-    print("🛑 Shutting down Legal AI Assistant...")
+@app.get("/", response_class=HTMLResponse)
+async def root():
+    """Root endpoint with basic information."""
+    return _ROOT_RESPONSE
 
 # Error handlers
 @app.exception_handler(404)
 async def not_found_handler(request, exc):
     """Handle 404 errors."""
-    return {
-        "error": "Not Found",
-        "message": "The requested resource was not found",
-        "path": str(request.url.path)
-    }
+    return ORJSONResponse(
+        status_code=status.HTTP_404_NOT_FOUND,
+        content={
+            "error": "Not Found",
+            "message": "The requested resource was not found",
+            "detail": getattr(exc, "detail", None),
+            "path": str(request.url.path)
+        }
+    )
 
 @app.exception_handler(500)
 async def internal_error_handler(request, exc):
     """Handle 500 errors."""
-    return {
-        "error": "Internal Server Error",
-        "message": "An unexpected error occurred",
-        "path": str(request.url.path)
-    }
+    return ORJSONResponse(
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        content={
+            "error": "Internal Server Error",
+            "message": "An unexpected error occurred",
+            "path": str(request.url.path)
+        }
+    )
+
+@app.exception_handler(SQLAlchemyError)
+async def database_error_handler(request, exc):
+    """Turn database errors escaping a route into a single 500 response."""
+    print(f"Database error on {request.url.path}: {exc}")
+    return ORJSONResponse(
+        status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+        content={
+            "error": "Internal Server Error",
+            "message": "A database error occurred",
+            "path": str(request.url.path)
+        }
+    )
 
 if __name__ == "__main__":
     # Run the application
     uvicorn.run(
         "main:app",
-        host=settings.host,
-        port=settings.port,
-        reload=settings.debug,
+        host=HOST,
+        port=PORT,
+        reload=DEBUG,
         log_level="info"
     )
\ No newline at end of file
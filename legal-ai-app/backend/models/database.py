@@ -1,15 +1,58 @@
-from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Boolean, ForeignKey, Float
+from sqlalchemy import create_engine, Column, Integer, String, Text, DateTime, Boolean, ForeignKey, Float, Index, JSON, insert, func
+from sqlalchemy.dialects.postgresql import JSONB
+from sqlalchemy.exc import SQLAlchemyError
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, relationship
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
 from datetime import datetime
-from typing import Optional
+from typing import Optional, List, Dict, Any
 import os
 
 from config import settings
 
+DATABASE_URL = settings.database_url
+
 # Database setup
-engine = create_engine(settings.database_url)
-SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
+def _engine_options(database_url: str) -> dict:
+    """Build connection pool options for the configured database backend."""
+    if database_url.startswith("sqlite"):
+        return {}
+    
+    options = {
+        "pool_size": settings.db_pool_size,
+        "max_overflow": settings.db_max_overflow,
+        "pool_timeout": settings.db_pool_timeout,
+        "pool_recycle": settings.db_pool_recycle,
+        "pool_pre_ping": True,
+    }
+    
+    # psycopg2 fast executemany: INSERTs are packed 1000 VALUES tuples per
+    # statement, other DML goes through execute_batch 500 rows at a time
+    if database_url.startswith(("postgresql://", "postgresql+psycopg2://")):
+        options["executemany_mode"] = "values_plus_batch"
+        options["insertmanyvalues_page_size"] = 1000
+        options["executemany_batch_page_size"] = 500
+    
+    return options
+
+def _async_database_url(database_url: str) -> str:
+    """Map the configured sync URL onto its async driver."""
+    if database_url.startswith("postgresql://"):
+        return database_url.replace("postgresql://", "postgresql+asyncpg://", 1)
+    if database_url.startswith("sqlite://"):
+        return database_url.replace("sqlite://", "sqlite+aiosqlite://", 1)
+    return database_url
+
+engine = create_engine(DATABASE_URL, **_engine_options(DATABASE_URL))
+# Keep loaded attributes after commit; every column default is Python-side, so
+# the instance already holds what a post-commit refresh would re-read
+SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine, expire_on_commit=False)
+
+# Async engine used by the API routes; the sync engine above stays for scripts
+async_database_url = _async_database_url(DATABASE_URL)
+async_engine = create_async_engine(async_database_url, **_engine_options(async_database_url))
+AsyncSessionLocal = async_sessionmaker(async_engine, class_=AsyncSession, expire_on_commit=False)
+
 Base = declarative_base()
 
 def get_db():
@@ -19,12 +62,22 @@ def get_db():
     finally:
         db.close()
 
+async def get_async_db():
+    """Yield a request-scoped session and commit it once when the handler returns."""
+    async with AsyncSessionLocal() as db:
+        try:
+            yield db
+            await db.commit()
+        except Exception:
+            await db.rollback()
+            raise
+
 # Models
 class User(Base):
     __tablename__ = "users"
     
     id = Column(Integer, primary_key=True, index=True)
-    email = Column(String, unique=True, index=True)
+    email = Column(String)  # Stored lowercased; uniqueness enforced by ix_users_email_lower
     username = Column(String, unique=True, index=True)
     hashed_password = Column(String)
     full_name = Column(String)
@@ -35,6 +88,10 @@ class User(Base):
     # Relationships
     cases = relationship("Case", back_populates="user")
     documents = relationship("Document", back_populates="user")
+    
+    __table_args__ = (
+        Index("ix_users_email_lower", func.lower(email), unique=True),
+    )
 
 class Case(Base):
     __tablename__ = "cases"
@@ -53,6 +110,12 @@ class Case(Base):
     user = relationship("User", back_populates="cases")
     documents = relationship("Document", back_populates="case")
     predictions = relationship("Prediction", back_populates="case")
+    
+    # user_id leads every index, so they also serve plain user_id filters
+    __table_args__ = (
+        Index("ix_cases_user_status_type", user_id, status, case_type),
+        Index("ix_cases_user_created", user_id, created_at.desc(), id.desc()),
+    )
 
 class Document(Base):
     __tablename__ = "documents"
@@ -69,6 +132,12 @@ class Document(Base):
     # Relationships
     case = relationship("Case", back_populates="documents")
     user = relationship("User", back_populates="documents")
+    
+    # ix_documents_user_id_desc also serves plain user_id filters
+    __table_args__ = (
+        Index("ix_documents_case_created", case_id, created_at.desc()),
+        Index("ix_documents_user_id_desc", user_id, id.desc()),
+    )
 
 class LegalDocument(Base):
     __tablename__ = "legal_documents"
@@ -83,15 +152,20 @@ class LegalDocument(Base):
     url = Column(String)
     embedding_vector = Column(Text, nullable=True)  # JSON string of embedding
     created_at = Column(DateTime, default=datetime.utcnow)
+    
+    # Sync dedups on (expediente, tribunal); unique so inserts can skip conflicts
+    __table_args__ = (
+        Index("ix_legaldoc_exp_trib", expediente, tribunal, unique=True),
+    )
 
 class Prediction(Base):
     __tablename__ = "predictions"
     
     id = Column(Integer, primary_key=True, index=True)
-    case_id = Column(Integer, ForeignKey("cases.id"))
+    case_id = Column(Integer, ForeignKey("cases.id"), index=True)
     predicted_outcome = Column(String)
     confidence_score = Column(Float)
-    similar_cases = Column(Text)  # JSON string of similar cases
+    similar_cases = Column(JSON().with_variant(JSONB, "postgresql"))  # List of similar case dicts
     explanation = Column(Text)
     created_at = Column(DateTime, default=datetime.utcnow)
     
@@ -108,6 +182,27 @@ class Template(Base):
     structure = Column(Text)  # JSON string of document structure
     created_at = Column(DateTime, default=datetime.utcnow)
 
+# Bulk writes
+async def bulk_save_predictions(db: AsyncSession, rows: List[Dict[str, Any]]) -> None:
+    """Insert many predictions in one executemany round-trip.
+    
+    Each row is a dict of Prediction column values. SQLAlchemy 2.0 batches
+    these into multi-row INSERTs ("insertmanyvalues") on every driver.
+    """
+    if not rows:
+        return
+    await db.execute(insert(Prediction), rows)
+
 # Create tables
 def create_tables():
-    Base.metadata.create_all(bind=engine)
\ No newline at end of file
+    Base.metadata.create_all(bind=engine)
+    
+    # create_all skips the indexes of tables that already exist, so add any
+    # declared since. Each is tried on its own: e.g. the unique legal document
+    # key fails over duplicate rows, and sync then inserts without ON CONFLICT
+    for table in Base.metadata.sorted_tables:
+        for index in table.indexes:
+            try:
+                index.create(bind=engine, checkfirst=True)
+            except SQLAlchemyError as e:
+                print(f"Could not create index {index.name}: {e}")
\ No newline at end of file
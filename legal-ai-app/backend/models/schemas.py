@@ -1,5 +1,5 @@
 from pydantic import BaseModel, EmailStr
-from typing import Optional, List
+from typing import Optional, List, Dict, Any
 from datetime import datetime
 
 # User schemas
@@ -88,6 +88,17 @@ class Document(DocumentBase):
     class Config:
         from_attributes = True
 
+class DocumentListItem(BaseModel):
+    """Listing view of a document; leaves out the content body."""
+    id: int
+    title: str
+    document_type: str
+    case_id: int
+    created_at: datetime
+    
+    class Config:
+        from_attributes = True
+
 # Legal Document schemas
 class LegalDocumentBase(BaseModel):
     tribunal: str
@@ -113,7 +124,7 @@ class LegalDocument(LegalDocumentBase):
 class PredictionBase(BaseModel):
     predicted_outcome: str
     confidence_score: float
-    similar_cases: str
+    similar_cases: List[Dict[str, Any]]
     explanation: str
 
 class PredictionCreate(PredictionBase):
@@ -169,11 +180,18 @@ class DocumentGenerationResponse(BaseModel):
     template_used: str
     citations: List[str]
 
+class BulkGenerationStatus(BaseModel):
+    batch_id: str
+    status: str
+    # Keyed by the request's position in the submitted list
+    documents: Dict[str, Optional[str]]
+
 # Analysis schemas
 class CaseAnalysisRequest(BaseModel):
     case_description: str
     case_type: str
     relevant_facts: List[str]
+    case_id: Optional[int] = None
 
 class CaseAnalysisResponse(BaseModel):
     predicted_outcome: str
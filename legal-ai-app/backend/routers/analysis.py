@@ -1,24 +1,32 @@
 from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+import asyncio
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from sqlalchemy.orm import contains_eager
 from typing import List
 
-from models.database import get_db, User, Case, Prediction
+from models.database import get_async_db, User, Case, Prediction
 from models.schemas import (
     CaseAnalysisRequest, CaseAnalysisResponse, PredictionCreate, Prediction as PredictionSchema
 )
+from services import get_embeddings_service, get_classifier_service
 from services.auth import get_current_active_user
-from services.classifier import classifier_service
-from services.embeddings import embeddings_service
+from services.cache import cache_service
 
 router = APIRouter(prefix="/analysis", tags=["case analysis"])
 
+MODEL_STATUS_CACHE_KEY = "analysis:model-status"
+MODEL_STATUS_CACHE_TTL = 60
+SIMILAR_CASES_CACHE_TTL = 300
+
 @router.post("/predict", response_model=CaseAnalysisResponse)
 async def predict_case_outcome(
     request: CaseAnalysisRequest,
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Predict the outcome of a legal case."""
+    classifier_service = get_classifier_service()
     try:
         # Check if classifier is trained
         if not classifier_service.is_trained:
@@ -27,14 +35,24 @@ async def predict_case_outcome(
                 detail="Legal classifier not trained. Please wait for training to complete."
             )
         
+        # Verify the case belongs to the user before persisting against it
+        if request.case_id:
+            case = await db.get(Case, request.case_id)
+            if not case or case.user_id != current_user.id:
+                raise HTTPException(
+                    status_code=status.HTTP_404_NOT_FOUND,
+                    detail="Case not found or access denied"
+                )
+        
         # Get prediction and explanation
-        analysis_result = classifier_service.explain_prediction(
+        analysis_result = await asyncio.to_thread(
+            classifier_service.explain_prediction,
             request.case_description,
             request.case_type
         )
         
         # Save prediction to database if case_id is provided
-        if hasattr(request, 'case_id') and request.case_id:
+        if request.case_id:
             prediction = Prediction(
                 case_id=request.case_id,
                 predicted_outcome=analysis_result['prediction']['predicted_outcome'],
@@ -43,17 +61,18 @@ async def predict_case_outcome(
                 explanation=analysis_result['explanation']
             )
             db.add(prediction)
-            db.commit()
         
         return CaseAnalysisResponse(
             predicted_outcome=analysis_result['prediction']['predicted_outcome'],
             confidence_score=analysis_result['prediction']['confidence_score'],
             similar_cases=analysis_result['similar_cases'],
             explanation=analysis_result['explanation'],
-            recommendations=self._generate_recommendations(analysis_result)
+            recommendations=_generate_recommendations(analysis_result)
         )
         
-    except Exception as e:
+    except HTTPException:
+        raise
+    except (ValueError, KeyError) as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
             detail=f"Error during case analysis: {str(e)}"
@@ -66,6 +85,8 @@ async def find_similar_cases(
     current_user: User = Depends(get_current_active_user)
 ):
     """Find similar legal cases based on a query."""
+    embeddings_service = get_embeddings_service()
+    classifier_service = get_classifier_service()
     try:
         if not embeddings_service.faiss_index:
             raise HTTPException(
@@ -73,13 +94,21 @@ async def find_similar_cases(
                 detail="Search index not available. Please wait for indexing to complete."
             )
         
-        similar_cases = classifier_service.get_similar_cases(query, limit)
-        return {
+        cache_key = cache_service.make_key("analysis:similar-cases", query, limit)
+        cached = await cache_service.get(cache_key)
+        if cached is not None:
+            return cached
+        
+        similar_cases = await asyncio.to_thread(classifier_service.get_similar_cases, query, limit)
+        response = {
             "query": query,
             "similar_cases": similar_cases,
             "total_found": len(similar_cases)
         }
         
+        await cache_service.set(cache_key, response, SIMILAR_CASES_CACHE_TTL)
+        return response
+        
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -91,23 +120,33 @@ async def get_user_predictions(
     skip: int = 0,
     limit: int = 100,
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get predictions made by the current user."""
-    predictions = db.query(Prediction).join(Case).filter(Case.user_id == current_user.id).offset(skip).limit(limit).all()
-    return predictions
+    result = await db.execute(
+        select(Prediction)
+        .join(Case)
+        .options(contains_eager(Prediction.case))
+        .where(Case.user_id == current_user.id)
+        .offset(skip)
+        .limit(limit)
+    )
+    return result.scalars().all()
 
 @router.get("/predictions/{prediction_id}", response_model=PredictionSchema)
 async def get_prediction(
     prediction_id: int,
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get a specific prediction by ID."""
-    prediction = db.query(Prediction).join(Case).filter(
-        Prediction.id == prediction_id,
-        Case.user_id == current_user.id
-    ).first()
+    result = await db.execute(
+        select(Prediction).join(Case).options(contains_eager(Prediction.case)).where(
+            Prediction.id == prediction_id,
+            Case.user_id == current_user.id
+        )
+    )
+    prediction = result.scalars().first()
     
     if not prediction:
         raise HTTPException(
@@ -121,13 +160,16 @@ async def get_prediction(
 async def delete_prediction(
     prediction_id: int,
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Delete a prediction."""
-    prediction = db.query(Prediction).join(Case).filter(
-        Prediction.id == prediction_id,
-        Case.user_id == current_user.id
-    ).first()
+    result = await db.execute(
+        select(Prediction).join(Case).options(contains_eager(Prediction.case)).where(
+            Prediction.id == prediction_id,
+            Case.user_id == current_user.id
+        )
+    )
+    prediction = result.scalars().first()
     
     if not prediction:
         raise HTTPException(
@@ -135,26 +177,36 @@ async def delete_prediction(
             detail="Prediction not found"
         )
     
-    db.delete(prediction)
-    db.commit()
+    await db.delete(prediction)
     
     return {"message": "Prediction deleted successfully"}
 
 @router.get("/model-status")
 async def get_model_status(current_user: User = Depends(get_current_active_user)):
     """Get the status of the ML models."""
-    return {
+    embeddings_service = get_embeddings_service()
+    classifier_service = get_classifier_service()
+    cached = await cache_service.get(MODEL_STATUS_CACHE_KEY)
+    if cached is not None:
+        return cached
+    
+    model_status = {
         "classifier_trained": classifier_service.is_trained,
         "search_index_available": embeddings_service.faiss_index is not None,
         "total_documents_indexed": len(embeddings_service.documents) if embeddings_service.documents else 0,
         "available_outcome_classes": list(classifier_service.label_encoder.classes_) if classifier_service.is_trained else []
     }
+    
+    await cache_service.set(MODEL_STATUS_CACHE_KEY, model_status, MODEL_STATUS_CACHE_TTL)
+    return model_status
 
 @router.post("/train-model")
 async def train_legal_classifier(
     current_user: User = Depends(get_current_active_user)
 ):
     """Trigger training of the legal classifier (admin only)."""
+    embeddings_service = get_embeddings_service()
+    classifier_service = get_classifier_service()
     # Check if user is admin
     if not current_user.is_superuser:
         raise HTTPException(
@@ -171,9 +223,10 @@ async def train_legal_classifier(
             )
         
         # Train the classifier
-        success = classifier_service.train_classifier(embeddings_service.documents)
+        success = await asyncio.to_thread(classifier_service.train_classifier, embeddings_service.documents)
         
         if success:
+            await cache_service.delete(MODEL_STATUS_CACHE_KEY)
             return {"message": "Legal classifier trained successfully"}
         else:
             raise HTTPException(
@@ -192,6 +245,8 @@ async def get_model_performance(
     current_user: User = Depends(get_current_active_user)
 ):
     """Get model performance metrics (admin only)."""
+    embeddings_service = get_embeddings_service()
+    classifier_service = get_classifier_service()
     if not current_user.is_superuser:
         raise HTTPException(
             status_code=status.HTTP_403_FORBIDDEN,
@@ -203,9 +258,9 @@ async def get_model_performance(
             return {"message": "Model not trained yet"}
         
         # Use a subset of documents for evaluation
-        test_docs = embeddings_service.documents[-100:] if len(embeddings_service.documents) > 100 else embeddings_service.documents
+        test_docs = embeddings_service.get_recent(100)
         
-        performance = classifier_service.evaluate_model(test_docs)
+        performance = await asyncio.to_thread(classifier_service.evaluate_model, test_docs)
         return performance
         
     except Exception as e:
@@ -1,58 +1,81 @@
-from fastapi import APIRouter, Depends, HTTPException, status
+from fastapi import APIRouter, Depends, HTTPException, status, Response, Query
 from fastapi.security import OAuth2PasswordRequestForm
-from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import select, func, or_
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.asyncio import AsyncSession
 from datetime import timedelta
+from typing import Optional
 
-from models.database import get_db, User
+from models.database import get_async_db, User
 from models.schemas import UserCreate, User as UserSchema, Token
 from services.auth import (
     authenticate_user, create_access_token, get_current_active_user,
-    get_password_hash, get_current_superuser
+    get_password_hash, get_current_superuser, invalidate_cached_user
 )
 from config import settings
 
 router = APIRouter(prefix="/auth", tags=["authentication"])
 
+# Columns serialized by UserSchema; never loads hashed_password
+USER_SCHEMA_COLUMNS = (
+    User.id, User.email, User.username, User.full_name,
+    User.is_active, User.is_superuser, User.created_at
+)
+
 @router.post("/register", response_model=UserSchema)
-async def register_user(user: UserCreate, db: Session = Depends(get_db)):
+async def register_user(user: UserCreate, db: AsyncSession = Depends(get_async_db)):
     """Register a new user."""
-    # Check if user already exists
-    db_user = db.query(User).filter(User.email == user.email).first()
-    if db_user:
+    email = user.email.lower()
+    
+    # Check email and username in one round-trip; up to two rows can match
+    conflicts = (await db.execute(
+        select(func.lower(User.email), User.username).where(
+            or_(func.lower(User.email) == email, User.username == user.username)
+        ).limit(2)
+    )).all()
+    
+    if any(conflict_email == email for conflict_email, _ in conflicts):
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Email already registered"
         )
     
-    db_user = db.query(User).filter(User.username == user.username).first()
-    if db_user:
+    if conflicts:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail="Username already taken"
         )
     
     # Create new user
-    hashed_password = get_password_hash(user.password)
+    hashed_password = await run_in_threadpool(get_password_hash, user.password)
     db_user = User(
-        email=user.email,
+        email=email,
         username=user.username,
         full_name=user.full_name,
         hashed_password=hashed_password
     )
     
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    try:
+        await db.commit()
+    except IntegrityError:
+        # A concurrent registration won the race past the pre-check
+        await db.rollback()
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Email or username already registered"
+        )
     
     return db_user
 
 @router.post("/token", response_model=Token)
 async def login_for_access_token(
     form_data: OAuth2PasswordRequestForm = Depends(),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Login to get access token."""
-    user = authenticate_user(db, form_data.username, form_data.password)
+    user = await authenticate_user(db, form_data.username, form_data.password)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -74,23 +97,39 @@ async def read_users_me(current_user: User = Depends(get_current_active_user)):
 
 @router.get("/users", response_model=list[UserSchema])
 async def read_users(
+    response: Response,
     skip: int = 0,
     limit: int = 100,
+    after_id: Optional[int] = Query(None, description="Keyset cursor: id of the last user seen"),
     current_user: User = Depends(get_current_superuser),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Get all users (superuser only)."""
-    users = db.query(User).offset(skip).limit(limit).all()
+    """Get all users (superuser only).
+    
+    Pass the X-Next-Cursor response header value as after_id to fetch the
+    next page without OFFSET.
+    """
+    query = select(*USER_SCHEMA_COLUMNS)
+    if after_id is not None:
+        query = query.where(User.id > after_id)
+    elif skip:
+        query = query.offset(skip)
+    
+    users = (await db.execute(query.order_by(User.id).limit(limit))).all()
+    
+    if len(users) == limit:
+        response.headers["X-Next-Cursor"] = f"after_id={users[-1].id}"
+    
     return users
 
 @router.post("/users/{user_id}/activate")
 async def activate_user(
     user_id: int,
     current_user: User = Depends(get_current_superuser),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Activate a user (superuser only)."""
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -98,8 +137,8 @@ async def activate_user(
         )
     
     user.is_active = True
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await invalidate_cached_user(user.username)
     
     return {"message": f"User {user.username} activated successfully"}
 
@@ -107,10 +146,10 @@ async def activate_user(
 async def deactivate_user(
     user_id: int,
     current_user: User = Depends(get_current_superuser),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Deactivate a user (superuser only)."""
-    user = db.query(User).filter(User.id == user_id).first()
+    user = await db.get(User, user_id)
     if not user:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
@@ -118,7 +157,7 @@ async def deactivate_user(
         )
     
     user.is_active = False
-    db.commit()
-    db.refresh(user)
+    await db.commit()
+    await invalidate_cached_user(user.username)
     
     return {"message": f"User {user.username} deactivated successfully"}
\ No newline at end of file
@@ -1,400 +1,426 @@
-from fastapi import APIRouter, Depends, HTTPException, status
-from sqlalchemy.orm import Session
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Response
+from sqlalchemy import select, delete, func, update, tuple_
+from sqlalchemy.ext.asyncio import AsyncSession
 from typing import List, Optional
+from datetime import datetime, timedelta
+import asyncio
 
-from models.database import get_db, User, Case, Document
+from models.database import get_async_db, AsyncSessionLocal, User, Case, Document
 from models.schemas import CaseCreate, CaseUpdate, Case as CaseSchema
 from services.auth import get_current_active_user
+from services.cache import cache_service
 
 router = APIRouter(prefix="/cases", tags=["case management"])
 
+# Columns serialized by CaseSchema; list endpoints select these as plain rows
+CASE_SCHEMA_COLUMNS = (
+    Case.id, Case.case_number, Case.title, Case.description, Case.case_type,
+    Case.status, Case.user_id, Case.created_at, Case.updated_at
+)
+
+_VALID_STATUSES = frozenset({"active", "pending", "closed", "archived"})
+_VALID_STATUSES_MSG = "Invalid status. Must be one of: active, pending, closed, archived"
+
+STATS_CACHE_TTL = 30
+
+def stats_cache_key(user_id: int) -> str:
+    """Cache key for a user's case statistics."""
+    return f"stats:{user_id}"
+
 @router.post("/", response_model=CaseSchema)
 async def create_case(
     case: CaseCreate,
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Create a new legal case."""
-    try:
-        # Check if case number already exists for this user
-        existing_case = db.query(Case).filter(
+    # Check if case number already exists for this user
+    existing_case = await db.scalar(
+        select(Case.id).where(
             Case.case_number == case.case_number,
             Case.user_id == current_user.id
-        ).first()
-        
-        if existing_case:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Case number already exists for this user"
-            )
-        
-        # Create new case
-        db_case = Case(
-            case_number=case.case_number,
-            title=case.title,
-            description=case.description,
-            case_type=case.case_type,
-            status=case.status,
-            user_id=current_user.id
-        )
-        
-        db.add(db_case)
-        db.commit()
-        db.refresh(db_case)
-        
-        return db_case
-        
-    except Exception as e:
+        ).limit(1)
+    )
+    
+    if existing_case:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error creating case: {str(e)}"
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Case number already exists for this user"
         )
+    
+    # Create new case
+    db_case = Case(
+        case_number=case.case_number,
+        title=case.title,
+        description=case.description,
+        case_type=case.case_type,
+        status=case.status,
+        user_id=current_user.id
+    )
+    
+    db.add(db_case)
+    await db.commit()
+    await cache_service.delete(stats_cache_key(current_user.id))
+    
+    return db_case
 
 @router.get("/", response_model=List[CaseSchema])
 async def get_user_cases(
+    response: Response,
     skip: int = 0,
     limit: int = 100,
     status_filter: Optional[str] = None,
     case_type_filter: Optional[str] = None,
+    after_created_at: Optional[datetime] = Query(None, description="Keyset cursor: created_at of the last case seen"),
+    after_id: Optional[int] = Query(None, description="Keyset cursor: id of the last case seen"),
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
-    """Get all cases for the current user with optional filtering."""
-    try:
-        query = db.query(Case).filter(Case.user_id == current_user.id)
-        
-        # Apply filters
-        if status_filter:
-            query = query.filter(Case.status == status_filter)
-        
-        if case_type_filter:
-            query = query.filter(Case.case_type == case_type_filter)
-        
-        # Order by creation date (newest first)
-        cases = query.order_by(Case.created_at.desc()).offset(skip).limit(limit).all()
-        
-        return cases
-        
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error getting cases: {str(e)}"
-        )
+    """Get all cases for the current user with optional filtering.
+    
+    Pass the values from the X-Next-Cursor response header as
+    after_created_at/after_id to fetch the next page without OFFSET.
+    """
+    query = select(*CASE_SCHEMA_COLUMNS).where(Case.user_id == current_user.id)
+    
+    # Apply filters
+    if status_filter:
+        query = query.where(Case.status == status_filter)
+    
+    if case_type_filter:
+        query = query.where(Case.case_type == case_type_filter)
+    
+    # Keyset pagination on (created_at, id) walks ix_cases_user_created
+    if after_created_at is not None and after_id is not None:
+        query = query.where(tuple_(Case.created_at, Case.id) < (after_created_at, after_id))
+    elif skip:
+        query = query.offset(skip)
+    
+    # Order by creation date (newest first)
+    cases = (await db.execute(query.order_by(Case.created_at.desc(), Case.id.desc()).limit(limit))).all()
+    
+    if len(cases) == limit:
+        last = cases[-1]
+        response.headers["X-Next-Cursor"] = f"after_created_at={last.created_at.isoformat()}&after_id={last.id}"
+    
+    return cases
 
 @router.get("/{case_id}", response_model=CaseSchema)
 async def get_case(
     case_id: int,
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get a specific case by ID."""
-    try:
-        case = db.query(Case).filter(
-            Case.id == case_id,
-            Case.user_id == current_user.id
-        ).first()
-        
-        if not case:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Case not found or access denied"
-            )
-        
-        return case
-        
-    except Exception as e:
+    case = await db.scalar(
+        select(Case).where(Case.id == case_id, Case.user_id == current_user.id)
+    )
+    
+    if not case:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error getting case: {str(e)}"
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Case not found or access denied"
         )
+    
+    return case
 
 @router.put("/{case_id}", response_model=CaseSchema)
 async def update_case(
     case_id: int,
     case_update: CaseUpdate,
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Update a case."""
-    try:
-        case = db.query(Case).filter(
-            Case.id == case_id,
-            Case.user_id == current_user.id
-        ).first()
-        
-        if not case:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Case not found or access denied"
-            )
-        
-        # Update fields
-        if case_update.title is not None:
-            case.title = case_update.title
-        if case_update.description is not None:
-            case.description = case_update.description
-        if case_update.case_type is not None:
-            case.case_type = case_update.case_type
-        if case_update.status is not None:
-            case.status = case_update.status
-        
-        db.commit()
-        db.refresh(case)
-        
-        return case
-        
-    except Exception as e:
+    case = await db.scalar(
+        select(Case).where(Case.id == case_id, Case.user_id == current_user.id)
+    )
+    
+    if not case:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error updating case: {str(e)}"
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Case not found or access denied"
         )
+    
+    # Update fields
+    if case_update.title is not None:
+        case.title = case_update.title
+    if case_update.description is not None:
+        case.description = case_update.description
+    if case_update.case_type is not None:
+        case.case_type = case_update.case_type
+    if case_update.status is not None:
+        case.status = case_update.status
+    
+    await db.commit()
+    await cache_service.delete(stats_cache_key(current_user.id))
+    
+    return case
 
 @router.delete("/{case_id}")
 async def delete_case(
     case_id: int,
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Delete a case and all associated documents."""
-    try:
-        case = db.query(Case).filter(
-            Case.id == case_id,
-            Case.user_id == current_user.id
-        ).first()
-        
-        if not case:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Case not found or access denied"
-            )
-        
-        # Delete associated documents first
-        documents = db.query(Document).filter(Document.case_id == case_id).all()
-        for doc in documents:
-            db.delete(doc)
-        
-        # Delete the case
-        db.delete(case)
-        db.commit()
-        
-        return {"message": f"Case '{case.title}' and {len(documents)} documents deleted successfully"}
-        
-    except Exception as e:
+    case = await db.scalar(
+        select(Case).where(Case.id == case_id, Case.user_id == current_user.id)
+    )
+    
+    if not case:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error deleting case: {str(e)}"
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Case not found or access denied"
         )
+    
+    # Delete associated documents first in a single statement
+    deleted_documents = (await db.execute(
+        delete(Document)
+        .where(Document.case_id == case_id)
+        .execution_options(synchronize_session=False)
+    )).rowcount
+    
+    # Delete the case
+    await db.delete(case)
+    await db.commit()
+    await cache_service.delete(stats_cache_key(current_user.id))
+    
+    return {"message": f"Case '{case.title}' and {deleted_documents} documents deleted successfully"}
 
 @router.get("/{case_id}/documents")
 async def get_case_documents(
     case_id: int,
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get all documents associated with a specific case."""
-    try:
-        # Verify case ownership
-        case = db.query(Case).filter(
+    # Ownership check and documents in one round-trip; the outer join keeps
+    # a single all-NULL document row for owned cases without documents
+    rows = (await db.execute(
+        select(
+            Case.id,
+            Case.title,
+            Case.case_number,
+            Document.id.label("document_id"),
+            Document.title.label("document_title"),
+            Document.document_type,
+            Document.created_at,
+            func.length(Document.content).label("content_length")
+        ).outerjoin(Document, Document.case_id == Case.id).where(
             Case.id == case_id,
             Case.user_id == current_user.id
-        ).first()
-        
-        if not case:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Case not found or access denied"
-            )
-        
-        # Get documents
-        documents = db.query(Document).filter(Document.case_id == case_id).order_by(Document.created_at.desc()).all()
-        
-        return {
-            "case": {
-                "id": case.id,
-                "title": case.title,
-                "case_number": case.case_number
-            },
-            "documents": [
-                {
-                    "id": doc.id,
-                    "title": doc.title,
-                    "document_type": doc.document_type,
-                    "created_at": doc.created_at,
-                    "content_length": len(doc.content)
-                }
-                for doc in documents
-            ],
-            "total_documents": len(documents)
-        }
-        
-    except Exception as e:
+        ).order_by(Document.created_at.desc())
+    )).all()
+    
+    if not rows:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error getting case documents: {str(e)}"
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Case not found or access denied"
         )
+    
+    case = rows[0]
+    documents = [row for row in rows if row.document_id is not None]
+    
+    return {
+        "case": {
+            "id": case.id,
+            "title": case.title,
+            "case_number": case.case_number
+        },
+        "documents": [
+            {
+                "id": doc.document_id,
+                "title": doc.document_title,
+                "document_type": doc.document_type,
+                "created_at": doc.created_at,
+                "content_length": doc.content_length or 0
+            }
+            for doc in documents
+        ],
+        "total_documents": len(documents)
+    }
+
+async def _document_overview(case_id: int, recent_limit: int):
+    """Document type histogram and most recent documents for a case.
+    
+    Uses its own session: an AsyncSession can't run two statements at once,
+    so this is what lets get_case_summary overlap it with the case lookup.
+    """
+    async with AsyncSessionLocal() as session:
+        document_types = dict((await session.execute(
+            select(Document.document_type, func.count())
+            .where(Document.case_id == case_id)
+            .group_by(Document.document_type)
+        )).all())
+        
+        recent_documents = (await session.execute(
+            select(
+                Document.id,
+                Document.title,
+                Document.document_type,
+                Document.created_at
+            ).where(Document.case_id == case_id).order_by(Document.created_at.desc()).limit(recent_limit)
+        )).all()
+    
+    return document_types, recent_documents
 
 @router.get("/{case_id}/summary")
 async def get_case_summary(
     case_id: int,
+    recent_limit: int = Query(5, ge=1, le=50, description="Number of most recent documents to include"),
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get a summary of a case including key information."""
-    try:
-        # Get case with documents
-        case = db.query(Case).filter(
-            Case.id == case_id,
-            Case.user_id == current_user.id
-        ).first()
-        
-        if not case:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Case not found or access denied"
-            )
-        
-        # Get document count and types
-        documents = db.query(Document).filter(Document.case_id == case_id).all()
-        
-        document_types = {}
-        for doc in documents:
-            doc_type = doc.document_type
-            document_types[doc_type] = document_types.get(doc_type, 0) + 1
-        
-        # Calculate case age
-        from datetime import datetime
-        case_age = (datetime.utcnow() - case.created_at).days
-        
-        return {
-            "case_info": {
-                "id": case.id,
-                "case_number": case.case_number,
-                "title": case.title,
-                "case_type": case.case_type,
-                "status": case.status,
-                "created_at": case.created_at,
-                "updated_at": case.updated_at,
-                "age_days": case_age
-            },
-            "documents": {
-                "total_count": len(documents),
-                "by_type": document_types,
-                "recent_documents": [
-                    {
-                        "id": doc.id,
-                        "title": doc.title,
-                        "type": doc.document_type,
-                        "created_at": doc.created_at
-                    }
-                    for doc in sorted(documents, key=lambda x: x.created_at, reverse=True)[:5]
-                ]
-            },
-            "case_status": {
-                "is_active": case.status == "active",
-                "has_documents": len(documents) > 0,
-                "last_activity": case.updated_at
-            }
-        }
-        
-    except Exception as e:
+    # The case lookup and the document aggregation are independent, so run
+    # them concurrently; the overview is discarded if the case isn't owned
+    case, (document_types, recent_documents) = await asyncio.gather(
+        db.scalar(select(Case).where(Case.id == case_id, Case.user_id == current_user.id)),
+        _document_overview(case_id, recent_limit)
+    )
+    
+    if not case:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error getting case summary: {str(e)}"
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Case not found or access denied"
         )
+    
+    total_documents = sum(document_types.values())
+    
+    # Calculate case age
+    case_age = (datetime.utcnow() - case.created_at).days
+    
+    return {
+        "case_info": {
+            "id": case.id,
+            "case_number": case.case_number,
+            "title": case.title,
+            "case_type": case.case_type,
+            "status": case.status,
+            "created_at": case.created_at,
+            "updated_at": case.updated_at,
+            "age_days": case_age
+        },
+        "documents": {
+            "total_count": total_documents,
+            "by_type": document_types,
+            "recent_documents": [
+                {
+                    "id": doc.id,
+                    "title": doc.title,
+                    "type": doc.document_type,
+                    "created_at": doc.created_at
+                }
+                for doc in recent_documents
+            ]
+        },
+        "case_status": {
+            "is_active": case.status == "active",
+            "has_documents": total_documents > 0,
+            "last_activity": case.updated_at
+        }
+    }
 
 @router.post("/{case_id}/change-status")
 async def change_case_status(
     case_id: int,
     new_status: str,
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Change the status of a case."""
-    try:
-        # Validate status
-        valid_statuses = ["active", "pending", "closed", "archived"]
-        if new_status not in valid_statuses:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail=f"Invalid status. Must be one of: {', '.join(valid_statuses)}"
-            )
-        
-        # Get case
-        case = db.query(Case).filter(
-            Case.id == case_id,
-            Case.user_id == current_user.id
-        ).first()
-        
-        if not case:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="Case not found or access denied"
-            )
-        
-        # Update status
-        old_status = case.status
-        case.status = new_status
-        db.commit()
-        
-        return {
-            "message": f"Case status changed from '{old_status}' to '{new_status}'",
-            "case_id": case_id,
-            "old_status": old_status,
-            "new_status": new_status
-        }
-        
-    except Exception as e:
+    # Validate status
+    if new_status not in _VALID_STATUSES:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=_VALID_STATUSES_MSG
+        )
+    
+    # Verify ownership and read the previous status without hydrating the case.
+    # FOR UPDATE holds the row until the commit, so a concurrent change waits
+    # and then reports this one's status as its old_status
+    old_status = await db.scalar(
+        select(Case.status)
+        .where(Case.id == case_id, Case.user_id == current_user.id)
+        .with_for_update()
+    )
+    
+    if old_status is None:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error changing case status: {str(e)}"
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Case not found or access denied"
         )
+    
+    # Update status
+    await db.execute(
+        update(Case)
+        .where(Case.id == case_id, Case.user_id == current_user.id)
+        .values(status=new_status)
+    )
+    await db.commit()
+    await cache_service.delete(stats_cache_key(current_user.id))
+    
+    return {
+        "message": f"Case status changed from '{old_status}' to '{new_status}'",
+        "case_id": case_id,
+        "old_status": old_status,
+        "new_status": new_status
+    }
 
 @router.get("/statistics/summary")
 async def get_cases_statistics(
     current_user: User = Depends(get_current_active_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_async_db)
 ):
     """Get summary statistics for user's cases."""
-    try:
-        # Get all user cases
-        cases = db.query(Case).filter(Case.user_id == current_user.id).all()
-        
-        if not cases:
-            return {
-                "total_cases": 0,
-                "message": "No cases found"
-            }
-        
-        # Calculate statistics
-        total_cases = len(cases)
-        status_counts = {}
-        type_counts = {}
-        
-        for case in cases:
-            # Status counts
-            status_counts[case.status] = status_counts.get(case.status, 0) + 1
-            
-            # Type counts
-            type_counts[case.case_type] = type_counts.get(case.case_type, 0) + 1
-        
-        # Get recent activity
-        from datetime import datetime, timedelta
-        recent_cases = [case for case in cases if case.updated_at > datetime.utcnow() - timedelta(days=30)]
-        
-        return {
-            "total_cases": total_cases,
-            "status_distribution": status_counts,
-            "type_distribution": type_counts,
-            "recent_activity": {
-                "cases_updated_last_30_days": len(recent_cases),
-                "active_cases": status_counts.get("active", 0),
-                "pending_cases": status_counts.get("pending", 0)
-            },
-            "case_types": list(type_counts.keys())
+    cache_key = stats_cache_key(current_user.id)
+    cached = await cache_service.get(cache_key)
+    if cached is not None:
+        return cached
+    
+    # Status and type distributions, aggregated by the database
+    status_counts = dict((await db.execute(
+        select(Case.status, func.count())
+        .where(Case.user_id == current_user.id)
+        .group_by(Case.status)
+    )).all())
+    
+    if not status_counts:
+        statistics = {
+            "total_cases": 0,
+            "message": "No cases found"
         }
-        
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error getting case statistics: {str(e)}"
-        )
\ No newline at end of file
+        await cache_service.set(cache_key, statistics, STATS_CACHE_TTL)
+        return statistics
+    
+    total_cases = sum(status_counts.values())
+    
+    type_counts = dict((await db.execute(
+        select(Case.case_type, func.count())
+        .where(Case.user_id == current_user.id)
+        .group_by(Case.case_type)
+    )).all())
+    
+    # Get recent activity
+    recent_cases_count = await db.scalar(
+        select(func.count(Case.id)).where(
+            Case.user_id == current_user.id,
+            Case.updated_at > datetime.utcnow() - timedelta(days=30)
+        )
+    )
+    
+    statistics = {
+        "total_cases": total_cases,
+        "status_distribution": status_counts,
+        "type_distribution": type_counts,
+        "recent_activity": {
+            "cases_updated_last_30_days": recent_cases_count,
+            "active_cases": status_counts.get("active", 0),
+            "pending_cases": status_counts.get("pending", 0)
+        },
+        "case_types": list(type_counts.keys())
+    }
+    
+    await cache_service.set(cache_key, statistics, STATS_CACHE_TTL)
+    return statistics
\ No newline at end of file
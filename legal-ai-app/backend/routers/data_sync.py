@@ -1,18 +1,124 @@
 from fastapi import APIRouter, Depends, HTTPException, status
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import insert, inspect, text, tuple_
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
 from sqlalchemy.orm import Session
-from typing import List, Dict, Any
-import json
+from typing import Iterator, List, Dict, Any, Set, Tuple, Optional
+from collections import Counter
+from contextlib import contextmanager
+import orjson
+import asyncio
+import hashlib
+import logging
+import numpy as np
 from datetime import datetime
 
 from models.database import get_db, User, LegalDocument, Template
+from services import get_embeddings_service, get_classifier_service, get_document_generator, get_google_drive_service
 from services.auth import get_current_active_user, get_current_superuser
-from services.google_drive import google_drive_service
-from services.embeddings import embeddings_service
-from services.classifier import classifier_service
+from services.cache import cache_service
+from routers.analysis import MODEL_STATUS_CACHE_KEY
 from config import settings
 
 router = APIRouter(prefix="/data-sync", tags=["data synchronization"])
 
+logger = logging.getLogger(__name__)
+
+# Keys per IN query; keeps bind parameters well under SQLite's limit
+EXISTENCE_CHECK_BATCH_SIZE = 500
+
+# Fields every synced legal document must carry, in reporting order
+REQUIRED_FIELDS = ('tribunal', 'fecha', 'materia', 'partes', 'expediente', 'full_text')
+
+def _existing_legal_document_keys(db: Session, keys: Set[Tuple[str, str]]) -> Set[Tuple[str, str]]:
+    """Return the (expediente, tribunal) pairs from keys already stored."""
+    existing = set()
+    keys = list(keys)
+    for start in range(0, len(keys), EXISTENCE_CHECK_BATCH_SIZE):
+        batch = keys[start:start + EXISTENCE_CHECK_BATCH_SIZE]
+        rows = db.query(LegalDocument.expediente, LegalDocument.tribunal).filter(
+            tuple_(LegalDocument.expediente, LegalDocument.tribunal).in_(batch)
+        ).all()
+        existing.update((row.expediente, row.tribunal) for row in rows)
+    return existing
+
+def _parsed_fecha(doc: Dict[str, Any]) -> Optional[datetime]:
+    """A document's fecha as a datetime, or None when missing or malformed."""
+    try:
+        return datetime.fromisoformat(doc.get('fecha', ''))
+    except (TypeError, ValueError):
+        return None
+
+def _stored_legal_documents(db: Session) -> List[Dict[str, Any]]:
+    """Every stored legal document as a sync-style dict, in insertion order."""
+    rows = db.query(
+        LegalDocument.tribunal, LegalDocument.fecha, LegalDocument.materia, LegalDocument.partes,
+        LegalDocument.expediente, LegalDocument.full_text, LegalDocument.url
+    ).order_by(LegalDocument.id)
+    return [
+        {
+            'tribunal': row.tribunal or '',
+            'fecha': row.fecha.isoformat() if row.fecha else '',
+            'materia': row.materia or '',
+            'partes': row.partes or '',
+            'expediente': row.expediente or '',
+            'full_text': row.full_text or '',
+            'url': row.url or ''
+        }
+        for row in rows
+    ]
+
+@contextmanager
+def _sync_lock(db: Session, name: str) -> Iterator[bool]:
+    """Hold a session-level advisory lock for a sync job on Postgres.
+    
+    Yields False when another worker already holds it. The lock is taken on
+    a connection of its own, so it outlives the commits the sync makes and
+    still covers embedding; it is released when the block exits. The key
+    is a stable digest (hash() is salted per process). Other databases have
+    no advisory locks and always proceed; the unique index still rejects
+    duplicate rows.
+    """
+    engine = db.get_bind()
+    if engine.dialect.name != "postgresql":
+        yield True
+        return
+    key = int.from_bytes(hashlib.blake2b(name.encode("utf-8"), digest_size=8).digest(), "big", signed=True)
+    with engine.connect() as conn:
+        acquired = conn.execute(text("SELECT pg_try_advisory_lock(:key)"), {"key": key}).scalar()
+        # The lock isn't tied to the transaction; don't sit idle in one
+        conn.commit()
+        try:
+            yield acquired
+        finally:
+            if acquired:
+                conn.execute(text("SELECT pg_advisory_unlock(:key)"), {"key": key})
+                conn.commit()
+
+def _has_legal_document_key(db: Session) -> bool:
+    """Whether the unique (expediente, tribunal) index ON CONFLICT relies on exists.
+    
+    Databases created before it was declared get it at startup, unless
+    duplicate rows kept it from being built.
+    """
+    return any(
+        index['unique'] and index['column_names'] == ['expediente', 'tribunal']
+        for index in inspect(db.connection()).get_indexes(LegalDocument.__tablename__)
+    )
+
+def _legal_document_insert(db: Session):
+    """INSERT for legal documents that skips rows already stored concurrently."""
+    dialect = db.get_bind().dialect.name
+    if dialect in ("postgresql", "sqlite") and not _has_legal_document_key(db):
+        # Plain insert; the existence check beforehand still filters known rows
+        return insert(LegalDocument)
+    if dialect == "postgresql":
+        return pg_insert(LegalDocument).on_conflict_do_nothing(index_elements=["expediente", "tribunal"])
+    if dialect == "sqlite":
+        return sqlite_insert(LegalDocument).on_conflict_do_nothing(index_elements=["expediente", "tribunal"])
+    return insert(LegalDocument)
+
 @router.post("/sync-legal-documents")
 async def sync_legal_documents(
     file_id: str,
@@ -20,64 +126,96 @@ async def sync_legal_documents(
     db: Session = Depends(get_db)
 ):
     """Synchronize legal documents from Google Drive JSON file."""
+    embeddings_service = get_embeddings_service()
+    google_drive_service = get_google_drive_service()
     try:
-        print(f"Starting legal documents synchronization from file ID: {file_id}")
-        
-        # Download and parse legal documents
-        documents = google_drive_service.download_legal_documents(file_id)
-        
-        if not documents:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="No documents found in the specified file"
+        # Reject a second concurrent sync of the same file before downloading
+        # it; the lock is held until the index update below has finished
+        with _sync_lock(db, f"sync-legal-documents:{file_id}") as acquired:
+            if not acquired:
+                raise HTTPException(
+                    status_code=status.HTTP_409_CONFLICT,
+                    detail="A synchronization of this file is already in progress"
+                )
+            
+            logger.info("Starting legal documents synchronization from file ID: %s", file_id)
+            
+            # Download and parse legal documents
+            documents = google_drive_service.download_legal_documents(file_id)
+            
+            if not documents:
+                raise HTTPException(
+                    status_code=status.HTTP_400_BAD_REQUEST,
+                    detail="No documents found in the specified file"
+                )
+            
+            logger.info("Downloaded %d legal documents", len(documents))
+            
+            # Look up which documents already exist in one pass instead of per row
+            existing_keys = _existing_legal_document_keys(
+                db, {(doc.get('expediente', ''), doc.get('tribunal', '')) for doc in documents}
             )
-        
-        print(f"Downloaded {len(documents)} legal documents")
-        
-        # Process and store documents
-        processed_count = 0
-        for doc in documents:
-            try:
-                # Check if document already exists
-                existing_doc = db.query(LegalDocument).filter(
-                    LegalDocument.expediente == doc.get('expediente', ''),
-                    LegalDocument.tribunal == doc.get('tribunal', '')
-                ).first()
-                
-                if not existing_doc:
-                    # Create new legal document
-                    legal_doc = LegalDocument(
-                        tribunal=doc.get('tribunal', ''),
-                        fecha=datetime.fromisoformat(doc.get('fecha', '')) if doc.get('fecha') else datetime.now(),
-                        materia=doc.get('materia', ''),
-                        partes=doc.get('partes', ''),
-                        expediente=doc.get('expediente', ''),
-                        full_text=doc.get('full_text', ''),
-                        url=doc.get('url', '')
-                    )
+            
+            # Build rows for new documents
+            new_rows = []
+            new_documents = []
+            for doc in documents:
+                try:
+                    key = (doc.get('expediente', ''), doc.get('tribunal', ''))
                     
-                    db.add(legal_doc)
-                    processed_count += 1
-                
-            except Exception as e:
-                print(f"Error processing document {doc.get('expediente', 'unknown')}: {e}")
-                continue
-        
-        # Commit to database
-        db.commit()
-        print(f"Successfully processed {processed_count} new legal documents")
-        
-        # Update embeddings index
-        print("Updating embeddings index...")
-        embeddings_service.update_index(documents)
-        
-        return {
-            "message": f"Legal documents synchronization completed",
-            "total_downloaded": len(documents),
-            "new_documents_added": processed_count,
-            "embeddings_updated": True
-        }
-        
+                    fecha = _parsed_fecha(doc)
+                    if fecha is None and doc.get('fecha'):
+                        raise ValueError(f"Invalid isoformat string: {doc['fecha']!r}")
+                    
+                    if key not in existing_keys:
+                        new_rows.append({
+                            "tribunal": doc.get('tribunal', ''),
+                            "fecha": fecha or datetime.now(),
+                            "materia": doc.get('materia', ''),
+                            "partes": doc.get('partes', ''),
+                            "expediente": doc.get('expediente', ''),
+                            "full_text": doc.get('full_text', ''),
+                            "url": doc.get('url', '')
+                        })
+                        new_documents.append(doc)
+                        # Also skips repeats of the same document within this file
+                        existing_keys.add(key)
+                    
+                except Exception:
+                    logger.exception("Error processing document %s", doc.get('expediente', 'unknown'))
+                    continue
+            
+            # Insert through Core as one executemany, bypassing the unit of work
+            if new_rows:
+                db.execute(_legal_document_insert(db), new_rows)
+            db.commit()
+            processed_count = len(new_rows)
+            logger.info("Successfully processed %d new legal documents", processed_count)
+            
+            # Only documents new to the database need embedding, as long as the
+            # index still lines up with its documents (e.g. it didn't lose them in
+            # a restart); otherwise it is rebuilt from every stored row
+            embeddings_updated = False
+            if not embeddings_service.index_matches_documents():
+                corpus = await run_in_threadpool(_stored_legal_documents, db)
+                if corpus:
+                    logger.info("Rebuilding embeddings index from %d stored documents...", len(corpus))
+                    await run_in_threadpool(embeddings_service.update_index, corpus)
+                    embeddings_updated = True
+            elif new_documents:
+                logger.info("Updating embeddings index...")
+                await run_in_threadpool(embeddings_service.update_index, new_documents)
+                embeddings_updated = True
+            
+            return {
+                "message": f"Legal documents synchronization completed",
+                "total_downloaded": len(documents),
+                "new_documents_added": processed_count,
+                "embeddings_updated": embeddings_updated
+            }
+            
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -91,11 +229,13 @@ async def sync_templates(
     db: Session = Depends(get_db)
 ):
     """Synchronize document templates from Google Drive folder."""
+    document_generator = get_document_generator()
+    google_drive_service = get_google_drive_service()
     try:
-        print(f"Starting templates synchronization from folder ID: {folder_id}")
+        logger.info("Starting templates synchronization from folder ID: %s", folder_id)
         
         # Download and parse templates
-        templates = google_drive_service.download_templates(folder_id)
+        templates = await google_drive_service.download_templates(folder_id)
         
         if not templates:
             raise HTTPException(
@@ -103,39 +243,40 @@ async def sync_templates(
                 detail="No templates found in the specified folder"
             )
         
-        print(f"Downloaded {len(templates)} templates")
+        logger.info("Downloaded %d templates", len(templates))
         
         # Load templates into document generator
         document_generator.load_templates(templates)
         
-        # Store templates in database
-        processed_count = 0
+        # Store templates in database; existing names are loaded in one query
+        incoming_names = {template.get('name') for template in templates}
+        existing_names = {
+            name for (name,) in db.query(Template.name).filter(Template.name.in_(incoming_names)).all()
+        }
+        
+        new_rows = []
         for template in templates:
             try:
-                # Check if template already exists
-                existing_template = db.query(Template).filter(
-                    Template.name == template['name']
-                ).first()
-                
-                if not existing_template:
-                    # Create new template
-                    db_template = Template(
-                        name=template['name'],
-                        document_type=template.get('document_type', 'general'),
-                        content=template['content'],
-                        structure=json.dumps(document_generator.templates[template['name']]['structure'])
-                    )
-                    
-                    db.add(db_template)
-                    processed_count += 1
+                if template['name'] not in existing_names:
+                    new_rows.append({
+                        "name": template['name'],
+                        "document_type": template.get('document_type', 'general'),
+                        "content": template['content'],
+                        "structure": orjson.dumps(document_generator.templates[template['name']]['structure']).decode()
+                    })
+                    # Also skips repeats of the same name within this folder
+                    existing_names.add(template['name'])
                 
-            except Exception as e:
-                print(f"Error processing template {template['name']}: {e}")
+            except Exception:
+                logger.exception("Error processing template %s", template.get('name', 'unknown'))
                 continue
         
-        # Commit to database
+        # Insert through Core as one executemany, bypassing the unit of work
+        if new_rows:
+            db.execute(insert(Template), new_rows)
         db.commit()
-        print(f"Successfully processed {processed_count} new templates")
+        processed_count = len(new_rows)
+        logger.info("Successfully processed %d new templates", processed_count)
         
         return {
             "message": f"Templates synchronization completed",
@@ -155,6 +296,8 @@ async def train_ml_models(
     current_user: User = Depends(get_current_superuser)
 ):
     """Train the ML models with current data."""
+    embeddings_service = get_embeddings_service()
+    classifier_service = get_classifier_service()
     try:
         if not embeddings_service.documents:
             raise HTTPException(
@@ -162,7 +305,7 @@ async def train_ml_models(
                 detail="No documents available for training. Please sync data first."
             )
         
-        print("Starting ML model training...")
+        logger.info("Starting ML model training...")
         
         # Train classifier
         training_success = classifier_service.train_classifier(embeddings_service.documents)
@@ -173,7 +316,8 @@ async def train_ml_models(
                 detail="Failed to train classifier"
             )
         
-        print("ML model training completed successfully")
+        await cache_service.delete(MODEL_STATUS_CACHE_KEY)
+        logger.info("ML model training completed successfully")
         
         return {
             "message": "ML models trained successfully",
@@ -188,11 +332,64 @@ async def train_ml_models(
             detail=f"Error during model training: {str(e)}"
         )
 
+@router.post("/rebuild-all")
+async def rebuild_all_models(
+    current_user: User = Depends(get_current_superuser)
+):
+    """Retrain the classifier and rebuild the search index in one job."""
+    embeddings_service = get_embeddings_service()
+    classifier_service = get_classifier_service()
+    try:
+        documents = embeddings_service.documents
+        if not documents:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail="No documents available for training. Please sync data first."
+            )
+        
+        logger.info("Starting full model rebuild...")
+        
+        # Training works on TF-IDF features and reindexing on sentence
+        # embeddings, so the two touch disjoint state and can overlap
+        training_success, embeddings = await asyncio.gather(
+            run_in_threadpool(classifier_service.train_classifier, documents),
+            run_in_threadpool(embeddings_service.rebuild_index)
+        )
+        
+        if not training_success:
+            raise HTTPException(
+                status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+                detail="Failed to train classifier"
+            )
+        
+        await cache_service.delete(MODEL_STATUS_CACHE_KEY)
+        logger.info("Full model rebuild completed successfully")
+        
+        return {
+            "message": "ML models trained and documents reindexed successfully",
+            "classifier_trained": True,
+            "total_training_documents": len(documents),
+            "search_index_rebuilt": True,
+            "embeddings_created": embeddings.shape
+        }
+        
+    except HTTPException:
+        raise
+    except Exception as e:
+        raise HTTPException(
+            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
+            detail=f"Error during model rebuild: {str(e)}"
+        )
+
 @router.get("/sync-status")
 async def get_sync_status(
     current_user: User = Depends(get_current_active_user)
 ):
     """Get the current synchronization status."""
+    embeddings_service = get_embeddings_service()
+    classifier_service = get_classifier_service()
+    document_generator = get_document_generator()
+    google_drive_service = get_google_drive_service()
     try:
         return {
             "legal_documents": {
@@ -226,6 +423,7 @@ async def reindex_documents(
     current_user: User = Depends(get_current_superuser)
 ):
     """Rebuild the search index from scratch."""
+    embeddings_service = get_embeddings_service()
     try:
         if not embeddings_service.documents:
             raise HTTPException(
@@ -233,15 +431,12 @@ async def reindex_documents(
                 detail="No documents available for indexing"
             )
         
-        print("Starting document reindexing...")
+        logger.info("Starting document reindexing...")
         
-        # Create new embeddings
-        embeddings = embeddings_service.create_embeddings(embeddings_service.documents)
+        # Encoding and index building are CPU/GPU-bound; keep them off the event loop
+        embeddings = await run_in_threadpool(embeddings_service.rebuild_index)
         
-        # Build new FAISS index
-        embeddings_service.build_faiss_index(embeddings)
-        
-        print("Document reindexing completed successfully")
+        logger.info("Document reindexing completed successfully")
         
         return {
             "message": "Documents reindexed successfully",
@@ -261,6 +456,7 @@ async def get_document_statistics(
     current_user: User = Depends(get_current_active_user)
 ):
     """Get statistics about the indexed documents."""
+    embeddings_service = get_embeddings_service()
     try:
         if not embeddings_service.documents:
             return {
@@ -269,47 +465,28 @@ async def get_document_statistics(
             }
         
         # Analyze documents
-        tribunals = {}
-        materias = {}
-        years = {}
-        text_lengths = []
-        
-        for doc in embeddings_service.documents:
-            # Tribunal distribution
-            tribunal = doc.get('tribunal', 'Unknown')
-            tribunals[tribunal] = tribunals.get(tribunal, 0) + 1
-            
-            # Materia distribution
-            materia = doc.get('materia', 'Unknown')
-            materias[materia] = materias.get(materia, 0) + 1
-            
-            # Year distribution
-            try:
-                year = datetime.fromisoformat(doc.get('fecha', '')).year
-                years[year] = years.get(year, 0) + 1
-            except:
-                pass
-            
-            # Text length
-            text_lengths.append(len(doc.get('full_text', '')))
-        
-        # Calculate statistics
-        avg_text_length = sum(text_lengths) / len(text_lengths) if text_lengths else 0
+        docs = embeddings_service.documents
+        tribunals = Counter(doc.get('tribunal', 'Unknown') for doc in docs)
+        materias = Counter(doc.get('materia', 'Unknown') for doc in docs)
+        # Years come from the dates the service parsed for its metadata index
+        years = embeddings_service.corpus_stats['years']
+        text_lengths = np.fromiter((len(doc.get('full_text', '')) for doc in docs), dtype=np.int64, count=len(docs))
+        total_text_length = int(text_lengths.sum())
         
         return {
-            "total_documents": len(embeddings_service.documents),
-            "tribunal_distribution": dict(sorted(tribunals.items(), key=lambda x: x[1], reverse=True)[:10]),
-            "materia_distribution": dict(sorted(materias.items(), key=lambda x: x[1], reverse=True)[:10]),
-            "year_distribution": dict(sorted(years.items(), key=lambda x: x[1], reverse=True)[:10]),
+            "total_documents": len(docs),
+            "tribunal_distribution": dict(tribunals.most_common(10)),
+            "materia_distribution": dict(materias.most_common(10)),
+            "year_distribution": dict(years.most_common(10)),
             "text_statistics": {
-                "average_length": round(avg_text_length, 2),
-                "total_text_length": sum(text_lengths),
-                "shortest_document": min(text_lengths) if text_lengths else 0,
-                "longest_document": max(text_lengths) if text_lengths else 0
+                "average_length": round(total_text_length / len(docs), 2),
+                "total_text_length": total_text_length,
+                "shortest_document": int(text_lengths.min()),
+                "longest_document": int(text_lengths.max())
             },
             "index_status": {
                 "faiss_index_available": embeddings_service.faiss_index is not None,
-                "embeddings_created": len(embeddings_service.embeddings) if embeddings_service.embeddings else 0
+                "embeddings_created": len(embeddings_service.embeddings)
             }
         }
         
@@ -324,6 +501,7 @@ async def validate_synced_data(
     current_user: User = Depends(get_current_superuser)
 ):
     """Validate the quality and consistency of synced data."""
+    embeddings_service = get_embeddings_service()
     try:
         if not embeddings_service.documents:
             return {
@@ -331,7 +509,7 @@ async def validate_synced_data(
                 "validation_passed": False
             }
         
-        print("Starting data validation...")
+        logger.info("Starting data validation...")
         
         validation_results = {
             "total_documents": len(embeddings_service.documents),
@@ -340,39 +518,47 @@ async def validate_synced_data(
             "passed_validation": True
         }
         
-        # Validate document structure
-        for i, doc in enumerate(embeddings_service.documents):
-            # Check required fields
-            required_fields = ['tribunal', 'fecha', 'materia', 'partes', 'expediente', 'full_text']
-            missing_fields = [field for field in required_fields if not doc.get(field)]
+        # Validate document structure in a single pass per document
+        validation_errors = validation_results["validation_errors"]
+        warnings = validation_results["warnings"]
+        
+        # NaT where the metadata index couldn't parse a document's fecha; both
+        # come from one snapshot so they line up even if a sync swaps the index
+        snapshot = embeddings_service.snapshot()
+        invalid_dates = np.isnat(snapshot.columns['fecha'])
+        
+        for i, doc in enumerate(snapshot.documents):
+            values = tuple(map(doc.get, REQUIRED_FIELDS))
+            expediente = doc.get('expediente', 'Unknown')
             
+            # Check required fields
+            missing_fields = [field for field, value in zip(REQUIRED_FIELDS, values) if not value]
             if missing_fields:
-                validation_results["validation_errors"].append({
+                validation_errors.append({
                     "document_index": i,
-                    "expediente": doc.get('expediente', 'Unknown'),
+                    "expediente": expediente,
                     "missing_fields": missing_fields
                 })
-                validation_results["passed_validation"] = False
             
             # Check text length
-            text_length = len(doc.get('full_text', ''))
+            text_length = len(values[5] or '')
             if text_length < 100:
-                validation_results["warnings"].append({
+                warnings.append({
                     "document_index": i,
-                    "expediente": doc.get('expediente', 'Unknown'),
+                    "expediente": expediente,
                     "warning": f"Very short text ({text_length} characters)"
                 })
             
             # Check date format
-            try:
-                datetime.fromisoformat(doc.get('fecha', ''))
-            except:
-                validation_results["validation_errors"].append({
+            if invalid_dates[i]:
+                validation_errors.append({
                     "document_index": i,
-                    "expediente": doc.get('expediente', 'Unknown'),
+                    "expediente": expediente,
                     "error": "Invalid date format"
                 })
-                validation_results["passed_validation"] = False
+        
+        if validation_errors:
+            validation_results["passed_validation"] = False
         
         # Check embeddings consistency
         if embeddings_service.embeddings is not None:
@@ -384,7 +570,7 @@ async def validate_synced_data(
                 })
                 validation_results["passed_validation"] = False
         
-        print(f"Data validation completed. Passed: {validation_results['passed_validation']}")
+        logger.info("Data validation completed. Passed: %s", validation_results['passed_validation'])
         
         return validation_results
         
@@ -1,18 +1,49 @@
-from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File
+from fastapi import APIRouter, Depends, HTTPException, status, UploadFile, File, Query, Response
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from typing import List, Optional
+from typing import List, Optional, BinaryIO
 import json
+import orjson
+import tempfile
 
-from models.database import get_db, User, Case, Document, Template
+from models.database import get_db, AsyncSessionLocal, User, Case, Document, Template
 from models.schemas import (
-    DocumentGenerationRequest, DocumentGenerationResponse, DocumentCreate, 
-    Document as DocumentSchema, TemplateCreate, Template as TemplateSchema
+    DocumentGenerationRequest, DocumentGenerationResponse, BulkGenerationStatus, DocumentCreate, 
+    Document as DocumentSchema, DocumentListItem, TemplateCreate, Template as TemplateSchema
 )
+from services import get_document_generator
 from services.auth import get_current_active_user
-from services.document_generator import document_generator
 
 router = APIRouter(prefix="/documents", tags=["document generation"])
 
+# Columns serialized by DocumentListItem; listings never load content
+DOCUMENT_LIST_COLUMNS = (
+    Document.id, Document.title, Document.document_type, Document.case_id, Document.created_at
+)
+
+# Template uploads are copied in chunks and capped, so one upload can't pin RAM
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_TEMPLATE_UPLOAD_BYTES = 20 * 1024 * 1024
+
+def _copy_upload(source: BinaryIO, destination: BinaryIO) -> int:
+    """Copy an upload chunk by chunk, returning its size; raises past the cap."""
+    size = 0
+    while chunk := source.read(UPLOAD_CHUNK_SIZE):
+        size += len(chunk)
+        if size > MAX_TEMPLATE_UPLOAD_BYTES:
+            raise ValueError("upload too large")
+        destination.write(chunk)
+    destination.flush()
+    return size
+
+def _extract_pdf_text(path: str) -> str:
+    """Extract the text of every page of a PDF, joined in one pass."""
+    # Imported lazily; PyMuPDF is only needed for PDF uploads
+    import fitz
+    with fitz.open(path) as doc:
+        return "".join([page.get_text("text") for page in doc])
+
 @router.post("/generate", response_model=DocumentGenerationResponse)
 async def generate_legal_document(
     request: DocumentGenerationRequest,
@@ -20,6 +51,7 @@ async def generate_legal_document(
     db: Session = Depends(get_db)
 ):
     """Generate a legal document using templates and AI."""
+    document_generator = get_document_generator()
     try:
         # Verify case exists and belongs to user
         case = db.query(Case).filter(
@@ -34,7 +66,7 @@ async def generate_legal_document(
             )
         
         # Generate document
-        generated_doc = document_generator.generate_document(
+        generated_doc = await document_generator.generate_document_async(
             request.template_name,
             request.case_details,
             request.case_id
@@ -51,7 +83,6 @@ async def generate_legal_document(
         
         db.add(db_document)
         db.commit()
-        db.refresh(db_document)
         
         return DocumentGenerationResponse(
             generated_document=generated_doc['generated_document'],
@@ -65,11 +96,123 @@ async def generate_legal_document(
             detail=f"Error generating document: {str(e)}"
         )
 
+@router.post("/generate/stream")
+async def stream_legal_document(
+    request: DocumentGenerationRequest,
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    """Generate a legal document, streaming the text as the model writes it.
+    
+    Template and citations are sent up front in headers; the document is
+    saved once the stream completes.
+    """
+    document_generator = get_document_generator()
+    case = db.query(Case).filter(
+        Case.id == request.case_id,
+        Case.user_id == current_user.id
+    ).first()
+    
+    if not case:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Case not found or access denied"
+        )
+    
+    try:
+        generated_doc = await document_generator.generate_document_async(
+            request.template_name,
+            request.case_details,
+            request.case_id,
+            stream=True
+        )
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    
+    title = f"{request.document_type} - {case.title}"
+    user_id = current_user.id
+    
+    async def document_chunks():
+        chunks = []
+        async for chunk in generated_doc['generated_document']:
+            chunks.append(chunk)
+            yield chunk
+        
+        # The request's session is already closed while the body streams
+        async with AsyncSessionLocal() as session:
+            session.add(Document(
+                title=title,
+                document_type=request.document_type,
+                content="".join(chunks),
+                case_id=request.case_id,
+                user_id=user_id
+            ))
+            await session.commit()
+    
+    return StreamingResponse(
+        document_chunks(),
+        media_type="text/plain; charset=utf-8",
+        headers={
+            "X-Template-Used": json.dumps(generated_doc['template_used']),
+            "X-Citations": json.dumps(generated_doc['citations']),
+            # GZipMiddleware passes responses with a Content-Encoding through
+            # untouched; compressed, tokens would sit in zlib's buffer until the end
+            "Content-Encoding": "identity"
+        }
+    )
+
+@router.post("/generate-bulk", response_model=BulkGenerationStatus)
+def submit_bulk_generation(
+    requests: List[DocumentGenerationRequest],
+    current_user: User = Depends(get_current_active_user),
+    db: Session = Depends(get_db)
+):
+    """Queue AI generation of many documents as one discounted OpenAI batch."""
+    document_generator = get_document_generator()
+    case_ids = {request.case_id for request in requests}
+    owned = {
+        case_id for (case_id,) in db.query(Case.id).filter(
+            Case.id.in_(case_ids),
+            Case.user_id == current_user.id
+        ).all()
+    }
+    if owned != case_ids:
+        raise HTTPException(
+            status_code=status.HTTP_404_NOT_FOUND,
+            detail="Case not found or access denied"
+        )
+    
+    jobs = [
+        {'custom_id': str(position), 'template_name': request.template_name, 'case_details': request.case_details}
+        for position, request in enumerate(requests)
+    ]
+    try:
+        batch = document_generator.submit_bulk_generation(jobs, owner=str(current_user.id))
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    
+    return BulkGenerationStatus(batch_id=batch['batch_id'], status=batch['status'], documents={})
+
+@router.get("/generate-bulk/{batch_id}", response_model=BulkGenerationStatus)
+def get_bulk_generation(
+    batch_id: str,
+    current_user: User = Depends(get_current_active_user)
+):
+    """Poll a bulk generation batch; documents are filled in once it completes."""
+    document_generator = get_document_generator()
+    try:
+        return document_generator.collect_bulk_generation(batch_id, owner=str(current_user.id))
+    except ValueError as e:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail=str(e))
+    except LookupError as e:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail=str(e))
+
 @router.get("/templates", response_model=List[TemplateSchema])
 async def get_available_templates(
     current_user: User = Depends(get_current_active_user)
 ):
     """Get list of available document templates."""
+    document_generator = get_document_generator()
     try:
         templates = document_generator.get_available_templates()
         return templates
@@ -86,6 +229,7 @@ async def create_custom_template(
     db: Session = Depends(get_db)
 ):
     """Create a custom document template."""
+    document_generator = get_document_generator()
     try:
         # Check if template name already exists
         existing_template = db.query(Template).filter(Template.name == template.name).first()
@@ -113,12 +257,11 @@ async def create_custom_template(
             name=template.name,
             document_type=template.document_type,
             content=template.content,
-            structure=json.dumps(document_generator.templates[template.name]['structure'])
+            structure=orjson.dumps(document_generator.templates[template.name]['structure']).decode()
         )
         
         db.add(db_template)
         db.commit()
-        db.refresh(db_template)
         
         return db_template
         
@@ -134,6 +277,7 @@ async def get_template_details(
     current_user: User = Depends(get_current_active_user)
 ):
     """Get detailed information about a specific template."""
+    document_generator = get_document_generator()
     try:
         if template_name not in document_generator.templates:
             raise HTTPException(
@@ -164,6 +308,7 @@ async def upload_template_file(
     current_user: User = Depends(get_current_active_user)
 ):
     """Upload a template file (PDF, DOC, TXT)."""
+    document_generator = get_document_generator()
     try:
         if not file.filename:
             raise HTTPException(
@@ -171,20 +316,26 @@ async def upload_template_file(
                 detail="No file provided"
             )
         
-        # Read file content
-        content = await file.read()
+        too_large = HTTPException(
+            status_code=status.HTTP_413_REQUEST_ENTITY_TOO_LARGE,
+            detail=f"Template files are limited to {MAX_TEMPLATE_UPLOAD_BYTES // (1024 * 1024)} MB"
+        )
         
         # Extract text based on file type
         if file.filename.endswith('.txt'):
+            content = await file.read(MAX_TEMPLATE_UPLOAD_BYTES + 1)
+            if len(content) > MAX_TEMPLATE_UPLOAD_BYTES:
+                raise too_large
             text_content = content.decode('utf-8')
         elif file.filename.endswith('.pdf'):
-            # Use PyMuPDF to extract text
-            import fitz
-            doc = fitz.open(stream=content, filetype="pdf")
-            text_content = ""
-            for page in doc:
-                text_content += page.get_text()
-            doc.close()
+            # Stream to a temp file and let PyMuPDF read it from disk; both
+            # steps block, so they run off the event loop
+            with tempfile.NamedTemporaryFile(suffix=".pdf") as tmp:
+                try:
+                    await run_in_threadpool(_copy_upload, file.file, tmp)
+                except ValueError:
+                    raise too_large
+                text_content = await run_in_threadpool(_extract_pdf_text, tmp.name)
         else:
             raise HTTPException(
                 status_code=status.HTTP_400_BAD_REQUEST,
@@ -218,6 +369,8 @@ async def upload_template_file(
                 detail="Failed to create template"
             )
             
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(
             status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
@@ -231,6 +384,7 @@ async def summarize_document(
     current_user: User = Depends(get_current_active_user)
 ):
     """Generate a summary of a legal document."""
+    document_generator = get_document_generator()
     try:
         if summary_type not in ["technical", "citizen"]:
             raise HTTPException(
@@ -238,7 +392,10 @@ async def summarize_document(
                 detail="Summary type must be 'technical' or 'citizen'"
             )
         
-        summary = document_generator.generate_summary(document_content, summary_type)
+        # The LLM call blocks; keep it off the event loop
+        summary = await run_in_threadpool(
+            document_generator.generate_summary, document_content, summary_type, current_user.id
+        )
         
         return {
             "summary": summary,
@@ -253,22 +410,38 @@ async def summarize_document(
             detail=f"Error generating summary: {str(e)}"
         )
 
-@router.get("/user-documents", response_model=List[DocumentSchema])
+@router.get("/user-documents", response_model=List[DocumentListItem])
 async def get_user_documents(
+    response: Response,
     skip: int = 0,
     limit: int = 100,
     case_id: Optional[int] = None,
+    after_id: Optional[int] = Query(None, description="Keyset cursor: id of the last document seen"),
     current_user: User = Depends(get_current_active_user),
     db: Session = Depends(get_db)
 ):
-    """Get documents created by the current user."""
+    """Get documents created by the current user, newest first.
+    
+    Pass the X-Next-Cursor response header value as after_id to fetch the
+    next page without OFFSET.
+    """
     try:
-        query = db.query(Document).filter(Document.user_id == current_user.id)
+        query = db.query(*DOCUMENT_LIST_COLUMNS).filter(Document.user_id == current_user.id)
         
         if case_id:
             query = query.filter(Document.case_id == case_id)
         
-        documents = query.offset(skip).limit(limit).all()
+        # Keyset pagination on id walks ix_documents_user_id_desc
+        if after_id is not None:
+            query = query.filter(Document.id < after_id)
+        elif skip:
+            query = query.offset(skip)
+        
+        documents = query.order_by(Document.id.desc()).limit(limit).all()
+        
+        if len(documents) == limit:
+            response.headers["X-Next-Cursor"] = f"after_id={documents[-1].id}"
+        
         return documents
         
     except Exception as e:
@@ -330,7 +503,6 @@ async def update_user_document(
         document.content = document_update.content
         
         db.commit()
-        db.refresh(document)
         
         return document
         
@@ -376,6 +548,7 @@ async def analyze_document_structure(
     current_user: User = Depends(get_current_active_user)
 ):
     """Analyze the structure of a legal document."""
+    document_generator = get_document_generator()
     try:
         structure = document_generator._analyze_template_structure(document_content)
         
@@ -395,6 +568,7 @@ async def analyze_document_structure(
 @router.get("/generation-status")
 async def get_generation_status(current_user: User = Depends(get_current_active_user)):
     """Get the status of document generation services."""
+    document_generator = get_document_generator()
     try:
         return {
             "ai_services_available": {
@@ -1,92 +1,98 @@
-from fastapi import APIRouter, Depends, HTTPException, status, Query
+from fastapi import APIRouter, Depends, HTTPException, status, Query, Header
+from fastapi.responses import StreamingResponse
+from starlette.concurrency import run_in_threadpool
 from sqlalchemy.orm import Session
-from typing import List, Optional
+from typing import Any, Dict, Iterable, List, Optional
 from datetime import datetime
+import numpy as np
+import orjson
 
-from models.database import get_db, User, LegalDocument
-from models.schemas import SearchQuery, SearchResult
+from models.database import get_db, User
+from models.schemas import SearchQuery, SearchResult, LegalDocument as LegalDocumentSchema
+from services import get_embeddings_service
+from services.query_batcher import query_batcher
 from services.auth import get_current_active_user
-from services.embeddings import embeddings_service
 
 router = APIRouter(prefix="/search", tags=["legal search"])
 
-@router.post("/query", response_model=List[SearchResult])
+NDJSON_MEDIA_TYPE = "application/x-ndjson"
+
+def _document_hit(snapshot, idx: int) -> Dict[str, Any]:
+    """Result entry for a metadata lookup (no similarity score)."""
+    doc = snapshot.documents[idx]
+    return {
+        'tribunal': doc.get('tribunal', ''),
+        'fecha': doc.get('fecha', ''),
+        'materia': doc.get('materia', ''),
+        'partes': doc.get('partes', ''),
+        'expediente': doc.get('expediente', ''),
+        'url': doc.get('url', ''),
+        'excerpt': snapshot.columns['excerpt'][idx]
+    }
+
+def _ndjson_response(rows: Iterable[Dict[str, Any]]) -> StreamingResponse:
+    """Stream rows one JSON object per line as they are produced."""
+    return StreamingResponse((orjson.dumps(row) + b"\n" for row in rows), media_type=NDJSON_MEDIA_TYPE)
+
+# Results are built from trusted index data, so skip response validation and
+# only document the shape
+@router.post("/query", response_model=None, responses={200: {"model": List[SearchResult]}})
 async def search_legal_documents(
     search_query: SearchQuery,
     current_user: User = Depends(get_current_active_user)
 ):
     """Search for legal documents using vector similarity and filters."""
-    try:
-        if not embeddings_service.faiss_index:
-            raise HTTPException(
-                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                detail="Search index not available. Please wait for indexing to complete."
-            )
-        
-        # Perform vector search
-        similar_indices = embeddings_service.search_similar_documents(
-            search_query.query, 
-            search_query.limit
-        )
-        
-        # Filter results based on criteria
-        filtered_results = []
-        for idx, score in similar_indices:
-            if idx < len(embeddings_service.documents):
-                doc = embeddings_service.documents[idx]
-                
-                # Apply filters
-                if search_query.tribunal and search_query.tribunal.lower() not in doc.get('tribunal', '').lower():
-                    continue
-                    
-                if search_query.materia and search_query.materia.lower() not in doc.get('materia', '').lower():
-                    continue
-                
-                if search_query.fecha_desde:
-                    try:
-                        doc_date = datetime.fromisoformat(doc.get('fecha', ''))
-                        if doc_date < search_query.fecha_desde:
-                            continue
-                    except:
-                        pass
-                
-                if search_query.fecha_hasta:
-                    try:
-                        doc_date = datetime.fromisoformat(doc.get('fecha', ''))
-                        if doc_date > search_query.fecha_hasta:
-                            continue
-                    except:
-                        pass
-                
-                # Create search result
-                legal_doc = LegalDocument(
-                    id=idx,
-                    tribunal=doc.get('tribunal', ''),
-                    fecha=datetime.fromisoformat(doc.get('fecha', '')) if doc.get('fecha') else datetime.now(),
-                    materia=doc.get('materia', ''),
-                    partes=doc.get('partes', ''),
-                    expediente=doc.get('expediente', ''),
-                    full_text=doc.get('full_text', ''),
-                    url=doc.get('url', '')
-                )
-                
-                result = SearchResult(
-                    legal_document=legal_doc,
-                    similarity_score=score
-                )
-                
-                filtered_results.append(result)
-        
-        # Sort by similarity score
-        filtered_results.sort(key=lambda x: x.similarity_score, reverse=True)
-        
-        return filtered_results[:search_query.limit]
-        
-    except Exception as e:
+    # Index, documents and columns all come from this one snapshot, so an
+    # index swap mid-request can't pair ids with the wrong documents
+    snapshot = get_embeddings_service().snapshot()
+    if not snapshot.faiss_index:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error during search: {str(e)}"
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Search index not available. Please wait for indexing to complete."
         )
+    
+    # Perform vector search
+    similar_indices = await query_batcher.submit(search_query.query, search_query.limit, snapshot)
+    
+    # Filter all results at once against the interned metadata columns
+    columns = snapshot.columns
+    result_ids = np.fromiter((idx for idx, _ in similar_indices), dtype=np.int64, count=len(similar_indices))
+    keep = snapshot.filter_mask(
+        result_ids,
+        tribunal=search_query.tribunal,
+        materia=search_query.materia,
+        start=search_query.fecha_desde,
+        end=search_query.fecha_hasta
+    )
+    
+    filtered_results = []
+    for (idx, score), kept in zip(similar_indices, keep):
+        if kept:
+            doc = snapshot.documents[idx]
+            doc_date = columns['fecha'][idx]
+            
+            # Create search result without re-validating server-side data
+            legal_doc = LegalDocumentSchema.model_construct(
+                id=idx,
+                tribunal=doc.get('tribunal', ''),
+                fecha=doc_date.item() or datetime.now(),
+                materia=doc.get('materia', ''),
+                partes=doc.get('partes', ''),
+                expediente=doc.get('expediente', ''),
+                full_text=doc.get('full_text', ''),
+                url=doc.get('url', ''),
+                created_at=None
+            )
+            
+            result = SearchResult.model_construct(
+                legal_document=legal_doc,
+                similarity_score=score
+            )
+            
+            filtered_results.append(result)
+    
+    # Already in descending score order: FAISS ranks results and the filters only drop entries
+    return filtered_results[:search_query.limit]
 
 @router.get("/semantic")
 async def semantic_search(
@@ -95,184 +101,133 @@ async def semantic_search(
     current_user: User = Depends(get_current_active_user)
 ):
     """Semantic search for legal documents using natural language queries."""
-    try:
-        if not embeddings_service.faiss_index:
-            raise HTTPException(
-                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                detail="Search index not available. Please wait for indexing to complete."
-            )
-        
-        # Perform semantic search
-        similar_indices = embeddings_service.search_similar_documents(query, limit)
-        
-        results = []
-        for idx, score in similar_indices:
-            if idx < len(embeddings_service.documents):
-                doc = embeddings_service.documents[idx]
-                results.append({
-                    'tribunal': doc.get('tribunal', ''),
-                    'fecha': doc.get('fecha', ''),
-                    'materia': doc.get('materia', ''),
-                    'partes': doc.get('partes', ''),
-                    'expediente': doc.get('expediente', ''),
-                    'url': doc.get('url', ''),
-                    'similarity_score': float(score),
-                    'excerpt': doc.get('full_text', '')[:200] + '...' if len(doc.get('full_text', '')) > 200 else doc.get('full_text', '')
-                })
-        
-        return {
-            'query': query,
-            'results': results,
-            'total_found': len(results)
-        }
-        
-    except Exception as e:
+    snapshot = get_embeddings_service().snapshot()
+    if not snapshot.faiss_index:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error during semantic search: {str(e)}"
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Search index not available. Please wait for indexing to complete."
         )
+    
+    # Perform semantic search
+    similar_indices = await query_batcher.submit(query, limit, snapshot)
+    
+    results = []
+    for idx, score in similar_indices:
+        if idx < len(snapshot.documents):
+            doc = snapshot.documents[idx]
+            results.append({
+                'tribunal': doc.get('tribunal', ''),
+                'fecha': doc.get('fecha', ''),
+                'materia': doc.get('materia', ''),
+                'partes': doc.get('partes', ''),
+                'expediente': doc.get('expediente', ''),
+                'url': doc.get('url', ''),
+                'similarity_score': float(score),
+                'excerpt': snapshot.columns['excerpt'][idx]
+            })
+    
+    return {
+        'query': query,
+        'results': results,
+        'total_found': len(results)
+    }
 
 @router.get("/by-tribunal")
-async def search_by_tribunal(
+def search_by_tribunal(
     tribunal: str = Query(..., description="Tribunal name to search for"),
     limit: int = Query(20, description="Maximum number of results"),
+    accept: Optional[str] = Header(None),
     current_user: User = Depends(get_current_active_user)
 ):
-    """Search for legal documents by specific tribunal."""
-    try:
-        if not embeddings_service.documents:
-            raise HTTPException(
-                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                detail="No documents available for search."
-            )
-        
-        results = []
-        for doc in embeddings_service.documents:
-            if tribunal.lower() in doc.get('tribunal', '').lower():
-                results.append({
-                    'tribunal': doc.get('tribunal', ''),
-                    'fecha': doc.get('fecha', ''),
-                    'materia': doc.get('materia', ''),
-                    'partes': doc.get('partes', ''),
-                    'expediente': doc.get('expediente', ''),
-                    'url': doc.get('url', ''),
-                    'excerpt': doc.get('full_text', '')[:200] + '...' if len(doc.get('full_text', '')) > 200 else doc.get('full_text', '')
-                })
-                
-                if len(results) >= limit:
-                    break
-        
-        return {
-            'tribunal': tribunal,
-            'results': results,
-            'total_found': len(results)
-        }
-        
-    except Exception as e:
+    """Search for legal documents by specific tribunal.
+    
+    Clients sending Accept: application/x-ndjson get one result per line,
+    streamed as matches are read, instead of a single JSON object.
+    """
+    snapshot = get_embeddings_service().snapshot()
+    if not snapshot.documents:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error searching by tribunal: {str(e)}"
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="No documents available for search."
         )
+    
+    ids = snapshot.ids_by_tribunal(tribunal, limit)
+    if accept and NDJSON_MEDIA_TYPE in accept:
+        return _ndjson_response(_document_hit(snapshot, idx) for idx in ids)
+    
+    results = [_document_hit(snapshot, idx) for idx in ids]
+    return {
+        'tribunal': tribunal,
+        'results': results,
+        'total_found': len(results)
+    }
 
 @router.get("/by-materia")
-async def search_by_materia(
+def search_by_materia(
     materia: str = Query(..., description="Legal matter to search for"),
     limit: int = Query(20, description="Maximum number of results"),
+    accept: Optional[str] = Header(None),
     current_user: User = Depends(get_current_active_user)
 ):
-    """Search for legal documents by specific legal matter."""
-    try:
-        if not embeddings_service.documents:
-            raise HTTPException(
-                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                detail="No documents available for search."
-            )
-        
-        results = []
-        for doc in embeddings_service.documents:
-            if materia.lower() in doc.get('materia', '').lower():
-                results.append({
-                    'tribunal': doc.get('tribunal', ''),
-                    'fecha': doc.get('fecha', ''),
-                    'materia': doc.get('materia', ''),
-                    'partes': doc.get('partes', ''),
-                    'expediente': doc.get('expediente', ''),
-                    'url': doc.get('url', ''),
-                    'excerpt': doc.get('full_text', '')[:200] + '...' if len(doc.get('full_text', '')) > 200 else doc.get('full_text', '')
-                })
-                
-                if len(results) >= limit:
-                    break
-        
-        return {
-            'materia': materia,
-            'results': results,
-            'total_found': len(results)
-        }
-        
-    except Exception as e:
+    """Search for legal documents by specific legal matter.
+    
+    Clients sending Accept: application/x-ndjson get one result per line,
+    streamed as matches are read, instead of a single JSON object.
+    """
+    snapshot = get_embeddings_service().snapshot()
+    if not snapshot.documents:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error searching by materia: {str(e)}"
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="No documents available for search."
         )
+    
+    ids = snapshot.ids_by_materia(materia, limit)
+    if accept and NDJSON_MEDIA_TYPE in accept:
+        return _ndjson_response(_document_hit(snapshot, idx) for idx in ids)
+    
+    results = [_document_hit(snapshot, idx) for idx in ids]
+    return {
+        'materia': materia,
+        'results': results,
+        'total_found': len(results)
+    }
 
 @router.get("/by-date-range")
-async def search_by_date_range(
+def search_by_date_range(
     fecha_desde: str = Query(..., description="Start date (YYYY-MM-DD)"),
     fecha_hasta: str = Query(..., description="End date (YYYY-MM-DD)"),
     limit: int = Query(20, description="Maximum number of results"),
     current_user: User = Depends(get_current_active_user)
 ):
     """Search for legal documents within a date range."""
+    snapshot = get_embeddings_service().snapshot()
+    if not snapshot.documents:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="No documents available for search."
+        )
+    
+    # Parse dates
     try:
-        if not embeddings_service.documents:
-            raise HTTPException(
-                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                detail="No documents available for search."
-            )
-        
-        # Parse dates
-        try:
-            start_date = datetime.fromisoformat(fecha_desde)
-            end_date = datetime.fromisoformat(fecha_hasta)
-        except ValueError:
-            raise HTTPException(
-                status_code=status.HTTP_400_BAD_REQUEST,
-                detail="Invalid date format. Use YYYY-MM-DD"
-            )
-        
-        results = []
-        for doc in embeddings_service.documents:
-            try:
-                doc_date = datetime.fromisoformat(doc.get('fecha', ''))
-                if start_date <= doc_date <= end_date:
-                    results.append({
-                        'tribunal': doc.get('tribunal', ''),
-                        'fecha': doc.get('fecha', ''),
-                        'materia': doc.get('materia', ''),
-                        'partes': doc.get('partes', ''),
-                        'expediente': doc.get('expediente', ''),
-                        'url': doc.get('url', ''),
-                        'excerpt': doc.get('full_text', '')[:200] + '...' if len(doc.get('full_text', '')) > 200 else doc.get('full_text', '')
-                    })
-                    
-                    if len(results) >= limit:
-                        break
-            except:
-                continue
-        
-        return {
-            'fecha_desde': fecha_desde,
-            'fecha_hasta': fecha_hasta,
-            'results': results,
-            'total_found': len(results)
-        }
-        
-    except Exception as e:
+        start_date = datetime.fromisoformat(fecha_desde)
+        end_date = datetime.fromisoformat(fecha_hasta)
+    except ValueError:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error searching by date range: {str(e)}"
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid date format. Use YYYY-MM-DD"
         )
+    
+    results = [
+        _document_hit(snapshot, idx)
+        for idx in snapshot.ids_by_date_range(start_date, end_date)[:limit]
+    ]
+    
+    return {
+        'fecha_desde': fecha_desde,
+        'fecha_hasta': fecha_hasta,
+        'results': results,
+        'total_found': len(results)
+    }
 
 @router.get("/advanced")
 async def advanced_search(
@@ -286,120 +241,95 @@ async def advanced_search(
     current_user: User = Depends(get_current_active_user)
 ):
     """Advanced search with multiple filters and similarity threshold."""
+    embeddings_service = get_embeddings_service()
+    snapshot = embeddings_service.snapshot()
+    if not snapshot.faiss_index:
+        raise HTTPException(
+            status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+            detail="Search index not available. Please wait for indexing to complete."
+        )
+    
+    # Resolve filters to candidate ids up front, so FAISS only scores
+    # matching documents instead of over-fetching and post-filtering
     try:
-        if not embeddings_service.faiss_index:
-            raise HTTPException(
-                status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
-                detail="Search index not available. Please wait for indexing to complete."
-            )
-        
-        # Perform vector search with higher limit for filtering
-        search_limit = min(limit * 3, 100)  # Get more results for filtering
-        similar_indices = embeddings_service.search_similar_documents(query, search_limit)
-        
-        # Apply filters
-        filtered_results = []
-        for idx, score in similar_indices:
-            if idx < len(embeddings_service.documents) and score >= min_similarity:
-                doc = embeddings_service.documents[idx]
-                
-                # Apply filters
-                if tribunal and tribunal.lower() not in doc.get('tribunal', '').lower():
-                    continue
-                    
-                if materia and materia.lower() not in doc.get('materia', '').lower():
-                    continue
-                
-                if fecha_desde:
-                    try:
-                        doc_date = datetime.fromisoformat(doc.get('fecha', ''))
-                        start_date = datetime.fromisoformat(fecha_desde)
-                        if doc_date < start_date:
-                            continue
-                    except:
-                        continue
-                
-                if fecha_hasta:
-                    try:
-                        doc_date = datetime.fromisoformat(doc.get('fecha', ''))
-                        end_date = datetime.fromisoformat(fecha_hasta)
-                        if doc_date > end_date:
-                            continue
-                    except:
-                        continue
-                
-                # Add to results
-                filtered_results.append({
-                    'tribunal': doc.get('tribunal', ''),
-                    'fecha': doc.get('fecha', ''),
-                    'materia': doc.get('materia', ''),
-                    'partes': doc.get('partes', ''),
-                    'expediente': doc.get('expediente', ''),
-                    'url': doc.get('url', ''),
-                    'similarity_score': float(score),
-                    'excerpt': doc.get('full_text', '')[:200] + '...' if len(doc.get('full_text', '')) > 200 else doc.get('full_text', '')
-                })
-                
-                if len(filtered_results) >= limit:
-                    break
-        
-        return {
-            'query': query,
-            'filters': {
-                'tribunal': tribunal,
-                'materia': materia,
-                'fecha_desde': fecha_desde,
-                'fecha_hasta': fecha_hasta,
-                'min_similarity': min_similarity
-            },
-            'results': filtered_results,
-            'total_found': len(filtered_results)
-        }
-        
-    except Exception as e:
+        start_date = datetime.fromisoformat(fecha_desde) if fecha_desde else None
+        end_date = datetime.fromisoformat(fecha_hasta) if fecha_hasta else None
+    except ValueError:
         raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error during advanced search: {str(e)}"
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="Invalid date format. Use YYYY-MM-DD"
+        )
+    
+    candidate_sets = []
+    if tribunal:
+        candidate_sets.append(snapshot.ids_by_tribunal(tribunal))
+    if materia:
+        candidate_sets.append(snapshot.ids_by_materia(materia))
+    if start_date or end_date:
+        candidate_sets.append(snapshot.ids_by_date_range(start_date, end_date))
+    
+    candidate_ids = None
+    for ids in candidate_sets:
+        candidate_ids = ids if candidate_ids is None else np.intersect1d(candidate_ids, ids, assume_unique=True)
+    
+    # Unfiltered queries share batched searches; filtered ones need their own ID selector
+    similar_indices = []
+    if candidate_ids is None:
+        similar_indices = await query_batcher.submit(query, min(limit, 100), snapshot)
+    elif len(candidate_ids):
+        similar_indices = await run_in_threadpool(
+            embeddings_service.search_similar_documents, query, min(limit, 100), ids=candidate_ids, snapshot=snapshot
         )
+    
+    filtered_results = []
+    for idx, score in similar_indices:
+        if idx < len(snapshot.documents) and score >= min_similarity:
+            doc = snapshot.documents[idx]
+            
+            # Add to results
+            filtered_results.append({
+                'tribunal': doc.get('tribunal', ''),
+                'fecha': doc.get('fecha', ''),
+                'materia': doc.get('materia', ''),
+                'partes': doc.get('partes', ''),
+                'expediente': doc.get('expediente', ''),
+                'url': doc.get('url', ''),
+                'similarity_score': float(score),
+                'excerpt': snapshot.columns['excerpt'][idx]
+            })
+            
+            if len(filtered_results) >= limit:
+                break
+    
+    return {
+        'query': query,
+        'filters': {
+            'tribunal': tribunal,
+            'materia': materia,
+            'fecha_desde': fecha_desde,
+            'fecha_hasta': fecha_hasta,
+            'min_similarity': min_similarity
+        },
+        'results': filtered_results,
+        'total_found': len(filtered_results)
+    }
 
 @router.get("/statistics")
-async def get_search_statistics(current_user: User = Depends(get_current_active_user)):
+def get_search_statistics(current_user: User = Depends(get_current_active_user)):
     """Get statistics about the searchable documents."""
-    try:
-        if not embeddings_service.documents:
-            return {
-                "total_documents": 0,
-                "index_status": "Not available"
-            }
-        
-        # Count documents by tribunal
-        tribunals = {}
-        materias = {}
-        years = {}
-        
-        for doc in embeddings_service.documents:
-            tribunal = doc.get('tribunal', 'Unknown')
-            tribunals[tribunal] = tribunals.get(tribunal, 0) + 1
-            
-            materia = doc.get('materia', 'Unknown')
-            materias[materia] = materias.get(materia, 0) + 1
-            
-            try:
-                year = datetime.fromisoformat(doc.get('fecha', '')).year
-                years[year] = years.get(year, 0) + 1
-            except:
-                pass
-        
+    snapshot = get_embeddings_service().snapshot()
+    if not snapshot.documents:
         return {
-            "total_documents": len(embeddings_service.documents),
-            "index_status": "Available" if embeddings_service.faiss_index else "Not available",
-            "tribunals": dict(sorted(tribunals.items(), key=lambda x: x[1], reverse=True)[:10]),
-            "materias": dict(sorted(materias.items(), key=lambda x: x[1], reverse=True)[:10]),
-            "years": dict(sorted(years.items(), key=lambda x: x[1], reverse=True)[:10])
+            "total_documents": 0,
+            "index_status": "Not available"
         }
-        
-    except Exception as e:
-        raise HTTPException(
-            status_code=status.HTTP_500_INTERNAL_SERVER_ERROR,
-            detail=f"Error getting search statistics: {str(e)}"
-        )
\ No newline at end of file
+    
+    # Histograms are precomputed whenever the index changes
+    stats = snapshot.corpus_stats
+    return {
+        "total_documents": len(snapshot.documents),
+        "index_status": "Available" if snapshot.faiss_index else "Not available",
+        "tribunals": dict(stats['tribunals'].most_common(10)),
+        "materias": dict(stats['materias'].most_common(10)),
+        "years": dict(stats['years'].most_common(10))
+    }
\ No newline at end of file
@@ -1 +1,41 @@
-# Services package for Legal AI Assistant
\ No newline at end of file
+# Services package for Legal AI Assistant
+#
+# The ML-backed services pull in torch, sentence-transformers, FAISS and the
+# Drive client when their modules are imported. Routers resolve them through
+# these cached accessors inside handlers so workers boot without loading them.
+from functools import lru_cache
+
+# Whether large preprocessing and PDF extraction batches may fork worker
+# processes. Forking the multithreaded server can copy a lock some other
+# thread (the threadpool, OpenMP, torch) held and deadlock the child, so only
+# the sync_data.py CLI turns this on; the server does that work in-process.
+_process_pools = False
+
+def enable_process_pools():
+    global _process_pools
+    _process_pools = True
+
+def process_pools_enabled() -> bool:
+    return _process_pools
+
+@lru_cache(maxsize=1)
+def get_embeddings_service():
+    from services.embeddings import embeddings_service
+    return embeddings_service
+
+@lru_cache(maxsize=1)
+def get_classifier_service():
+    from services.classifier import classifier_service
+    return classifier_service
+
+@lru_cache(maxsize=1)
+def get_document_generator():
+    from services.document_generator import document_generator
+    return document_generator
+
+@lru_cache(maxsize=1)
+def get_google_drive_service():
+    # Built here rather than at import: constructing it reads the token file
+    # and may start the OAuth flow
+    from services.google_drive import GoogleDriveService
+    return GoogleDriveService()
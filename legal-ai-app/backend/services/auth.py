@@ -1,21 +1,50 @@
 from datetime import datetime, timedelta
+from functools import lru_cache
 from typing import Optional
 from jose import JWTError, jwt
 from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
 from fastapi.security import OAuth2PasswordBearer
-from sqlalchemy.orm import Session
+from starlette.concurrency import run_in_threadpool
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
 
 from config import settings
-from models.database import get_db, User
+from models.database import get_async_db, User
 from models.schemas import TokenData
+from services.cache import cache_service
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing: Argon2id for new hashes, bcrypt kept so existing hashes
+# still verify and get upgraded on the next successful login
+pwd_context = CryptContext(
+    schemes=["argon2", "bcrypt"],
+    deprecated="auto",
+    argon2__type="ID",
+    argon2__time_cost=3,
+    argon2__memory_cost=64 * 1024,
+    argon2__parallelism=4
+)
 
 # OAuth2 scheme
 oauth2_scheme = OAuth2PasswordBearer(tokenUrl="token")
 
+# Authenticated user lookups are cached across requests
+USER_CACHE_TTL = 300
+_CACHED_USER_FIELDS = ("id", "email", "username", "full_name", "is_active", "is_superuser", "created_at")
+
+def user_cache_key(username: str) -> str:
+    """Cache key for the user resolved from a token subject."""
+    return f"user:{username}"
+
+async def invalidate_cached_user(username: str):
+    """Drop a cached user after its row changes."""
+    await cache_service.delete(user_cache_key(username))
+
+@lru_cache(maxsize=1)
+def _dummy_password_hash() -> str:
+    """Hash verified when the username doesn't exist, so both paths cost the same."""
+    return pwd_context.hash("dummy-password-for-timing-equalization")
+
 def verify_password(plain_password: str, hashed_password: str) -> bool:
     """Verify a password against its hash."""
     return pwd_context.verify(plain_password, hashed_password)
@@ -24,13 +53,26 @@ def get_password_hash(password: str) -> str:
     """Hash a password."""
     return pwd_context.hash(password)
 
-def authenticate_user(db: Session, username: str, password: str) -> Optional[User]:
+async def authenticate_user(db: AsyncSession, username: str, password: str) -> Optional[User]:
     """Authenticate a user with username and password."""
-    user = db.query(User).filter(User.username == username).first()
+    user = await db.scalar(select(User).where(User.username == username))
     if not user:
+        # Burn the same verification cost so response time doesn't reveal
+        # whether the username exists
+        await run_in_threadpool(pwd_context.verify, password, _dummy_password_hash())
         return None
-    if not verify_password(password, user.hashed_password):
+    
+    # Hash verification is CPU-bound; keep it off the event loop
+    valid, new_hash = await run_in_threadpool(
+        pwd_context.verify_and_update, password, user.hashed_password
+    )
+    if not valid:
         return None
+    
+    if new_hash:
+        user.hashed_password = new_hash
+        await db.commit()
+    
     return user
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -45,7 +87,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, settings.jwt_secret, algorithm=settings.jwt_algorithm)
     return encoded_jwt
 
-async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = Depends(get_db)) -> User:
+async def get_current_user(token: str = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)) -> User:
     """Get the current authenticated user from JWT token."""
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
@@ -62,9 +104,24 @@ async def get_current_user(token: str = Depends(oauth2_scheme), db: Session = De
     except JWTError:
         raise credentials_exception
     
-    user = db.query(User).filter(User.username == token_data.username).first()
+    cache_key = user_cache_key(token_data.username)
+    cached = await cache_service.get(cache_key)
+    if cached is not None:
+        # Detached instance: carries the columns handlers read, never the password hash
+        if cached["created_at"]:
+            cached["created_at"] = datetime.fromisoformat(cached["created_at"])
+        return User(**cached)
+    
+    result = await db.execute(select(User).where(User.username == token_data.username))
+    user = result.scalars().first()
     if user is None:
         raise credentials_exception
+    
+    await cache_service.set(
+        cache_key,
+        {field: getattr(user, field) for field in _CACHED_USER_FIELDS},
+        USER_CACHE_TTL
+    )
     return user
 
 async def get_current_active_user(current_user: User = Depends(get_current_user)) -> User:
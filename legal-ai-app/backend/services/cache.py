@@ -0,0 +1,50 @@
+import hashlib
+import orjson
+from typing import Any, Optional
+
+import redis.asyncio as aioredis
+from redis.exceptions import RedisError
+
+from config import settings
+
+class CacheService:
+    def __init__(self):
+        # redis-py connects lazily, so building the client at import is cheap
+        self.redis = aioredis.from_url(settings.redis_url, decode_responses=True)
+
+    @staticmethod
+    def make_key(prefix: str, *parts: Any) -> str:
+        """Build a cache key, hashing free-text parts to keep keys short."""
+        digest = hashlib.sha1("|".join(str(part) for part in parts).encode("utf-8")).hexdigest()
+        return f"{prefix}:{digest}"
+
+    async def get(self, key: str) -> Optional[Any]:
+        """Return the cached JSON value for key, or None on miss/unavailable Redis."""
+        try:
+            value = await self.redis.get(key)
+        except RedisError as e:
+            print(f"Cache unavailable, skipping read of {key}: {e}")
+            return None
+
+        return orjson.loads(value) if value is not None else None
+
+    async def set(self, key: str, value: Any, ttl: int) -> None:
+        """Store a JSON-serializable value under key for ttl seconds."""
+        try:
+            await self.redis.set(key, orjson.dumps(value, default=str), ex=ttl)
+        except RedisError as e:
+            print(f"Cache unavailable, skipping write of {key}: {e}")
+
+    async def delete(self, *keys: str) -> None:
+        """Invalidate the given keys."""
+        try:
+            await self.redis.delete(*keys)
+        except RedisError as e:
+            print(f"Cache unavailable, skipping invalidation of {keys}: {e}")
+
+    async def close(self) -> None:
+        """Close the underlying connection pool."""
+        await self.redis.aclose()
+
+# Global instance
+cache_service = CacheService()
@@ -1,22 +1,43 @@
 import pickle
 import os
+import hashlib
+import threading
+from collections import OrderedDict
 import numpy as np
 from typing import List, Dict, Any, Tuple
-from sklearn.ensemble import RandomForestClassifier
+from sklearn.ensemble import HistGradientBoostingClassifier
+from sklearn.inspection import permutation_importance
 from sklearn.model_selection import train_test_split
 from sklearn.metrics import classification_report, accuracy_score
 from sklearn.preprocessing import LabelEncoder
 import joblib
+import onnxruntime as ort
+from skl2onnx import convert_sklearn
+from skl2onnx.common.data_types import FloatTensorType
 
 from config import settings
-from services.embeddings import embeddings_service
+from services import get_embeddings_service
+
+# Recent explain_prediction results kept in memory, keyed by a digest of the input
+EXPLAIN_CACHE_SIZE = 4096
+
+# Features reported as feature_importance, and shuffles per feature when measuring them
+TOP_FEATURES = 10
+PERMUTATION_REPEATS = 5
 
 class LegalDocumentClassifier:
     def __init__(self):
         self.classifier = None
         self.label_encoder = LabelEncoder()
         self.feature_names = []
+        # Top features by permutation importance on the held-out split, from training
+        self.feature_importance: Dict[str, float] = {}
         self.is_trained = False
+        # Compiled ONNX Runtime session for the classifier; None falls back to sklearn
+        self._ort = None
+        # LRU of explain_prediction results; the lock covers threadpool callers
+        self._explain_cache: "OrderedDict[bytes, Dict[str, Any]]" = OrderedDict()
+        self._explain_cache_lock = threading.Lock()
         
         # Load existing classifier if it exists
         self._load_classifier()
@@ -25,13 +46,24 @@ class LegalDocumentClassifier:
         """Load existing trained classifier if it exists."""
         try:
             if os.path.exists(settings.classifier_model_path):
-                model_data = joblib.load(settings.classifier_model_path)
+                # Tree arrays are memory-mapped, so workers share one copy
+                model_data = joblib.load(settings.classifier_model_path, mmap_mode='r')
                 self.classifier = model_data['classifier']
                 self.label_encoder = model_data['label_encoder']
                 self.feature_names = model_data['feature_names']
+                self.feature_importance = model_data.get('feature_importance', {})
                 self.is_trained = True
                 print(f"Loaded existing classifier from {settings.classifier_model_path}")
                 
+                # Re-export when the ONNX copy is missing or older than the pickle
+                if (
+                    not os.path.exists(settings.classifier_onnx_path)
+                    or os.path.getmtime(settings.classifier_onnx_path) < os.path.getmtime(settings.classifier_model_path)
+                ):
+                    self._export_onnx()
+                else:
+                    self._load_onnx()
+                
         except Exception as e:
             print(f"Error loading existing classifier: {e}")
             print("Will train new classifier")
@@ -39,6 +71,7 @@ class LegalDocumentClassifier:
     def prepare_training_data(self, documents: List[Dict[str, Any]]) -> Tuple[np.ndarray, np.ndarray]:
         """Prepare training data for the classifier."""
         print("Preparing training data...")
+        embeddings_service = get_embeddings_service()
         
         # Extract features using embeddings service
         features = embeddings_service.extract_features(documents)
@@ -73,12 +106,15 @@ class LegalDocumentClassifier:
             features, outcomes, test_size=test_size, random_state=42, stratify=outcomes
         )
         
-        # Initialize classifier
-        self.classifier = RandomForestClassifier(
-            n_estimators=100,
-            max_depth=10,
-            random_state=42,
-            n_jobs=-1
+        # Initialize classifier (histogram-binned boosted trees stay small and
+        # fast to evaluate; early stopping only kicks in past 10k samples,
+        # so tiny training sets still fit)
+        self.classifier = HistGradientBoostingClassifier(
+            max_iter=200,
+            max_depth=8,
+            early_stopping='auto',
+            validation_fraction=0.1,
+            random_state=42
         )
         
         # Train classifier
@@ -93,9 +129,12 @@ class LegalDocumentClassifier:
         print("\nClassification Report:")
         print(classification_report(y_test, y_pred, target_names=self.label_encoder.classes_))
         
+        self.feature_importance = self._compute_feature_importance(X_test, y_test)
+        
         # Save classifier
         self._save_classifier()
         self.is_trained = True
+        self.clear_explain_cache()
         
         return True
     
@@ -107,14 +146,56 @@ class LegalDocumentClassifier:
             model_data = {
                 'classifier': self.classifier,
                 'label_encoder': self.label_encoder,
-                'feature_names': self.feature_names
+                'feature_names': self.feature_names,
+                'feature_importance': self.feature_importance
             }
             
-            joblib.dump(model_data, settings.classifier_model_path)
+            # Replace atomically; other workers may still map the old file
+            tmp_path = f"{settings.classifier_model_path}.tmp"
+            joblib.dump(model_data, tmp_path)
+            os.replace(tmp_path, settings.classifier_model_path)
             print(f"Classifier saved to {settings.classifier_model_path}")
             
         except Exception as e:
             print(f"Error saving classifier: {e}")
+            return
+        
+        self._export_onnx()
+    
+    def _export_onnx(self):
+        """Compile the classifier to ONNX and load it for inference."""
+        try:
+            onnx_model = convert_sklearn(
+                self.classifier,
+                initial_types=[('input', FloatTensorType([None, self.classifier.n_features_in_]))],
+                # Plain probability tensor instead of a list of per-class dicts
+                options={id(self.classifier): {'zipmap': False}}
+            )
+            with open(settings.classifier_onnx_path, 'wb') as f:
+                f.write(onnx_model.SerializeToString())
+            print(f"Classifier exported to {settings.classifier_onnx_path}")
+            
+        except Exception as e:
+            print(f"Error exporting classifier to ONNX, using scikit-learn for inference: {e}")
+            self._ort = None
+            return
+        
+        self._load_onnx()
+    
+    def _load_onnx(self):
+        """Open an ONNX Runtime session over the exported classifier."""
+        try:
+            self._ort = ort.InferenceSession(settings.classifier_onnx_path, providers=['CPUExecutionProvider'])
+        except Exception as e:
+            print(f"Error loading ONNX classifier, using scikit-learn for inference: {e}")
+            self._ort = None
+    
+    def _predict_proba(self, features: np.ndarray) -> np.ndarray:
+        """Class probabilities, columns ordered as self.classifier.classes_."""
+        if self._ort is not None:
+            # Outputs are [labels, probabilities]
+            return self._ort.run(None, {'input': features.astype(np.float32)})[1]
+        return self.classifier.predict_proba(features)
     
     def predict_outcome(self, case_description: str, case_type: str = None) -> Dict[str, Any]:
         """Predict the outcome of a legal case."""
@@ -128,18 +209,17 @@ class LegalDocumentClassifier:
             'full_text': case_description
         }
         
-        features = embeddings_service.extract_features([case_doc])
+        features = get_embeddings_service().extract_features([case_doc])
         
-        # Make prediction
-        prediction_proba = self.classifier.predict_proba(features)[0]
-        predicted_class_idx = self.classifier.predict(features)[0]
+        # Make prediction; predict() is just the argmax of the probabilities,
+        # so one pass over the trees gives both
+        prediction_proba = self._predict_proba(features)[0]
+        best = int(prediction_proba.argmax())
+        predicted_class_idx = self.classifier.classes_[best]
         
         # Get predicted outcome and confidence
         predicted_outcome = self.label_encoder.classes_[predicted_class_idx]
-        confidence_score = prediction_proba[predicted_class_idx]
-        
-        # Get feature importance for explanation
-        feature_importance = self._get_feature_importance(features[0])
+        confidence_score = prediction_proba[best]
         
         return {
             'predicted_outcome': predicted_outcome,
@@ -148,54 +228,111 @@ class LegalDocumentClassifier:
                 outcome: float(prob) 
                 for outcome, prob in zip(self.label_encoder.classes_, prediction_proba)
             },
-            'feature_importance': feature_importance
+            # Model-wide, measured at training time
+            'feature_importance': self.feature_importance
         }
     
-    def _get_feature_importance(self, features: np.ndarray) -> Dict[str, float]:
-        """Get feature importance for explanation."""
-        if hasattr(self.classifier, 'feature_importances_'):
-            importance_dict = {}
-            for i, importance in enumerate(self.classifier.feature_importances_):
-                feature_name = f"feature_{i}"
-                importance_dict[feature_name] = float(importance)
-            
-            # Sort by importance
-            sorted_importance = dict(
-                sorted(importance_dict.items(), key=lambda x: x[1], reverse=True)[:10]
+    def _compute_feature_importance(self, X_test: np.ndarray, y_test: np.ndarray) -> Dict[str, float]:
+        """Top features by permutation importance (mean accuracy drop when shuffled).
+        
+        Boosted histogram trees expose no feature_importances_, so this is
+        measured once per fit on the held-out split rather than per prediction.
+        """
+        try:
+            result = permutation_importance(
+                self.classifier, X_test, y_test,
+                n_repeats=PERMUTATION_REPEATS, random_state=42
             )
-            return sorted_importance
+        except Exception as e:
+            print(f"Error computing feature importance: {e}")
+            return {}
         
-        return {}
+        top = np.argsort(result.importances_mean)[::-1][:TOP_FEATURES]
+        return {f"feature_{i}": float(result.importances_mean[i]) for i in top}
     
     def get_similar_cases(self, case_description: str, k: int = 5) -> List[Dict[str, Any]]:
         """Get similar cases using embeddings."""
+        embeddings_service = get_embeddings_service()
         try:
             # Search for similar documents
-            similar_indices = embeddings_service.search_similar_documents(case_description, k)
-            
-            similar_cases = []
-            for idx, score in similar_indices:
-                if idx < len(embeddings_service.documents):
-                    doc = embeddings_service.documents[idx]
-                    similar_cases.append({
-                        'tribunal': doc.get('tribunal', ''),
-                        'fecha': doc.get('fecha', ''),
-                        'materia': doc.get('materia', ''),
-                        'partes': doc.get('partes', ''),
-                        'expediente': doc.get('expediente', ''),
-                        'url': doc.get('url', ''),
-                        'similarity_score': float(score),
-                        'outcome': embeddings_service.extract_outcome_from_text(doc.get('full_text', ''))
-                    })
-            
-            return similar_cases
+            snapshot = embeddings_service.snapshot()
+            similar_indices = embeddings_service.search_similar_documents(case_description, k, snapshot=snapshot)
+            return self._similar_cases(similar_indices, snapshot)
             
         except Exception as e:
             print(f"Error getting similar cases: {e}")
             return []
     
+    def get_similar_cases_batch(self, case_descriptions: List[str], k: int = 5) -> List[List[Dict[str, Any]]]:
+        """get_similar_cases for many descriptions with one encode and one FAISS search."""
+        if not case_descriptions:
+            return []
+        
+        embeddings_service = get_embeddings_service()
+        try:
+            snapshot = embeddings_service.snapshot()
+            query_embeddings = embeddings_service.embed_queries(case_descriptions)
+            return [
+                self._similar_cases(similar_indices, snapshot)
+                for similar_indices in embeddings_service.search_embeddings(query_embeddings, k, snapshot)
+            ]
+            
+        except Exception as e:
+            print(f"Error getting similar cases: {e}")
+            return [[] for _ in case_descriptions]
+    
+    def _similar_cases(self, similar_indices: List[Tuple[int, float]], snapshot) -> List[Dict[str, Any]]:
+        """Citation details for (index, score) search hits in snapshot."""
+        embeddings_service = get_embeddings_service()
+        similar_cases = []
+        for idx, score in similar_indices:
+            if idx < len(snapshot.documents):
+                doc = snapshot.documents[idx]
+                similar_cases.append({
+                    'tribunal': doc.get('tribunal', ''),
+                    'fecha': doc.get('fecha', ''),
+                    'materia': doc.get('materia', ''),
+                    'partes': doc.get('partes', ''),
+                    'expediente': doc.get('expediente', ''),
+                    'url': doc.get('url', ''),
+                    'similarity_score': float(score),
+                    'outcome': embeddings_service.extract_outcome_from_text(doc.get('full_text', ''))
+                })
+        
+        return similar_cases
+    
+    def clear_explain_cache(self):
+        """Forget memoized explanations, e.g. after retraining."""
+        with self._explain_cache_lock:
+            self._explain_cache.clear()
+    
     def explain_prediction(self, case_description: str, case_type: str = None) -> Dict[str, Any]:
-        """Provide explanation for a prediction."""
+        """Provide explanation for a prediction.
+        
+        Results are memoized per case text and type. The corpus size is
+        part of the key, so newly indexed documents show up in the similar
+        cases. Callers must treat the returned dict as read-only.
+        """
+        key = hashlib.blake2b(
+            f"{len(get_embeddings_service().documents)}|{case_type}|{case_description}".encode("utf-8"),
+            digest_size=16
+        ).digest()
+        with self._explain_cache_lock:
+            cached = self._explain_cache.get(key)
+            if cached is not None:
+                self._explain_cache.move_to_end(key)
+                return cached
+        
+        result = self._explain_prediction(case_description, case_type)
+        
+        with self._explain_cache_lock:
+            self._explain_cache[key] = result
+            if len(self._explain_cache) > EXPLAIN_CACHE_SIZE:
+                self._explain_cache.popitem(last=False)
+        
+        return result
+    
+    def _explain_prediction(self, case_description: str, case_type: str = None) -> Dict[str, Any]:
         # Get prediction
         prediction = self.predict_outcome(case_description, case_type)
         
@@ -246,25 +383,24 @@ class LegalDocumentClassifier:
         # Prepare test data
         features, outcomes = self.prepare_training_data(test_documents)
         
-        # Make predictions
-        predictions = self.classifier.predict(features)
-        prediction_probas = self.classifier.predict_proba(features)
+        # One pass over the trees; predictions are the per-row argmax
+        prediction_probas = self._predict_proba(features)
+        best = prediction_probas.argmax(axis=1)
+        predictions = self.classifier.classes_[best]
         
         # Calculate metrics
         accuracy = accuracy_score(outcomes, predictions)
         
-        # Calculate confidence scores
-        confidence_scores = []
-        for i, pred in enumerate(predictions):
-            confidence_scores.append(prediction_probas[i][pred])
-        
-        avg_confidence = np.mean(confidence_scores)
+        # Confidence is the probability of the predicted class
+        confidence_scores = prediction_probas[np.arange(len(best)), best]
+        avg_confidence = confidence_scores.mean()
         
+        class_counts = np.bincount(outcomes, minlength=len(self.label_encoder.classes_))
         return {
             'accuracy': float(accuracy),
             'average_confidence': float(avg_confidence),
             'total_samples': len(test_documents),
-            'class_distribution': dict(zip(self.label_encoder.classes_, np.bincount(outcomes)))
+            'class_distribution': dict(zip(self.label_encoder.classes_, class_counts.tolist()))
         }
 
 # Global instance
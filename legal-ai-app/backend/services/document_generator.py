@@ -1,18 +1,71 @@
+import asyncio
+import hashlib
 import json
 import re
-from typing import List, Dict, Any, Optional
+import threading
+from collections import OrderedDict
+from typing import List, Dict, Any, Optional, AsyncIterator
 from datetime import datetime
 import openai
 import anthropic
+from starlette.concurrency import run_in_threadpool
+from tenacity import retry, retry_if_exception_type, stop_after_attempt, wait_exponential_jitter
 from config import settings
-from services.embeddings import embeddings_service
-from services.classifier import classifier_service
+from services import get_classifier_service
+
+# OpenAI Batch API jobs finish within this window at half the per-token price
+BULK_COMPLETION_WINDOW = "24h"
+
+# Rate limits and dropped connections are retried with jittered backoff;
+# the async clients are built with max_retries=0 so this is the only retry layer
+llm_retry = retry(
+    retry=retry_if_exception_type((
+        openai.RateLimitError, openai.APIConnectionError,
+        anthropic.RateLimitError, anthropic.APIConnectionError
+    )),
+    wait=wait_exponential_jitter(initial=1, max=30),
+    stop=stop_after_attempt(5),
+    reraise=True
+)
+
+# Common template sections, fused into one alternation so detection is a single scan
+SECTION_PATTERNS = {
+    'header': r'(?:ENCABEZADO|HEADER|TÍTULO|TITLE)',
+    'introduction': r'(?:INTRODUCCIÓN|INTRODUCCION|INTRO)',
+    'facts': r'(?:HECHOS|FACTS|ANTECEDENTES)',
+    'legal_basis': r'(?:FUNDAMENTOS|LEGAL_BASIS|FUNDAMENTACIÓN)',
+    'conclusion': r'(?:CONCLUSIÓN|CONCLUSION|CONCLUSIONES)',
+    'signature': r'(?:FIRMA|SIGNATURE|SUSCRITO)'
+}
+SECTION_RE = re.compile(
+    '|'.join(f'(?P<{name}>{pattern})' for name, pattern in SECTION_PATTERNS.items()),
+    re.IGNORECASE
+)
+PLACEHOLDER_RE = re.compile(r'\{\{([^}]+)\}\}')
+HTML_RE = re.compile(r'<[^>]+>')
+# Basic summaries scan sentences lazily and stop at the fifth relevant one
+SENTENCE_RE = re.compile(r'[^.!?]+')
+LEGAL_KEYWORD_RE = re.compile(
+    '|'.join(['tribunal', 'juez', 'sentencia', 'fallo', 'recurso', 'apelación', 'materia', 'partes']),
+    re.IGNORECASE
+)
+BASIC_SUMMARY_SENTENCES = 5
+
+# Characters of a document that are summarized; the summary cache keys on exactly these
+SUMMARY_INPUT_CHARS = 3000
 
 class LegalDocumentGenerator:
     def __init__(self):
         self.templates = {}
         self.openai_client = None
         self.anthropic_client = None
+        self.async_openai_client = None
+        self.async_anthropic_client = None
+        # Caps concurrent interactive LLM calls so bursts queue here instead of hitting 429s
+        self._llm_semaphore = asyncio.Semaphore(settings.llm_max_concurrency)
+        # LRU of summaries by digest of (user, summary type, summarized text)
+        self._summary_cache: "OrderedDict[bytes, str]" = OrderedDict()
+        self._summary_cache_lock = threading.Lock()
         
         # Initialize AI clients
         self._initialize_ai_clients()
@@ -22,10 +75,12 @@ class LegalDocumentGenerator:
         if settings.openai_api_key:
             openai.api_key = settings.openai_api_key
             self.openai_client = openai.OpenAI(api_key=settings.openai_api_key)
+            self.async_openai_client = openai.AsyncOpenAI(api_key=settings.openai_api_key, max_retries=0)
             print("OpenAI client initialized")
         
         if settings.anthropic_api_key:
             self.anthropic_client = anthropic.Anthropic(api_key=settings.anthropic_api_key)
+            self.async_anthropic_client = anthropic.AsyncAnthropic(api_key=settings.anthropic_api_key, max_retries=0)
             print("Anthropic client initialized")
         
         if not self.openai_client and not self.anthropic_client:
@@ -50,27 +105,20 @@ class LegalDocumentGenerator:
             'formatting': {}
         }
         
-        # Identify common sections
-        section_patterns = {
-            'header': r'(?:ENCABEZADO|HEADER|TÍTULO|TITLE)',
-            'introduction': r'(?:INTRODUCCIÓN|INTRODUCCION|INTRO)',
-            'facts': r'(?:HECHOS|FACTS|ANTECEDENTES)',
-            'legal_basis': r'(?:FUNDAMENTOS|LEGAL_BASIS|FUNDAMENTACIÓN)',
-            'conclusion': r'(?:CONCLUSIÓN|CONCLUSION|CONCLUSIONES)',
-            'signature': r'(?:FIRMA|SIGNATURE|SUSCRITO)'
-        }
-        
-        for section_name, pattern in section_patterns.items():
-            if re.search(pattern, template_content, re.IGNORECASE):
-                structure['sections'].append(section_name)
+        # Identify common sections, stopping once every section has been seen
+        found = set()
+        for match in SECTION_RE.finditer(template_content):
+            found.add(match.lastgroup)
+            if len(found) == len(SECTION_PATTERNS):
+                break
+        structure['sections'] = [name for name in SECTION_PATTERNS if name in found]
         
         # Find placeholders
-        placeholder_pattern = r'\{\{([^}]+)\}\}'
-        placeholders = re.findall(placeholder_pattern, template_content)
+        placeholders = PLACEHOLDER_RE.findall(template_content)
         structure['placeholders'] = list(set(placeholders))
         
         # Detect formatting
-        if re.search(r'<[^>]+>', template_content):
+        if HTML_RE.search(template_content):
             structure['formatting']['html'] = True
         
         return structure
@@ -85,7 +133,7 @@ class LegalDocumentGenerator:
         
         # Get similar cases for citations
         case_description = case_details.get('description', '')
-        similar_cases = classifier_service.get_similar_cases(case_description, k=3)
+        similar_cases = get_classifier_service().get_similar_cases(case_description, k=3)
         
         # Generate document content
         generated_content = self._fill_template(template, case_details, similar_cases)
@@ -104,35 +152,72 @@ class LegalDocumentGenerator:
             'generated_at': datetime.utcnow().isoformat()
         }
     
+    async def generate_document_async(self, template_name: str, case_details: Dict[str, Any],
+                                      case_id: int = None, stream: bool = False) -> Dict[str, Any]:
+        """Generate a legal document without blocking the event loop.
+        
+        Same result as generate_document; the similar-case search runs on the
+        threadpool and the AI enhancement is awaited under the LLM semaphore.
+        With stream=True, 'generated_document' is an async iterator of text
+        chunks yielded as the model produces them.
+        """
+        if template_name not in self.templates:
+            raise ValueError(f"Template '{template_name}' not found")
+        
+        template = self.templates[template_name]
+        
+        # Get similar cases for citations
+        case_description = case_details.get('description', '')
+        similar_cases = await run_in_threadpool(get_classifier_service().get_similar_cases, case_description, 3)
+        
+        # Generate document content
+        generated_content = self._fill_template(template, case_details, similar_cases)
+        
+        # Enhance with AI if available
+        if stream:
+            enhanced_content = self._enhance_with_ai_stream(generated_content, case_details, similar_cases)
+        elif self.async_openai_client or self.async_anthropic_client:
+            enhanced_content = await self._enhance_with_ai_async(generated_content, case_details, similar_cases)
+        else:
+            enhanced_content = generated_content
+        
+        return {
+            'generated_document': enhanced_content,
+            'template_used': template_name,
+            'citations': [case['expediente'] for case in similar_cases],
+            'similar_cases': similar_cases,
+            'generated_at': datetime.utcnow().isoformat()
+        }
+    
     def _fill_template(self, template: Dict[str, Any], case_details: Dict[str, Any], 
                       similar_cases: List[Dict[str, Any]]) -> str:
         """Fill template with case details."""
-        content = template['content']
+        now = datetime.now()
         
         # Replace basic placeholders
         replacements = {
-            '{{FECHA}}': datetime.now().strftime('%d/%m/%Y'),
-            '{{FECHA_ACTUAL}}': datetime.now().strftime('%d de %B de %Y'),
-            '{{CASO_NUMERO}}': case_details.get('case_number', ''),
-            '{{TITULO_CASO}}': case_details.get('title', ''),
-            '{{DESCRIPCION_CASO}}': case_details.get('description', ''),
-            '{{TIPO_CASO}}': case_details.get('case_type', ''),
-            '{{PARTES}}': case_details.get('parties', ''),
-            '{{TRIBUNAL}}': case_details.get('tribunal', ''),
-            '{{MATERIA}}': case_details.get('matter', ''),
-            '{{ABOGADO}}': case_details.get('lawyer', ''),
-            '{{CLIENTE}}': case_details.get('client', '')
+            'FECHA': now.strftime('%d/%m/%Y'),
+            'FECHA_ACTUAL': now.strftime('%d de %B de %Y'),
+            'CASO_NUMERO': case_details.get('case_number', ''),
+            'TITULO_CASO': case_details.get('title', ''),
+            'DESCRIPCION_CASO': case_details.get('description', ''),
+            'TIPO_CASO': case_details.get('case_type', ''),
+            'PARTES': case_details.get('parties', ''),
+            'TRIBUNAL': case_details.get('tribunal', ''),
+            'MATERIA': case_details.get('matter', ''),
+            'ABOGADO': case_details.get('lawyer', ''),
+            'CLIENTE': case_details.get('client', '')
         }
         
-        for placeholder, value in replacements.items():
-            content = content.replace(placeholder, str(value))
-        
         # Add citations section if similar cases exist
         if similar_cases:
-            citations_text = self._format_citations(similar_cases)
-            content = content.replace('{{CITACIONES}}', citations_text)
+            replacements['CITACIONES'] = self._format_citations(similar_cases)
         
-        return content
+        # One pass over the template; unknown placeholders are left as they are
+        return PLACEHOLDER_RE.sub(
+            lambda match: str(replacements.get(match.group(1), match.group(0))),
+            template['content']
+        )
     
     def _format_citations(self, similar_cases: List[Dict[str, Any]]) -> str:
         """Format similar cases as legal citations."""
@@ -148,18 +233,7 @@ class LegalDocumentGenerator:
                          similar_cases: List[Dict[str, Any]]) -> str:
         """Enhance document content using AI."""
         try:
-            # Prepare context for AI
-            context = f"""
-            Tipo de documento: {case_details.get('document_type', '')}
-            Descripción del caso: {case_details.get('description', '')}
-            Tipo de caso: {case_details.get('case_type', '')}
-            
-            Casos similares para referencia:
-            {json.dumps(similar_cases, indent=2, default=str)}
-            
-            Documento base:
-            {base_content}
-            """
+            context = self._enhancement_context(base_content, case_details, similar_cases)
             
             # Try OpenAI first, then Anthropic
             if self.openai_client:
@@ -175,10 +249,96 @@ class LegalDocumentGenerator:
             print(f"Error enhancing document with AI: {e}")
             return base_content
     
-    def _enhance_with_openai(self, context: str, case_details: Dict[str, Any]) -> str:
-        """Enhance document using OpenAI."""
+    async def _enhance_with_ai_async(self, base_content: str, case_details: Dict[str, Any],
+                                     similar_cases: List[Dict[str, Any]]) -> str:
+        """Async counterpart of _enhance_with_ai; falls back to the base content on failure."""
         try:
-            prompt = f"""
+            context = self._enhancement_context(base_content, case_details, similar_cases)
+            
+            async with self._llm_semaphore:
+                if self.async_openai_client:
+                    return await self._enhance_with_openai_async(context)
+                return await self._enhance_with_anthropic_async(context)
+            
+        except Exception as e:
+            print(f"Error enhancing document with AI: {e}")
+            return base_content
+    
+    async def _enhance_with_ai_stream(self, base_content: str, case_details: Dict[str, Any],
+                                      similar_cases: List[Dict[str, Any]]) -> AsyncIterator[str]:
+        """Yield the enhanced document as it streams in.
+        
+        Falls back to the base content if the model fails before producing
+        anything; a failure mid-stream ends the stream where it stopped.
+        """
+        if not (self.async_openai_client or self.async_anthropic_client):
+            yield base_content
+            return
+        
+        produced = False
+        try:
+            context = self._enhancement_context(base_content, case_details, similar_cases)
+            
+            async with self._llm_semaphore:
+                if self.async_openai_client:
+                    response = await self.async_openai_client.chat.completions.create(
+                        **self._openai_enhancement_body(context), stream=True
+                    )
+                    async for chunk in response:
+                        if chunk.choices and chunk.choices[0].delta.content:
+                            produced = True
+                            yield chunk.choices[0].delta.content
+                else:
+                    response = await self.async_anthropic_client.messages.create(
+                        **self._anthropic_enhancement_body(context), stream=True
+                    )
+                    async for event in response:
+                        if event.type == "content_block_delta" and event.delta.text:
+                            produced = True
+                            yield event.delta.text
+            
+        except Exception as e:
+            print(f"Error streaming AI enhancement: {e}")
+            if not produced:
+                yield base_content
+    
+    @llm_retry
+    async def _enhance_with_openai_async(self, context: str) -> str:
+        """Enhance document using the async OpenAI client."""
+        response = await self.async_openai_client.chat.completions.create(**self._openai_enhancement_body(context))
+        return response.choices[0].message.content.strip()
+    
+    @llm_retry
+    async def _enhance_with_anthropic_async(self, context: str) -> str:
+        """Enhance document using the async Anthropic client."""
+        response = await self.async_anthropic_client.messages.create(**self._anthropic_enhancement_body(context))
+        return response.content[0].text.strip()
+    
+    def _enhancement_context(self, base_content: str, case_details: Dict[str, Any],
+                             similar_cases: List[Dict[str, Any]]) -> str:
+        """Prepare context for AI."""
+        return f"""
+            Tipo de documento: {case_details.get('document_type', '')}
+            Descripción del caso: {case_details.get('description', '')}
+            Tipo de caso: {case_details.get('case_type', '')}
+            
+            Casos similares para referencia (expediente|tribunal|fecha|materia|resultado):
+            {self._format_reference_cases(similar_cases)}
+            
+            Documento base:
+            {base_content}
+            """
+    
+    def _format_reference_cases(self, similar_cases: List[Dict[str, Any]]) -> str:
+        """One terse line per similar case; indented JSON cost several times the tokens."""
+        return "\n".join(
+            "|".join(str(case.get(field, '')) for field in ('expediente', 'tribunal', 'fecha', 'materia', 'outcome'))
+            for case in similar_cases
+        )
+    
+    def _enhancement_prompt(self, context: str) -> str:
+        """Instructions wrapped around the enhancement context."""
+        return f"""
             Eres un abogado experto. Mejora el siguiente documento legal basándote en el contexto proporcionado.
             
             Contexto:
@@ -193,16 +353,34 @@ class LegalDocumentGenerator:
             
             Documento mejorado:
             """
-            
-            response = self.openai_client.chat.completions.create(
-                model="gpt-4",
-                messages=[
-                    {"role": "system", "content": "Eres un abogado experto especializado en redacción de documentos legales."},
-                    {"role": "user", "content": prompt}
-                ],
-                max_tokens=2000,
-                temperature=0.3
-            )
+    
+    def _openai_enhancement_body(self, context: str) -> Dict[str, Any]:
+        """Chat completion parameters, shared by direct and batched requests."""
+        return {
+            "model": settings.openai_enhance_model,
+            "messages": [
+                {"role": "system", "content": "Eres un abogado experto especializado en redacción de documentos legales."},
+                {"role": "user", "content": self._enhancement_prompt(context)}
+            ],
+            "max_tokens": 2000,
+            "temperature": 0.3
+        }
+    
+    def _anthropic_enhancement_body(self, context: str) -> Dict[str, Any]:
+        """Messages API parameters, shared by the sync and async clients."""
+        return {
+            "model": "claude-3-sonnet-20240229",
+            "max_tokens": 2000,
+            "temperature": 0.3,
+            "messages": [
+                {"role": "user", "content": self._enhancement_prompt(context)}
+            ]
+        }
+    
+    def _enhance_with_openai(self, context: str, case_details: Dict[str, Any]) -> str:
+        """Enhance document using OpenAI."""
+        try:
+            response = self.openai_client.chat.completions.create(**self._openai_enhancement_body(context))
             
             return response.choices[0].message.content.strip()
             
@@ -213,30 +391,7 @@ class LegalDocumentGenerator:
     def _enhance_with_anthropic(self, context: str, case_details: Dict[str, Any]) -> str:
         """Enhance document using Anthropic Claude."""
         try:
-            prompt = f"""
-            Eres un abogado experto. Mejora el siguiente documento legal basándote en el contexto proporcionado.
-            
-            Contexto:
-            {context}
-            
-            Instrucciones:
-            1. Mantén la estructura legal del documento
-            2. Mejora la redacción y claridad
-            3. Incorpora referencias a los casos similares cuando sea apropiado
-            4. Asegúrate de que el documento sea profesional y técnicamente correcto
-            5. Mantén el formato original
-            
-            Documento mejorado:
-            """
-            
-            response = self.anthropic_client.messages.create(
-                model="claude-3-sonnet-20240229",
-                max_tokens=2000,
-                temperature=0.3,
-                messages=[
-                    {"role": "user", "content": prompt}
-                ]
-            )
+            response = self.anthropic_client.messages.create(**self._anthropic_enhancement_body(context))
             
             return response.content[0].text.strip()
             
@@ -244,8 +399,94 @@ class LegalDocumentGenerator:
             print(f"Error with Anthropic enhancement: {e}")
             return context.split("Documento base:")[-1].strip()
     
-    def generate_summary(self, document_content: str, summary_type: str = "technical") -> str:
-        """Generate a summary of a legal document."""
+    def submit_bulk_generation(self, jobs: List[Dict[str, Any]], owner: str) -> Dict[str, Any]:
+        """Queue AI enhancement of many documents as one OpenAI batch.
+        
+        Each job has 'custom_id', 'template_name' and 'case_details'. Templates
+        are filled now; the enhanced text is fetched later with
+        collect_bulk_generation. Latency-sensitive single documents should
+        keep using generate_document.
+        """
+        if not self.openai_client:
+            raise ValueError("Bulk generation requires an OpenAI API key")
+        
+        for job in jobs:
+            if job['template_name'] not in self.templates:
+                raise ValueError(f"Template '{job['template_name']}' not found")
+        
+        # Neighbours for every job come from one batched encode and FAISS search
+        similar_cases_per_job = get_classifier_service().get_similar_cases_batch(
+            [job['case_details'].get('description', '') for job in jobs], k=3
+        )
+        
+        lines = []
+        documents = {}
+        for job, similar_cases in zip(jobs, similar_cases_per_job):
+            template_name = job['template_name']
+            case_details = job['case_details']
+            base_content = self._fill_template(self.templates[template_name], case_details, similar_cases)
+            context = self._enhancement_context(base_content, case_details, similar_cases)
+            
+            lines.append(json.dumps({
+                "custom_id": job['custom_id'],
+                "method": "POST",
+                "url": "/v1/chat/completions",
+                "body": self._openai_enhancement_body(context)
+            }, default=str))
+            documents[job['custom_id']] = {
+                'template_used': template_name,
+                'citations': [case['expediente'] for case in similar_cases]
+            }
+        
+        batch_input = self.openai_client.files.create(
+            file=("bulk_generation.jsonl", "\n".join(lines).encode("utf-8")),
+            purpose="batch"
+        )
+        batch = self.openai_client.batches.create(
+            input_file_id=batch_input.id,
+            endpoint="/v1/chat/completions",
+            completion_window=BULK_COMPLETION_WINDOW,
+            metadata={"owner": owner}
+        )
+        print(f"Submitted bulk generation batch {batch.id} with {len(lines)} documents")
+        
+        return {'batch_id': batch.id, 'status': batch.status, 'documents': documents}
+    
+    def collect_bulk_generation(self, batch_id: str, owner: str) -> Dict[str, Any]:
+        """Status of a bulk batch and, once completed, its documents by custom_id.
+        
+        Requests that failed inside the batch map to None.
+        """
+        if not self.openai_client:
+            raise ValueError("Bulk generation requires an OpenAI API key")
+        
+        batch = self.openai_client.batches.retrieve(batch_id)
+        if (batch.metadata or {}).get("owner") != owner:
+            raise LookupError(f"Batch '{batch_id}' not found")
+        
+        if batch.status != "completed":
+            return {'batch_id': batch_id, 'status': batch.status, 'documents': {}}
+        
+        documents = {}
+        output = self.openai_client.files.content(batch.output_file_id).text if batch.output_file_id else ""
+        for line in output.splitlines():
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            response = result.get('response') or {}
+            if response.get('status_code') == 200:
+                documents[result['custom_id']] = response['body']['choices'][0]['message']['content'].strip()
+            else:
+                documents[result['custom_id']] = None
+        
+        return {'batch_id': batch_id, 'status': batch.status, 'documents': documents}
+    
+    def generate_summary(self, document_content: str, summary_type: str = "technical", user_id: Optional[int] = None) -> str:
+        """Generate a summary of a legal document.
+        
+        Repeat requests for the same text by the same user reuse the stored
+        summary; it is never served for another user's or a merely similar text.
+        """
         if not (self.openai_client or self.anthropic_client):
             return self._generate_basic_summary(document_content, summary_type)
         
@@ -259,54 +500,74 @@ class LegalDocumentGenerator:
             {instruction}
             
             Documento:
-            {document_content[:3000]}  # Limit content length
+            {document_content[:SUMMARY_INPUT_CHARS]}  # Limit content length
             
             Resumen:
             """
             
-            if self.openai_client:
-                response = self.openai_client.chat.completions.create(
-                    model="gpt-4",
-                    messages=[
-                        {"role": "system", "content": "Eres un experto en análisis legal y comunicación jurídica."},
-                        {"role": "user", "content": prompt}
-                    ],
-                    max_tokens=500,
-                    temperature=0.3
-                )
-                return response.choices[0].message.content.strip()
+            key = hashlib.sha256(
+                f"{user_id}\0{summary_type}\0{document_content[:SUMMARY_INPUT_CHARS]}".encode('utf-8')
+            ).digest()
+            with self._summary_cache_lock:
+                cached_summary = self._summary_cache.get(key)
+                if cached_summary is not None:
+                    self._summary_cache.move_to_end(key)
+                    return cached_summary
             
-            elif self.anthropic_client:
-                response = self.anthropic_client.messages.create(
-                    model="claude-3-sonnet-20240229",
-                    max_tokens=500,
-                    temperature=0.3,
-                    messages=[
-                        {"role": "user", "content": prompt}
-                    ]
-                )
-                return response.content[0].text.strip()
+            summary = self._summarize_with_ai(prompt)
+            with self._summary_cache_lock:
+                self._summary_cache[key] = summary
+                if len(self._summary_cache) > settings.summary_cache_size:
+                    self._summary_cache.popitem(last=False)
+            return summary
                 
         except Exception as e:
             print(f"Error generating AI summary: {e}")
             return self._generate_basic_summary(document_content, summary_type)
     
+    def _summarize_with_ai(self, prompt: str) -> str:
+        """Run the summary prompt on OpenAI, or Anthropic when only it is configured."""
+        if self.openai_client:
+            response = self.openai_client.chat.completions.create(
+                model="gpt-4",
+                messages=[
+                    {"role": "system", "content": "Eres un experto en análisis legal y comunicación jurídica."},
+                    {"role": "user", "content": prompt}
+                ],
+                max_tokens=500,
+                temperature=0.3
+            )
+            return response.choices[0].message.content.strip()
+        
+        elif self.anthropic_client:
+            response = self.anthropic_client.messages.create(
+                model="claude-3-sonnet-20240229",
+                max_tokens=500,
+                temperature=0.3,
+                messages=[
+                    {"role": "user", "content": prompt}
+                ]
+            )
+            return response.content[0].text.strip()
+    
     def _generate_basic_summary(self, document_content: str, summary_type: str) -> str:
         """Generate a basic summary without AI."""
         # Simple text summarization
-        sentences = re.split(r'[.!?]+', document_content)
-        sentences = [s.strip() for s in sentences if len(s.strip()) > 20]
-        
         if summary_type == "technical":
             # Focus on legal terms and structure
-            legal_keywords = ['tribunal', 'juez', 'sentencia', 'fallo', 'recurso', 'apelación', 'materia', 'partes']
-            relevant_sentences = [s for s in sentences if any(keyword in s.lower() for keyword in legal_keywords)]
+            is_relevant = lambda sentence: LEGAL_KEYWORD_RE.search(sentence) is not None
         else:
             # Focus on clear, simple sentences
-            relevant_sentences = [s for s in sentences if len(s.split()) < 25]
+            is_relevant = lambda sentence: len(sentence.split()) < 25
         
         # Take first few relevant sentences
-        summary_sentences = relevant_sentences[:5]
+        summary_sentences = []
+        for match in SENTENCE_RE.finditer(document_content):
+            sentence = match.group().strip()
+            if len(sentence) > 20 and is_relevant(sentence):
+                summary_sentences.append(sentence)
+                if len(summary_sentences) == BASIC_SUMMARY_SENTENCES:
+                    break
         return ". ".join(summary_sentences) + "."
     
     def get_available_templates(self) -> List[Dict[str, Any]]:
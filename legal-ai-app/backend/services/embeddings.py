@@ -1,18 +1,34 @@
 import numpy as np
 import json
+import orjson
 import pickle
 import os
+import hashlib
+import fcntl
+import threading
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Dict, Any, Tuple, Optional
+import torch
 from sentence_transformers import SentenceTransformer
 import faiss
 from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.decomposition import PCA
+from sklearn.decomposition import TruncatedSVD
 import nltk
 from nltk.corpus import stopwords
 from nltk.tokenize import word_tokenize
 import re
+import heapq
+import ahocorasick
+from collections import Counter, OrderedDict
+from itertools import islice
+from datetime import datetime
 
 from config import settings
+from services import process_pools_enabled
+
+# Size FAISS's OpenMP pool explicitly; main.py defaults OMP_NUM_THREADS
+faiss.omp_set_num_threads(int(os.environ.get("OMP_NUM_THREADS") or os.cpu_count()))
 
 # Download NLTK data
 try:
@@ -25,28 +41,423 @@ try:
 except LookupError:
     nltk.download('stopwords')
 
+# Rebuild the index from scratch once this fraction of it was added incrementally
+INDEX_REBUILD_RATIO = 0.5
+
+# Corpora at least this large get an IVF index with 8-bit scalar-quantized
+# vectors (4x smaller than float32); smaller ones use exhaustive search over
+# float16 vectors, which halves the memory scanned at near-identical scores
+IVF_MIN_VECTORS = 10_000
+
+# Past this size, switch to OPQ-rotated product quantization (64 bytes per
+# vector) trained on a random sample rather than the whole corpus
+IVFPQ_MIN_VECTORS = 100_000
+IVFPQ_SUBQUANTIZERS = 64
+IVF_TRAIN_SAMPLE = 100_000
+
+# Length of the full_text preview returned with search results
+EXCERPT_LENGTH = 200
+
+# Embedding cache files: 32-byte content digests, and float32 rows after an
+# int64 row-width header, both appended to in the same order
+EMBED_CACHE_KEY_BYTES = 32
+EMBED_CACHE_HEADER_BYTES = 8
+
+# Distinct preprocessed queries whose embeddings are kept in memory
+QUERY_CACHE_SIZE = 1024
+
+# Compiled once; preprocess_text runs on every document and query
+_NON_WORD_RE = re.compile(r'[^\w\s]')
+_WHITESPACE_RE = re.compile(r'\s+')
+
+# Batches at least this large are preprocessed across worker processes where
+# those are enabled; below it, pool startup costs more than it saves
+PREPROCESS_PARALLEL_MIN = 10_000
+PREPROCESS_CHUNKSIZE = 256
+
+# Common outcome indicators; on ties the earlier outcome wins
+OUTCOME_INDICATORS = {
+    'condena': ['condena', 'condenado', 'condenada', 'condenar'],
+    'absolución': ['absuelve', 'absuelto', 'absuelta', 'absolver'],
+    'rechazo': ['rechaza', 'rechazado', 'rechazada', 'rechazar'],
+    'aceptación': ['acepta', 'aceptado', 'aceptada', 'aceptar'],
+    'archivo': ['archiva', 'archivado', 'archivada', 'archivar'],
+    'nulidad': ['nulo', 'nula', 'nulidad', 'anular'],
+    'recurso': ['recurso', 'recurrido', 'recurrida', 'recurrir']
+}
+_OUTCOMES = list(OUTCOME_INDICATORS)
+
+def _build_outcome_automaton() -> ahocorasick.Automaton:
+    """Aho-Corasick matcher mapping every indicator keyword to its outcome's position."""
+    automaton = ahocorasick.Automaton()
+    for position, keywords in enumerate(OUTCOME_INDICATORS.values()):
+        for keyword in keywords:
+            automaton.add_word(keyword, position)
+    automaton.make_automaton()
+    return automaton
+
+_OUTCOME_AUTOMATON = _build_outcome_automaton()
+
+def _document_datetime(doc: Dict[str, Any]) -> Optional[datetime]:
+    """A document's fecha as a naive datetime, or None when missing or malformed."""
+    try:
+        fecha = datetime.fromisoformat(doc.get('fecha', ''))
+    except (TypeError, ValueError):
+        return None
+    if fecha.tzinfo is not None:
+        fecha = fecha.replace(tzinfo=None)
+    return fecha
+
+def _use_onnx_encoder() -> bool:
+    """Whether to encode with the ONNX export; CUDA keeps the PyTorch model."""
+    return bool(settings.sentence_transformer_onnx_path) and not torch.cuda.is_available()
+
+def _encoder_id() -> str:
+    """Identifies the weights embeddings come from, for the embedding cache."""
+    if _use_onnx_encoder():
+        return f"{settings.sentence_transformer_model}@{settings.sentence_transformer_onnx_path}"
+    return settings.sentence_transformer_model
+
+def _preprocess_text(text: str) -> str:
+    """Preprocess legal text for better embeddings."""
+    # Remove special characters and normalize
+    text = _NON_WORD_RE.sub(' ', text)
+    text = _WHITESPACE_RE.sub(' ', text)
+    return text.lower().strip()
+
+def _preprocess_many(texts: List[str]) -> List[str]:
+    """_preprocess_text over texts, in worker processes for large batches.
+    
+    Serial unless process pools are enabled (see services.enable_process_pools).
+    """
+    if len(texts) < PREPROCESS_PARALLEL_MIN or not process_pools_enabled():
+        return [_preprocess_text(text) for text in texts]
+    
+    # Forked so workers neither re-import this module (and reload the model)
+    # nor receive the service object; they only run the module-level function
+    with ProcessPoolExecutor(mp_context=multiprocessing.get_context("fork")) as executor:
+        return list(executor.map(_preprocess_text, texts, chunksize=PREPROCESS_CHUNKSIZE))
+
+def _excerpt(text: str) -> str:
+    """Preview of a document's text, ellipsized past EXCERPT_LENGTH."""
+    return text[:EXCERPT_LENGTH] + '...' if len(text) > EXCERPT_LENGTH else text
+
+def _datetime64(value: datetime) -> np.datetime64:
+    """Naive datetime64[s] for comparing against the parsed fecha column."""
+    if value.tzinfo is not None:
+        value = value.replace(tzinfo=None)
+    return np.datetime64(value, 's')
+
+def _build_inverted_index(values: List[str]) -> Dict[str, np.ndarray]:
+    """Map each distinct value to the ascending document ids that carry it."""
+    postings: Dict[str, List[int]] = {}
+    for idx, value in enumerate(values):
+        postings.setdefault(value, []).append(idx)
+    return {value: np.array(ids, dtype=np.int64) for value, ids in postings.items()}
+
+def _gpu_count() -> int:
+    """Number of GPUs FAISS can use; always 0 with the faiss-cpu build."""
+    return faiss.get_num_gpus() if hasattr(faiss, "get_num_gpus") else 0
+
+def _apply_nprobe(index):
+    """Set the configured nprobe on an IVF index (wrapped or not); no-op otherwise."""
+    ivf = faiss.try_extract_index_ivf(index)
+    if ivf is not None:
+        ivf.nprobe = settings.faiss_nprobe
+    return index
+
+def _to_gpu(index):
+    """Clone a CPU index onto every visible GPU, or return it unchanged.
+    
+    Index types without a GPU implementation stay on the CPU.
+    """
+    if _gpu_count() == 0:
+        return index
+    options = faiss.GpuMultipleClonerOptions()
+    # Stores flat vectors as float16 and enables the float16 lookup tables
+    # GPU IVF-PQ needs past 48 sub-quantizers
+    options.useFloat16 = True
+    try:
+        return faiss.index_cpu_to_all_gpus(index, co=options)
+    except RuntimeError as e:
+        print(f"Keeping FAISS index on CPU, GPU clone failed: {e}")
+        return index
+
+def _copy_index(index):
+    """Independent copy of a FAISS index that can be added to without touching the original."""
+    if _gpu_count() > 0:
+        return _to_gpu(_apply_nprobe(faiss.index_gpu_to_cpu(index)))
+    return _apply_nprobe(faiss.clone_index(index))
+
+def _extend_embeddings(buffer: np.ndarray, count: int, rows: np.ndarray) -> Tuple[np.ndarray, int]:
+    """Buffer holding buffer[:count] followed by rows, and its filled length.
+    
+    Rows go into spare capacity past count, which no published snapshot
+    reads; when it runs out the buffer doubles (a read-only map is copied
+    once), so appends are amortized O(1).
+    """
+    needed = count + len(rows)
+    if needed > len(buffer) or not buffer.flags.writeable:
+        grown = np.empty((max(needed, 2 * len(buffer)), rows.shape[1]), dtype=np.float32)
+        if count:
+            grown[:count] = buffer[:count]
+        buffer = grown
+    buffer[count:needed] = rows
+    return buffer, needed
+
+class IndexSnapshot:
+    """The FAISS index, the documents its ids point to, and metadata over them.
+    
+    A snapshot is never modified once built. Writers publish a new one in
+    a single assignment, so a request that reads one snapshot sees an
+    index, document list and columns that all match.
+    """
+    
+    def __init__(
+        self,
+        faiss_index=None,
+        documents: Optional[List[Dict[str, Any]]] = None,
+        embedding_buffer: Optional[np.ndarray] = None,
+        embedding_count: int = 0
+    ):
+        self.faiss_index = faiss_index
+        self.documents = documents if documents is not None else []
+        # Embedding rows live in a buffer with spare capacity shared with the
+        # snapshot this one was extended from; self.embeddings is the filled prefix
+        self.embedding_buffer = embedding_buffer if embedding_buffer is not None else np.empty((0, 0), dtype=np.float32)
+        self.embedding_count = embedding_count
+        self._build_metadata_index()
+    
+    @property
+    def embeddings(self) -> np.ndarray:
+        """Embeddings of self.documents, one row per document."""
+        return self.embedding_buffer[:self.embedding_count]
+    
+    def index_matches_documents(self) -> bool:
+        """Whether there is an index and FAISS id i is self.documents[i] for all of it."""
+        return self.faiss_index is not None and self.faiss_index.ntotal == len(self.documents)
+    
+    def _build_metadata_index(self):
+        """Index documents by lowercased tribunal/materia and by date.
+        
+        Lets filtered searches resolve candidate ids without walking every
+        document dict on each request. self.columns holds normalized
+        per-document fields as arrays parallel to self.documents.
+        """
+        self.columns: Dict[str, np.ndarray] = {
+            'tribunal_lower': np.array([doc.get('tribunal', '').lower() for doc in self.documents], dtype=object),
+            'materia_lower': np.array([doc.get('materia', '').lower() for doc in self.documents], dtype=object),
+            # Parsed once here; NaT marks a missing or malformed fecha
+            'fecha': np.array([_document_datetime(doc) for doc in self.documents], dtype='datetime64[s]'),
+            'excerpt': np.array([_excerpt(doc.get('full_text', '')) for doc in self.documents], dtype=object),
+        }
+        self.tribunal_index = _build_inverted_index(self.columns['tribunal_lower'].tolist())
+        self.materia_index = _build_inverted_index(self.columns['materia_lower'].tolist())
+        
+        # Intern tribunal/materia so per-result filters compare small ints;
+        # the *_code columns index into these sorted distinct values
+        self.vocab: Dict[str, np.ndarray] = {}
+        for field in ('tribunal', 'materia'):
+            vocab, codes = np.unique(self.columns[f'{field}_lower'].astype(str), return_inverse=True)
+            self.vocab[field] = vocab
+            self.columns[f'{field}_code'] = codes.astype(np.int32)
+        
+        dates = self.columns['fecha']
+        ids = np.flatnonzero(~np.isnat(dates))
+        order = np.argsort(dates[ids], kind='stable')
+        self.dates_sorted = dates[ids][order]
+        self.date_order_idx = ids[order]
+        
+        # Tribunal/materia/year histograms
+        self.corpus_stats: Dict[str, Counter] = {
+            'tribunals': Counter(doc.get('tribunal', 'Unknown') for doc in self.documents),
+            'materias': Counter(doc.get('materia', 'Unknown') for doc in self.documents),
+            'years': Counter((self.dates_sorted.astype('datetime64[Y]').astype(int) + 1970).tolist()),
+        }
+    
+    @staticmethod
+    def _match_substring(index: Dict[str, np.ndarray], query: str, limit: Optional[int] = None) -> np.ndarray:
+        """Ascending ids whose indexed value contains query (case-insensitive).
+        
+        Each document sits under exactly one value, so the matching id
+        arrays are disjoint; with a limit they are merged lazily and only
+        the first limit ids are produced.
+        """
+        query = query.lower()
+        matches = [ids for value, ids in index.items() if query in value]
+        if not matches:
+            return np.array([], dtype=np.int64)
+        if limit is not None:
+            return np.fromiter(islice(heapq.merge(*matches), limit), dtype=np.int64)
+        return np.sort(np.concatenate(matches))
+    
+    def ids_by_tribunal(self, tribunal: str, limit: Optional[int] = None) -> np.ndarray:
+        """Ascending ids of documents whose tribunal contains the given text."""
+        return self._match_substring(self.tribunal_index, tribunal, limit)
+    
+    def ids_by_materia(self, materia: str, limit: Optional[int] = None) -> np.ndarray:
+        """Ascending ids of documents whose materia contains the given text."""
+        return self._match_substring(self.materia_index, materia, limit)
+    
+    def filter_mask(
+        self,
+        ids: np.ndarray,
+        tribunal: Optional[str] = None,
+        materia: Optional[str] = None,
+        start: Optional[datetime] = None,
+        end: Optional[datetime] = None
+    ) -> np.ndarray:
+        """Boolean mask over ids of documents passing the given filters.
+        
+        Tribunal/materia match as case-insensitive substrings. Undated
+        documents are kept by the date bounds, unlike ids_by_date_range.
+        Ids not yet covered by the metadata columns never pass.
+        """
+        count = len(self.columns.get('fecha', ()))
+        mask = ids < count
+        if not count:
+            return mask
+        ids = np.where(mask, ids, 0)
+        for field, query in (('tribunal', tribunal), ('materia', materia)):
+            if query:
+                query = query.lower()
+                targets = np.flatnonzero([query in value for value in self.vocab[field]])
+                mask &= np.isin(self.columns[f'{field}_code'][ids], targets)
+        
+        if start or end:
+            fechas = self.columns['fecha'][ids]
+            # NaT compares False, so undated documents survive both bounds
+            if start:
+                mask &= ~(fechas < _datetime64(start))
+            if end:
+                mask &= ~(fechas > _datetime64(end))
+        return mask
+    
+    def ids_by_date_range(self, start: Optional[datetime] = None, end: Optional[datetime] = None) -> np.ndarray:
+        """Ascending ids of documents dated within [start, end]; undated ones never match."""
+        lo = np.searchsorted(self.dates_sorted, np.datetime64(start, 's'), side='left') if start else 0
+        hi = np.searchsorted(self.dates_sorted, np.datetime64(end, 's'), side='right') if end else len(self.dates_sorted)
+        return np.sort(self.date_order_idx[lo:hi])
+    
+    def selector_search_params(self, ids: np.ndarray):
+        """SearchParameters restricting a FAISS search to the given ids."""
+        selector = faiss.IDSelectorBatch(len(ids), faiss.swig_ptr(ids))
+        index = self.faiss_index
+        if isinstance(index, faiss.IndexPreTransform):
+            # The OPQ rotation wraps the IVF index; parameters go to the inner one
+            inner = faiss.extract_index_ivf(index)
+            return faiss.SearchParametersPreTransform(
+                index_params=faiss.SearchParametersIVF(sel=selector, nprobe=inner.nprobe)
+            )
+        if isinstance(index, faiss.IndexIVF):
+            return faiss.SearchParametersIVF(sel=selector, nprobe=index.nprobe)
+        return faiss.SearchParameters(sel=selector)
+
 class LegalEmbeddingsService:
     def __init__(self):
-        self.model = SentenceTransformer(settings.sentence_transformer_model)
+        # The transformer is loaded on first encode; see the model property
+        self._model = None
+        self._model_lock = threading.Lock()
         self.tfidf_vectorizer = TfidfVectorizer(
             max_features=1000,
             stop_words='english',
             ngram_range=(1, 2)
         )
-        self.pca = PCA(n_components=100)
-        self.faiss_index = None
-        self.documents = []
-        self.embeddings = []
+        # LSA on the sparse TF-IDF matrix; unlike PCA it never densifies it
+        self.svd = TruncatedSVD(n_components=100, algorithm='randomized', random_state=42)
+        # Index, documents and metadata, replaced as a whole by index writers;
+        # readers take one snapshot per request (see snapshot())
+        self._snapshot = IndexSnapshot()
+        # Only one index job embeds and builds at a time
+        self._write_lock = threading.Lock()
+        # Vectors added since the last full build, and how many rebuilds ran
+        self.delta_count = 0
+        self._epoch_rebuilds = 0
+        
+        # Embeddings by content digest: digest -> row of _embed_cache_vectors,
+        # a read-only map of the append-only cache file
+        self._embed_cache_rows: Dict[bytes, int] = {}
+        self._embed_cache_vectors = np.empty((0, 0), dtype=np.float32)
+        self._embed_cache_lock = threading.Lock()
+        
+        # LRU of query embeddings keyed on the preprocessed query; popular
+        # queries repeat a lot, so hits skip the transformer forward pass
+        self._query_cache: "OrderedDict[str, np.ndarray]" = OrderedDict()
+        self._query_cache_lock = threading.Lock()
         
         # Load existing models if they exist
         self._load_models()
+        self._load_embedding_cache()
+    
+    @property
+    def model(self) -> SentenceTransformer:
+        """The sentence transformer, loaded on first use.
+        
+        Loading costs hundreds of MB and seconds of CPU, so processes that
+        only read the index or metadata never pay for it. On CPU-only hosts
+        with an ONNX export configured, an OnnxSentenceEncoder is used instead.
+        """
+        if self._model is None:
+            with self._model_lock:
+                if self._model is None and _use_onnx_encoder():
+                    from services.onnx_encoder import OnnxSentenceEncoder
+                    self._model = OnnxSentenceEncoder(settings.sentence_transformer_onnx_path)
+                    print(f"Loaded ONNX sentence encoder from {settings.sentence_transformer_onnx_path}")
+                elif self._model is None:
+                    model = SentenceTransformer(settings.sentence_transformer_model)
+                    if torch.cuda.is_available():
+                        # Half precision doubles encoder throughput and cosine scores barely move
+                        model = model.to('cuda').half()
+                    self._model = model
+        return self._model
+    
+    def snapshot(self) -> IndexSnapshot:
+        """The current index state; stays consistent however long the caller holds it."""
+        return self._snapshot
+    
+    @property
+    def faiss_index(self):
+        return self._snapshot.faiss_index
+    
+    @property
+    def documents(self) -> List[Dict[str, Any]]:
+        return self._snapshot.documents
+    
+    @property
+    def embeddings(self) -> np.ndarray:
+        """Embeddings of self.documents, one row per document."""
+        return self._snapshot.embeddings
+    
+    @property
+    def corpus_stats(self) -> Dict[str, Counter]:
+        return self._snapshot.corpus_stats
     
     def _load_models(self):
         """Load existing FAISS index and classifier if they exist."""
         try:
             if os.path.exists(settings.faiss_index_path):
-                self.faiss_index = faiss.read_index(settings.faiss_index_path)
+                faiss_index = _to_gpu(_apply_nprobe(faiss.read_index(settings.faiss_index_path)))
                 print(f"Loaded existing FAISS index from {settings.faiss_index_path}")
+                
+                # Mapped rather than read, so workers share the pages
+                embeddings = np.empty((0, 0), dtype=np.float32)
+                if os.path.exists(settings.embeddings_path):
+                    mapped = np.load(settings.embeddings_path, mmap_mode='r')
+                    if len(mapped) == faiss_index.ntotal:
+                        embeddings = mapped
+                
+                # FAISS ids are positions in this list, so an index it doesn't
+                # match would return the wrong documents; drop it instead and
+                # let the next sync rebuild from the full corpus
+                documents = self._read_documents()
+                if len(documents) == faiss_index.ntotal:
+                    self._snapshot = IndexSnapshot(faiss_index, documents, embeddings, len(embeddings))
+                    print(f"Loaded {len(documents)} indexed documents from {settings.documents_path}")
+                else:
+                    print(
+                        f"Indexed documents ({len(documents)}) don't match the FAISS index "
+                        f"({faiss_index.ntotal} vectors); it will be rebuilt"
+                    )
             
             if os.path.exists(settings.classifier_model_path):
                 with open(settings.classifier_model_path, 'rb') as f:
@@ -57,109 +468,353 @@ class LegalEmbeddingsService:
             print(f"Error loading existing models: {e}")
             print("Will create new models")
     
-    def preprocess_text(self, text: str) -> str:
-        """Preprocess legal text for better embeddings."""
-        # Remove special characters and normalize
-        text = re.sub(r'[^\w\s]', ' ', text)
-        text = re.sub(r'\s+', ' ', text)
-        text = text.lower().strip()
-        
-        # Remove common legal abbreviations and normalize
-        legal_replacements = {
-            'dr.': 'doctor',
-            'sr.': 'señor',
-            'sra.': 'señora',
-            'art.': 'artículo',
-            'arts.': 'artículos',
-            'inc.': 'inciso',
-            'incs.': 'incisos',
-            'ley': 'ley',
-            'código': 'código',
-            'tribunal': 'tribunal',
-            'juzgado': 'juzgado',
-            'cámara': 'cámara',
-            'fiscal': 'fiscal',
-            'defensor': 'defensor',
-            'abogado': 'abogado'
-        }
+    @staticmethod
+    def _read_documents() -> List[Dict[str, Any]]:
+        if not os.path.exists(settings.documents_path):
+            return []
+        with open(settings.documents_path, 'rb') as f:
+            return orjson.loads(f.read())
+    
+    def index_matches_documents(self) -> bool:
+        """Whether there is an index and FAISS id i is self.documents[i] for all of it.
+        
+        Only then can update_index append new documents; otherwise callers
+        should pass the whole corpus so the index is rebuilt from it.
+        """
+        return self._snapshot.index_matches_documents()
+    
+    @staticmethod
+    def _embed_cache_paths() -> Tuple[str, str]:
+        """Digest file and vector file of the embedding cache."""
+        return f"{settings.embedding_cache_path}.keys", f"{settings.embedding_cache_path}.f32"
+    
+    @staticmethod
+    def _embed_cache_dimension(vectors_path: str) -> Optional[int]:
+        """Row width recorded in a vector file's header, or None without one."""
+        try:
+            with open(vectors_path, 'rb') as f:
+                header = f.read(EMBED_CACHE_HEADER_BYTES)
+        except FileNotFoundError:
+            return None
+        if len(header) < EMBED_CACHE_HEADER_BYTES:
+            return None
+        return int(np.frombuffer(header, dtype=np.int64)[0])
+    
+    @staticmethod
+    def _embed_cache_count(keys_size: int, vectors_size: int, dimension: int) -> int:
+        """Complete entries in the cache files.
+        
+        Vectors are written before their digests, so a writer that died
+        mid-append leaves extra vector rows or a partial digest; both are ignored.
+        """
+        rows = (vectors_size - EMBED_CACHE_HEADER_BYTES) // (4 * dimension)
+        return max(0, min(keys_size // EMBED_CACHE_KEY_BYTES, rows))
+    
+    def _map_embedding_cache(self, vectors_path: str, dimension: int, count: int):
+        """Point _embed_cache_vectors at the first count rows of the vector file."""
+        if count == 0:
+            self._embed_cache_vectors = np.empty((0, dimension), dtype=np.float32)
+        else:
+            # Mapped read-only: pages are shared between workers, not copied
+            self._embed_cache_vectors = np.memmap(
+                vectors_path, dtype=np.float32, mode='r',
+                offset=EMBED_CACHE_HEADER_BYTES, shape=(count, dimension)
+            )
+    
+    def _load_embedding_cache(self):
+        """Map the content-hash embedding cache, if one was saved."""
+        keys_path, vectors_path = self._embed_cache_paths()
+        dimension = self._embed_cache_dimension(vectors_path)
+        if dimension is None or not os.path.exists(keys_path):
+            return
+        try:
+            with open(keys_path, 'rb') as f:
+                keys = f.read()
+            count = self._embed_cache_count(len(keys), os.path.getsize(vectors_path), dimension)
+            self._embed_cache_rows = {
+                keys[row * EMBED_CACHE_KEY_BYTES:(row + 1) * EMBED_CACHE_KEY_BYTES]: row
+                for row in range(count)
+            }
+            self._map_embedding_cache(vectors_path, dimension, count)
+            print(f"Loaded {count} cached embeddings from {settings.embedding_cache_path}")
+        except Exception as e:
+            print(f"Error loading embedding cache, starting empty: {e}")
+    
+    def _append_embedding_cache(self, digests: List[bytes], vectors: np.ndarray):
+        """Append new entries to the cache files and map them. Caller holds _embed_cache_lock.
+        
+        Only the new rows are written. An exclusive flock serializes appends
+        across worker processes, and each append starts at the on-disk row
+        count, so entries added by other processes are kept too.
+        """
+        keys_path, vectors_path = self._embed_cache_paths()
+        os.makedirs(os.path.dirname(keys_path) or '.', exist_ok=True)
+        dimension = vectors.shape[1]
         
-        for abbr, full in legal_replacements.items():
-            text = text.replace(abbr, full)
+        with open(f"{settings.embedding_cache_path}.lock", 'wb') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            if self._embed_cache_dimension(vectors_path) != dimension:
+                # New cache, or an encoder with another width. Fresh files are
+                # swapped in, so processes mapping the old ones keep valid pages
+                for path, content in ((keys_path, b''), (vectors_path, np.int64(dimension).tobytes())):
+                    with open(f"{path}.tmp", 'wb') as f:
+                        f.write(content)
+                    os.replace(f"{path}.tmp", path)
+                self._embed_cache_rows = {}
+            
+            with open(keys_path, 'ab') as keys_file, open(vectors_path, 'ab') as vectors_file:
+                start = self._embed_cache_count(
+                    os.fstat(keys_file.fileno()).st_size, os.fstat(vectors_file.fileno()).st_size, dimension
+                )
+                # Cut any incomplete tail; no process maps past the complete rows
+                keys_file.truncate(start * EMBED_CACHE_KEY_BYTES)
+                vectors_file.truncate(EMBED_CACHE_HEADER_BYTES + start * 4 * dimension)
+                vectors_file.write(np.ascontiguousarray(vectors, dtype=np.float32).tobytes())
+                vectors_file.flush()
+                keys_file.write(b''.join(digests))
         
-        return text
+        # A concurrent call may have added the same digest; the newer row wins
+        for offset, digest in enumerate(digests):
+            self._embed_cache_rows[digest] = start + offset
+        self._map_embedding_cache(vectors_path, dimension, start + len(digests))
+    
+    @staticmethod
+    def _content_digest(processed_text: str) -> bytes:
+        """Cache key for a text; includes the model so a model change misses."""
+        return hashlib.sha256(f"{_encoder_id()}\0{processed_text}".encode('utf-8')).digest()
+    
+    def preprocess_text(self, text: str) -> str:
+        """Preprocess legal text for better embeddings."""
+        return _preprocess_text(text)
     
     def create_embeddings(self, documents: List[Dict[str, Any]]) -> np.ndarray:
         """Create embeddings for a list of legal documents."""
         print(f"Creating embeddings for {len(documents)} documents...")
         
-        processed_texts = []
-        for doc in documents:
-            # Combine relevant fields for embedding
-            text_parts = [
+        # Combine relevant fields for embedding
+        combined_texts = [
+            ' '.join(filter(None, [
                 doc.get('tribunal', ''),
                 doc.get('materia', ''),
                 doc.get('partes', ''),
                 doc.get('full_text', '')
-            ]
+            ]))
+            for doc in documents
+        ]
+        processed_texts = _preprocess_many(combined_texts)
+        
+        # Only encode texts not embedded before (or repeated in this batch)
+        digests = [self._content_digest(text) for text in processed_texts]
+        with self._embed_cache_lock:
+            missing = list(dict.fromkeys(d for d in digests if d not in self._embed_cache_rows))
+        
+        new_vectors = None
+        if missing:
+            missing_texts = dict(zip(digests, processed_texts))
+            # Create embeddings
+            # (L2-normalized by the encoder, so inner product is cosine)
+            new_vectors = np.asarray(self.model.encode(
+                [missing_texts[d] for d in missing],
+                batch_size=settings.embedding_batch_size,
+                show_progress_bar=True,
+                convert_to_numpy=True,
+                normalize_embeddings=True
+            ), dtype=np.float32)
             
-            combined_text = ' '.join(filter(None, text_parts))
-            processed_text = self.preprocess_text(combined_text)
-            processed_texts.append(processed_text)
+            with self._embed_cache_lock:
+                try:
+                    self._append_embedding_cache(missing, new_vectors)
+                except Exception as e:
+                    print(f"Error saving embedding cache: {e}")
+        
+        with self._embed_cache_lock:
+            rows = np.fromiter(
+                (self._embed_cache_rows.get(d, -1) for d in digests), dtype=np.int64, count=len(digests)
+            )
+            cached = self._embed_cache_vectors
         
-        # Create embeddings
-        embeddings = self.model.encode(processed_texts, show_progress_bar=True)
-        print(f"Created embeddings with shape: {embeddings.shape}")
+        # Cached rows are gathered from the map; those the cache couldn't take
+        # (a failed append) come straight from this call's encode
+        dimension = new_vectors.shape[1] if new_vectors is not None else cached.shape[1]
+        embeddings = np.empty((len(digests), dimension), dtype=np.float32)
+        hits = rows >= 0
+        embeddings[hits] = cached[rows[hits]]
+        if not hits.all():
+            new_rows = {digest: row for row, digest in enumerate(missing)}
+            misses = np.flatnonzero(~hits)
+            embeddings[misses] = new_vectors[[new_rows[digests[i]] for i in misses]]
+        print(f"Created embeddings with shape: {embeddings.shape} ({len(missing)} newly encoded)")
         
         return embeddings
     
-    def build_faiss_index(self, embeddings: np.ndarray):
-        """Build FAISS index for fast similarity search."""
+    def _build_faiss_index(self, embeddings: np.ndarray):
+        """Build a FAISS index for fast similarity search over the given rows."""
         print("Building FAISS index...")
         
-        # Normalize embeddings for cosine similarity
-        faiss.normalize_L2(embeddings)
-        
-        # Create FAISS index
-        dimension = embeddings.shape[1]
-        self.faiss_index = faiss.IndexFlatIP(dimension)  # Inner product for cosine similarity
+        # Create FAISS index (inner product over the normalized embeddings
+        # from create_embeddings = cosine)
+        vectors = np.ascontiguousarray(embeddings, dtype=np.float32)
+        count, dimension = vectors.shape
+        if count >= IVF_MIN_VECTORS:
+            # ~sqrt(n) lists keeps well over the ~39 training points per list FAISS wants
+            nlist = int(np.sqrt(count))
+            if count >= IVFPQ_MIN_VECTORS and dimension % IVFPQ_SUBQUANTIZERS == 0:
+                m = IVFPQ_SUBQUANTIZERS
+                factory = f"OPQ{m},IVF{nlist},PQ{m}"
+            else:
+                factory = f"IVF{nlist},SQ8"
+            index = faiss.index_factory(dimension, factory, faiss.METRIC_INNER_PRODUCT)
+            if count > IVF_TRAIN_SAMPLE:
+                sample = np.random.default_rng(0).choice(count, IVF_TRAIN_SAMPLE, replace=False)
+                index.train(vectors[sample])
+            else:
+                index.train(vectors)
+            _apply_nprobe(index)
+        elif _gpu_count() > 0:
+            # The GPU clone of a flat index already stores float16 vectors
+            index = faiss.IndexFlatIP(dimension)
+        else:
+            index = faiss.IndexScalarQuantizer(dimension, faiss.ScalarQuantizer.QT_fp16, faiss.METRIC_INNER_PRODUCT)
+            index.train(vectors)
+        index = _to_gpu(index)
         
         # Add vectors to index
-        self.faiss_index.add(embeddings.astype('float32'))
+        index.add(vectors)
+        print(f"FAISS index built with {index.ntotal} vectors")
+        return index
+    
+    def rebuild_index(self) -> np.ndarray:
+        """Re-embed the indexed documents and build a fresh FAISS index over them.
         
-        print(f"FAISS index built with {self.faiss_index.ntotal} vectors")
+        Returns the embeddings the new index was built from.
+        """
+        with self._write_lock:
+            documents = self._snapshot.documents
+            embeddings = self.create_embeddings(documents)
+            snapshot = IndexSnapshot(self._build_faiss_index(embeddings), documents, embeddings, len(embeddings))
+            self._snapshot = snapshot
+            self.delta_count = 0
+            self._write_index(snapshot)
+        return embeddings
+    
+    def _write_index(self, snapshot: IndexSnapshot):
+        """Persist a snapshot's FAISS index, copying it back from the GPU if needed.
         
-        # Save index
+        The embedding matrix is saved alongside it. It goes through a
+        temporary file and a rename, so processes still mapping the old
+        file keep reading intact pages. So does the document list, which
+        maps FAISS ids back to documents after a restart.
+        """
         os.makedirs(os.path.dirname(settings.faiss_index_path), exist_ok=True)
-        faiss.write_index(self.faiss_index, settings.faiss_index_path)
+        index = faiss.index_gpu_to_cpu(snapshot.faiss_index) if _gpu_count() > 0 else snapshot.faiss_index
+        faiss.write_index(index, settings.faiss_index_path)
         print(f"FAISS index saved to {settings.faiss_index_path}")
+        
+        if len(snapshot.embeddings) > 0:
+            tmp_path = f"{settings.embeddings_path}.tmp"
+            with open(tmp_path, 'wb') as f:
+                np.save(f, np.asarray(snapshot.embeddings, dtype=np.float32))
+            os.replace(tmp_path, settings.embeddings_path)
+        
+        tmp_path = f"{settings.documents_path}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(orjson.dumps(snapshot.documents, default=str))
+        os.replace(tmp_path, settings.documents_path)
     
-    def search_similar_documents(self, query: str, k: int = 10) -> List[Tuple[int, float]]:
-        """Search for similar documents using FAISS."""
-        if self.faiss_index is None:
-            raise ValueError("FAISS index not built. Please build index first.")
+    def search_similar_documents(
+        self,
+        query: str,
+        k: int = 10,
+        ids: Optional[np.ndarray] = None,
+        snapshot: Optional[IndexSnapshot] = None
+    ) -> List[Tuple[int, float]]:
+        """Search for similar documents using FAISS.
         
-        # Create query embedding
-        processed_query = self.preprocess_text(query)
-        query_embedding = self.model.encode([processed_query])
+        When ids is given, only those documents are scored. Results come
+        back in descending score order, as ids into the documents of
+        snapshot (the current one by default).
+        """
+        snapshot = snapshot or self._snapshot
+        if snapshot.faiss_index is None:
+            raise ValueError("FAISS index not built. Please build index first.")
         
-        # Normalize query embedding
-        faiss.normalize_L2(query_embedding)
+        query_embedding = self.embed_queries([query])
         
         # Search
-        scores, indices = self.faiss_index.search(
-            query_embedding.astype('float32'), k
-        )
+        if ids is None:
+            return self.search_embeddings(query_embedding, k, snapshot)[0]
+        elif _gpu_count() > 0:
+            # GPU indexes don't take ID selectors; over-fetch and filter instead
+            fetch = min(snapshot.faiss_index.ntotal, max(k * 10, 100))
+            scores, indices = snapshot.faiss_index.search(query_embedding, fetch)
+            keep = np.isin(indices[0], ids)
+            scores, indices = scores[:, keep][:, :k], indices[:, keep][:, :k]
+        else:
+            ids = np.ascontiguousarray(ids, dtype=np.int64)
+            scores, indices = snapshot.faiss_index.search(
+                query_embedding, k, params=snapshot.selector_search_params(ids)
+            )
+        
+        return self._result_pairs(indices[0], scores[0])
+    
+    def embed_queries(self, queries: List[str]) -> np.ndarray:
+        """Normalized float32 query embeddings, one row per query.
+        
+        Previously seen queries come from the LRU; the rest are encoded
+        together in one model call.
+        """
+        processed_queries = [self.preprocess_text(query) for query in queries]
+        
+        vectors: Dict[str, np.ndarray] = {}
+        with self._query_cache_lock:
+            for processed_query in processed_queries:
+                if processed_query in self._query_cache:
+                    self._query_cache.move_to_end(processed_query)
+                    vectors[processed_query] = self._query_cache[processed_query]
         
-        # Return results as (index, score) tuples
-        results = []
-        for i, score in zip(indices[0], scores[0]):
-            if i != -1:  # FAISS returns -1 for invalid indices
-                results.append((int(i), float(score)))
+        misses = [query for query in dict.fromkeys(processed_queries) if query not in vectors]
+        if misses:
+            encoded = np.asarray(
+                self.model.encode(misses, convert_to_numpy=True, normalize_embeddings=True),
+                dtype=np.float32
+            )
+            encoded.setflags(write=False)
+            with self._query_cache_lock:
+                for processed_query, vector in zip(misses, encoded):
+                    vectors[processed_query] = vector
+                    self._query_cache[processed_query] = vector
+                    self._query_cache.move_to_end(processed_query)
+                while len(self._query_cache) > QUERY_CACHE_SIZE:
+                    self._query_cache.popitem(last=False)
         
-        return results
+        return np.stack([vectors[processed_query] for processed_query in processed_queries])
+    
+    def search_embeddings(
+        self,
+        query_embeddings: np.ndarray,
+        k: int,
+        snapshot: Optional[IndexSnapshot] = None
+    ) -> List[List[Tuple[int, float]]]:
+        """Search several query embeddings in one FAISS call.
+        
+        A (B, d) batch is scored as one matrix product instead of B
+        separate vector products. Each row is in descending score order,
+        which callers rely on instead of re-sorting.
+        """
+        snapshot = snapshot or self._snapshot
+        if snapshot.faiss_index is None:
+            raise ValueError("FAISS index not built. Please build index first.")
+        
+        scores, indices = snapshot.faiss_index.search(query_embeddings, k)
+        return [self._result_pairs(row_indices, row_scores) for row_indices, row_scores in zip(indices, scores)]
+    
+    @staticmethod
+    def _result_pairs(indices: np.ndarray, scores: np.ndarray) -> List[Tuple[int, float]]:
+        """(index, score) tuples for one result row, skipping FAISS's -1 padding."""
+        return [(int(i), float(score)) for i, score in zip(indices, scores) if i != -1]
     
     def extract_features(self, documents: List[Dict[str, Any]]) -> np.ndarray:
-        """Extract features for classification using TF-IDF and PCA."""
+        """Extract features for classification using TF-IDF and truncated SVD."""
         print("Extracting features for classification...")
         
         # Prepare text for TF-IDF
@@ -178,38 +833,26 @@ class LegalEmbeddingsService:
         tfidf_features = self.tfidf_vectorizer.fit_transform(texts)
         print(f"TF-IDF features shape: {tfidf_features.shape}")
         
-        # Apply PCA for dimensionality reduction
-        tfidf_dense = tfidf_features.toarray()
-        pca_features = self.pca.fit_transform(tfidf_dense)
-        print(f"PCA features shape: {pca_features.shape}")
+        # Reduce dimensionality directly on the CSR matrix
+        svd_features = self.svd.fit_transform(tfidf_features)
+        print(f"SVD features shape: {svd_features.shape}")
         
-        return pca_features
+        return svd_features
     
     def extract_outcome_from_text(self, text: str) -> str:
         """Extract legal outcome from text using simple NLP rules."""
         text_lower = text.lower()
         
-        # Common outcome indicators
-        outcome_indicators = {
-            'condena': ['condena', 'condenado', 'condenada', 'condenar'],
-            'absolución': ['absuelve', 'absuelto', 'absuelta', 'absolver'],
-            'rechazo': ['rechaza', 'rechazado', 'rechazada', 'rechazar'],
-            'aceptación': ['acepta', 'aceptado', 'aceptada', 'aceptar'],
-            'archivo': ['archiva', 'archivado', 'archivada', 'archivar'],
-            'nulidad': ['nulo', 'nula', 'nulidad', 'anular'],
-            'recurso': ['recurso', 'recurrido', 'recurrida', 'recurrir']
-        }
-        
-        # Count occurrences of each outcome type
-        outcome_counts = {}
-        for outcome, keywords in outcome_indicators.items():
-            count = sum(text_lower.count(keyword) for keyword in keywords)
-            if count > 0:
-                outcome_counts[outcome] = count
+        # Count occurrences of each outcome type in one pass over the text;
+        # overlapping keywords (condena/condenado) each count, as with str.count
+        outcome_counts = [0] * len(_OUTCOMES)
+        for _, position in _OUTCOME_AUTOMATON.iter(text_lower):
+            outcome_counts[position] += 1
         
         # Return most common outcome
-        if outcome_counts:
-            return max(outcome_counts, key=outcome_counts.get)
+        best = max(range(len(_OUTCOMES)), key=outcome_counts.__getitem__)
+        if outcome_counts[best] > 0:
+            return _OUTCOMES[best]
         else:
             return 'indeterminado'
     
@@ -225,35 +868,58 @@ class LegalEmbeddingsService:
             'outcome': self.extract_outcome_from_text(doc.get('full_text', ''))
         }
     
+    def get_recent(self, n: int) -> List[Dict[str, Any]]:
+        """Return the last n indexed documents without copying the whole list."""
+        if n <= 0:
+            return []
+        return self._snapshot.documents[-n:]
+    
     def update_index(self, new_documents: List[Dict[str, Any]]):
-        """Update the FAISS index with new documents."""
-        print(f"Updating index with {len(new_documents)} new documents...")
+        """Update the FAISS index with new documents.
         
-        # Create embeddings for new documents
-        new_embeddings = self.create_embeddings(new_documents)
+        Without an index matching self.documents (see index_matches_documents),
+        new_documents replaces the indexed corpus instead. The result is
+        built aside and published in one swap, so searches keep using the
+        previous state until it is complete.
+        """
+        print(f"Updating index with {len(new_documents)} new documents...")
         
-        # Add to existing index or create new one
-        if self.faiss_index is not None:
-            # Normalize new embeddings
-            faiss.normalize_L2(new_embeddings)
+        with self._write_lock:
+            current = self._snapshot
             
-            # Add to existing index
-            self.faiss_index.add(new_embeddings.astype('float32'))
+            # Create embeddings for new documents
+            new_embeddings = self.create_embeddings(new_documents)
             
-            # Update documents list
-            self.documents.extend(new_documents)
-            self.embeddings = np.vstack([self.embeddings, new_embeddings]) if len(self.embeddings) > 0 else new_embeddings
+            # Add to a copy of the existing index or create new one; appending
+            # needs FAISS ids to line up with the documents, else new_documents
+            # is the corpus
+            if current.index_matches_documents():
+                faiss_index = _copy_index(current.faiss_index)
+                faiss_index.add(new_embeddings)
+                documents = current.documents + list(new_documents)
+                buffer, count = _extend_embeddings(current.embedding_buffer, current.embedding_count, new_embeddings)
+                self.delta_count += len(new_documents)
+                
+                # Incremental adds are cheap but leave structure fitted to the old
+                # data; rebuild once the delta outgrows the threshold
+                if self.delta_count / faiss_index.ntotal > INDEX_REBUILD_RATIO and count == faiss_index.ntotal:
+                    print(f"Rebuilding index after {self.delta_count} incremental additions...")
+                    faiss_index = self._build_faiss_index(buffer[:count])
+                    self.delta_count = 0
+                    self._epoch_rebuilds += 1
+            else:
+                # Create new index
+                documents = list(new_documents)
+                buffer, count = new_embeddings, len(new_embeddings)
+                faiss_index = self._build_faiss_index(new_embeddings)
+                self.delta_count = 0
             
-        else:
-            # Create new index
-            self.documents = new_documents
-            self.embeddings = new_embeddings
-            self.build_faiss_index(new_embeddings)
-        
-        print(f"Index updated. Total documents: {len(self.documents)}")
-        
-        # Save updated index
-        faiss.write_index(self.faiss_index, settings.faiss_index_path)
+            snapshot = IndexSnapshot(faiss_index, documents, buffer, count)
+            self._snapshot = snapshot
+            print(f"Index updated. Total documents: {len(documents)}")
+            
+            # Save updated index
+            self._write_index(snapshot)
 
 # Global instance
 embeddings_service = LegalEmbeddingsService()
\ No newline at end of file
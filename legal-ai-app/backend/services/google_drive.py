@@ -1,21 +1,209 @@
 import os
-import json
+import re
+import logging
+import orjson
 import tempfile
+import asyncio
+import threading
+import multiprocessing
+from datetime import datetime, timedelta
+from concurrent.futures import ProcessPoolExecutor
 from typing import List, Dict, Any, Optional
 from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
+from googleapiclient.errors import HttpError
 from googleapiclient.http import MediaIoBaseDownload
-import io
+import google_auth_httplib2
+import httplib2
+import httpx
 import fitz  # PyMuPDF
+from tenacity import retry, retry_if_exception, stop_after_attempt, wait_random_exponential
+from services import process_pools_enabled
+from services.template_cache import TemplateCache
 from config import settings
 
+logger = logging.getLogger(__name__)
+
+# MuPDF parsing is CPU-bound; a few worker processes extract PDFs in parallel
+PDF_EXTRACT_WORKERS = min(os.cpu_count() or 1, 4)
+# Large PDFs are split into page ranges of this size so their pages spread over workers
+PAGES_PER_TASK = 16
+
+# Template downloads in flight at once; well inside Drive's per-user quota
+DOWNLOAD_CONCURRENCY = 8
+# Templates are fetched whole from the media endpoint over pooled connections
+DRIVE_MEDIA_URL = "https://www.googleapis.com/drive/v3/files/{file_id}?alt=media"
+DOWNLOAD_TIMEOUT = httpx.Timeout(60.0, connect=10.0)
+# Extracted templates are committed to the template cache after every this many files
+CHECKPOINT_BATCH = 32
+
+# File ID in /file/d/<id> or ?id=<id> style Drive links
+DRIVE_ID_RE = re.compile(r'(?:/file/d/|[?&]id=)([A-Za-z0-9_-]{10,})')
+
+# Drive accepts at most 100 calls per batch HTTP request
+BATCH_REQUEST_LIMIT = 100
+
+# Access tokens this close to expiry are refreshed before use rather than after a 401
+TOKEN_REFRESH_MARGIN = timedelta(seconds=60)
+
+# Drive asks clients to back off exponentially on rate limits and 5xx errors
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+RATE_LIMIT_REASONS = {'rateLimitExceeded', 'userRateLimitExceeded'}
+
+def _response_error_details(response: httpx.Response) -> List[Any]:
+    """The errors list of a Drive JSON error body, or [] when there is none."""
+    try:
+        details = response.json()['error']['errors']
+    except Exception:
+        return []
+    return details if isinstance(details, list) else []
+
+def _is_retryable(error: BaseException) -> bool:
+    """Whether a Drive API error is transient: 429, 5xx, a 403 rate limit or a dropped connection."""
+    if isinstance(error, httpx.TransportError):
+        return True
+    if isinstance(error, HttpError):
+        status = error.resp.status
+        details = error.error_details if isinstance(error.error_details, list) else []
+    elif isinstance(error, httpx.HTTPStatusError):
+        status = error.response.status_code
+        details = _response_error_details(error.response)
+    else:
+        return False
+    if status == 403:
+        return any(isinstance(detail, dict) and detail.get('reason') in RATE_LIMIT_REASONS for detail in details)
+    return status in RETRYABLE_STATUSES
+
+# Full-jitter backoff: sleep up to min(16s, 0.5s * 2**attempt), five attempts
+drive_retry = retry(
+    retry=retry_if_exception(_is_retryable),
+    wait=wait_random_exponential(multiplier=0.5, max=16),
+    stop=stop_after_attempt(5),
+    reraise=True
+)
+
+def _page_range_text(pdf_document: fitz.Document, start: int, stop: Optional[int] = None) -> str:
+    """Text of pages [start, stop) of an open document."""
+    stop = pdf_document.page_count if stop is None else min(stop, pdf_document.page_count)
+    # Plain "text" mode: MuPDF's fastest path, and it keeps the line
+    # breaks templates rely on (the "words" mode would drop them)
+    return "".join([pdf_document[page_num].get_text("text") for page_num in range(start, stop)])
+
+def _open_pdf(pdf_content: bytes) -> Optional[fitz.Document]:
+    try:
+        # Open PDF from bytes
+        return fitz.open(stream=pdf_content, filetype="pdf")
+    except Exception as e:
+        logger.error("Error extracting text from PDF: %s", e)
+        return None
+
+def _extract_pdf_text(pdf_content: bytes) -> str:
+    """Extract text content from PDF bytes."""
+    pdf_document = _open_pdf(pdf_content)
+    if pdf_document is None:
+        return ""
+    try:
+        with pdf_document:
+            return _page_range_text(pdf_document, 0).strip()
+    except Exception as e:
+        logger.error("Error extracting text from PDF: %s", e)
+        return ""
+
+# PDFs of the extraction batch in flight. Set before the pool forks, so workers
+# inherit the bytes instead of having them pickled into every page-range task
+_batch_contents: List[bytes] = []
+_batch_lock = threading.Lock()
+# Per worker process: documents opened so far, so a worker given several
+# ranges of one PDF parses it (and loads its fonts) once
+_worker_documents: Dict[int, Optional[fitz.Document]] = {}
+
+def _extract_batch_range(position: int, start: int, stop: int) -> str:
+    if position not in _worker_documents:
+        _worker_documents[position] = _open_pdf(_batch_contents[position])
+    pdf_document = _worker_documents[position]
+    if pdf_document is None:
+        return ""
+    try:
+        return _page_range_text(pdf_document, start, stop)
+    except Exception as e:
+        logger.error("Error extracting text from PDF: %s", e)
+        return ""
+
+def _extract_pdf_texts(pdf_contents: List[bytes]) -> List[str]:
+    """_extract_pdf_text over several PDFs, in worker processes when there is enough work.
+    
+    Work is split into page ranges rather than whole files, so one large
+    template spreads over all workers instead of pinning one of them.
+    Serial unless process pools are enabled (see services.enable_process_pools).
+    """
+    # The page counts need every PDF opened once here; when the work turns
+    # out to be serial, those same documents are extracted instead of reopened
+    documents = [_open_pdf(pdf_content) for pdf_content in pdf_contents]
+    try:
+        tasks = [
+            (position, start, start + PAGES_PER_TASK)
+            for position, pdf_document in enumerate(documents)
+            for start in range(0, max(pdf_document.page_count if pdf_document else 0, 1), PAGES_PER_TASK)
+        ]
+        if len(tasks) < 2 or PDF_EXTRACT_WORKERS < 2 or not process_pools_enabled():
+            return [
+                _page_range_text(pdf_document, 0).strip() if pdf_document else ""
+                for pdf_document in documents
+            ]
+    finally:
+        for pdf_document in documents:
+            if pdf_document is not None:
+                pdf_document.close()
+    
+    global _batch_contents
+    with _batch_lock:
+        _batch_contents = pdf_contents
+        try:
+            # Forked so workers don't re-import this module and re-run authentication.
+            # MuPDF holds the GIL and isn't thread-safe, so threads wouldn't help here
+            with ProcessPoolExecutor(
+                max_workers=min(PDF_EXTRACT_WORKERS, len(tasks)),
+                mp_context=multiprocessing.get_context("fork")
+            ) as executor:
+                texts = executor.map(
+                    _extract_batch_range,
+                    [position for position, _, _ in tasks],
+                    [start for _, start, _ in tasks],
+                    [stop for _, _, stop in tasks]
+                )
+                parts = [[] for _ in pdf_contents]
+                for (position, _, _), text in zip(tasks, texts):
+                    parts[position].append(text)
+        finally:
+            _batch_contents = []
+    
+    return ["".join(pdf_parts).strip() for pdf_parts in parts]
+
+class _BytearrayWriter:
+    """File-like sink for MediaIoBaseDownload that accumulates into a bytearray.
+    
+    The bytearray is handed out as is, where BytesIO.getvalue() would copy
+    the whole file once more.
+    """
+    
+    def __init__(self):
+        self.buffer = bytearray()
+    
+    def write(self, data: bytes) -> int:
+        self.buffer += data
+        return len(data)
+
 class GoogleDriveService:
     def __init__(self):
         self.SCOPES = ['https://www.googleapis.com/auth/drive.readonly']
         self.creds = None
         self.service = None
+        # httplib2 connections aren't thread-safe, so each thread downloads on its own
+        self._local = threading.local()
+        # Concurrent downloads share one token; only one thread refreshes it
+        self._creds_lock = threading.Lock()
         self._authenticate()
     
     def _authenticate(self):
@@ -32,154 +220,319 @@ class GoogleDriveService:
                     'client_secrets.json', self.SCOPES)
                 self.creds = flow.run_local_server(port=0)
             
-            # Save the credentials for the next run
-            with open(settings.google_drive_credentials_file, 'w') as token:
-                token.write(self.creds.to_json())
+            self._save_credentials()
         
         self.service = build('drive', 'v3', credentials=self.creds)
     
-    def download_file(self, file_id: str) -> bytes:
+    def _save_credentials(self):
+        """Save the credentials for the next run, so it reuses the live access token."""
+        with open(settings.google_drive_credentials_file, 'w') as token:
+            token.write(self.creds.to_json())
+    
+    def _ensure_fresh_credentials(self):
+        """Refresh the shared access token once if it is about to expire."""
+        with self._creds_lock:
+            expiry = self.creds.expiry
+            # google-auth keeps expiry as naive UTC
+            if expiry is None or expiry - datetime.utcnow() > TOKEN_REFRESH_MARGIN:
+                return
+            if self.creds.refresh_token:
+                self.creds.refresh(Request())
+                self._save_credentials()
+    
+    def _http(self) -> google_auth_httplib2.AuthorizedHttp:
+        """This thread's authorized HTTP connection."""
+        if not hasattr(self._local, 'http'):
+            self._local.http = google_auth_httplib2.AuthorizedHttp(self.creds, http=httplib2.Http())
+        return self._local.http
+    
+    @drive_retry
+    def _execute(self, request) -> Dict[str, Any]:
+        """Execute a Drive API request on this thread's connection, retrying transient errors."""
+        self._ensure_fresh_credentials()
+        return request.execute(http=self._http())
+    
+    @drive_retry
+    def _next_chunk(self, downloader: MediaIoBaseDownload):
+        """Fetch the next media chunk; a retry resumes from the last completed chunk."""
+        self._ensure_fresh_credentials()
+        return downloader.next_chunk()
+    
+    def download_file(self, file_id: str) -> bytearray:
         """Download a file from Google Drive by ID."""
         try:
             request = self.service.files().get_media(fileId=file_id)
-            file = io.BytesIO()
+            request.http = self._http()
+            file = _BytearrayWriter()
             downloader = MediaIoBaseDownload(file, request)
             done = False
             while done is False:
-                status, done = downloader.next_chunk()
+                status, done = self._next_chunk(downloader)
             
-            return file.getvalue()
+            return file.buffer
         except Exception as e:
-            print(f"Error downloading file {file_id}: {e}")
+            logger.error("Error downloading file %s: %s", file_id, e)
             return None
     
     def get_file_info(self, file_id: str) -> Optional[Dict[str, Any]]:
         """Get file metadata from Google Drive."""
         try:
-            file = self.service.files().get(fileId=file_id).execute()
+            file = self._execute(self.service.files().get(fileId=file_id))
             return file
         except Exception as e:
-            print(f"Error getting file info for {file_id}: {e}")
+            logger.error("Error getting file info for %s: %s", file_id, e)
             return None
     
+    def get_files_info_batch(self, file_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        """Get metadata for many files, up to 100 per batch HTTP request.
+        
+        Files that fail (e.g. not found) are left out of the result.
+        """
+        files_info = {}
+        
+        def collect(request_id, response, exception):
+            if exception is not None:
+                logger.error("Error getting file info for %s: %s", request_id, exception)
+            else:
+                files_info[request_id] = response
+        
+        unique_ids = list(dict.fromkeys(file_ids))
+        for start in range(0, len(unique_ids), BATCH_REQUEST_LIMIT):
+            batch = self.service.new_batch_http_request(callback=collect)
+            for file_id in unique_ids[start:start + BATCH_REQUEST_LIMIT]:
+                batch.add(self.service.files().get(fileId=file_id, fields='id,name,mimeType,size'), request_id=file_id)
+            try:
+                self._execute(batch)
+            except Exception as e:
+                logger.error("Error getting file info batch: %s", e)
+        
+        return files_info
+    
     def list_files_in_folder(self, folder_id: str) -> List[Dict[str, Any]]:
         """List all files in a Google Drive folder."""
+        files = self._list_files(
+            folder_id,
+            f"'{folder_id}' in parents",
+            "nextPageToken, files(id, name, mimeType, size, md5Checksum, modifiedTime)"
+        )
+        return files if files is not None else []
+    
+    def list_pdfs_in_folder(self, folder_id: str) -> Optional[List[Dict[str, Any]]]:
+        """List the PDFs in a folder, filtered by Drive rather than after transfer.
+        
+        None when the listing failed, as opposed to an empty folder.
+        """
+        return self._list_files(
+            folder_id,
+            f"'{folder_id}' in parents and mimeType='application/pdf' and trashed=false",
+            "nextPageToken, files(id, name, size, md5Checksum, modifiedTime)"
+        )
+    
+    def _list_files(self, folder_id: str, query: str, fields: str) -> Optional[List[Dict[str, Any]]]:
+        """Every file matching query, following nextPageToken past the 1000-file page.
+        
+        A failure on any page returns None rather than a partial listing.
+        """
         try:
-            results = self.service.files().list(
-                q=f"'{folder_id}' in parents",
-                pageSize=1000,
-                fields="nextPageToken, files(id, name, mimeType, size)"
-            ).execute()
-            
-            return results.get('files', [])
+            files = []
+            page_token = None
+            while True:
+                results = self._execute(self.service.files().list(
+                    q=query,
+                    pageSize=1000,
+                    pageToken=page_token,
+                    fields=fields
+                ))
+                files.extend(results.get('files', []))
+                
+                page_token = results.get('nextPageToken')
+                if not page_token:
+                    return files
         except Exception as e:
-            print(f"Error listing files in folder {folder_id}: {e}")
-            return []
+            logger.error("Error listing files in folder %s: %s", folder_id, e)
+            return None
     
     def download_legal_documents(self, file_id: str) -> List[Dict[str, Any]]:
         """Download and parse the legal documents JSON file."""
-        print(f"Downloading legal documents from file ID: {file_id}")
+        logger.info("Downloading legal documents from file ID: %s", file_id)
         
         # Download the file
         file_content = self.download_file(file_id)
         if not file_content:
-            print("Failed to download legal documents file")
+            logger.error("Failed to download legal documents file")
             return []
         
         try:
-            # Parse JSON content
-            documents = json.loads(file_content.decode('utf-8'))
-            print(f"Successfully loaded {len(documents)} legal documents")
+            # Parse JSON content straight from the downloaded bytes, without a decoded copy
+            documents = orjson.loads(file_content)
+            # Vectors exported with the documents are never read: the index is
+            # built from create_embeddings, and the index itself stores them as
+            # float16/SQ8/PQ. As parsed lists of Python floats they would cost
+            # ~9x their float32 size in every document dict kept in memory
+            for document in documents:
+                document.pop('embedding', None)
+            logger.info("Successfully loaded %d legal documents", len(documents))
             return documents
-        except json.JSONDecodeError as e:
-            print(f"Error parsing JSON: {e}")
+        except orjson.JSONDecodeError as e:
+            logger.error("Error parsing JSON: %s", e)
             return []
-        except Exception as e:
-            print(f"Unexpected error processing legal documents: {e}")
+        except Exception:
+            logger.exception("Unexpected error processing legal documents")
             return []
     
-    def download_templates(self, folder_id: str) -> List[Dict[str, Any]]:
-        """Download and parse PDF templates from the templates folder."""
-        print(f"Downloading templates from folder ID: {folder_id}")
+    @drive_retry
+    async def _fetch_media(self, client: httpx.AsyncClient, file_id: str) -> bytes:
+        """A file's whole content in one GET, retrying transient errors."""
+        # Only blocks (on a worker thread) when the token is about to expire
+        await asyncio.to_thread(self._ensure_fresh_credentials)
+        response = await client.get(
+            DRIVE_MEDIA_URL.format(file_id=file_id),
+            headers={'Authorization': f'Bearer {self.creds.token}'}
+        )
+        response.raise_for_status()
+        return response.content
+    
+    async def _download_file_async(self, client: httpx.AsyncClient, file_id: str) -> Optional[bytes]:
+        """Download a file from Google Drive by ID on the event loop."""
+        try:
+            return await self._fetch_media(client, file_id)
+        except Exception as e:
+            logger.error("Error downloading file %s: %s", file_id, e)
+            return None
+    
+    @staticmethod
+    def _template(file: Dict[str, Any], content: str) -> Dict[str, Any]:
+        return {
+            'name': file['name'].replace('.pdf', ''),
+            'content': content,
+            'file_id': file['id'],
+            'size': file.get('size', 0)
+        }
+    
+    async def download_templates(self, folder_id: str) -> List[Dict[str, Any]]:
+        """Download and parse PDF templates from the templates folder.
         
-        templates = []
-        files = self.list_files_in_folder(folder_id)
+        Downloads run concurrently, at most DOWNLOAD_CONCURRENCY at a time.
+        Files whose checksum is in the template cache are served from it
+        without downloading, and new extractions are saved to it every
+        CHECKPOINT_BATCH files, so an interrupted sync resumes where it stopped.
+        """
+        logger.info("Downloading templates from folder ID: %s", folder_id)
         
-        for file in files:
-            if file['mimeType'] == 'application/pdf':
-                print(f"Processing template: {file['name']}")
-                
-                # Download PDF content
-                pdf_content = self.download_file(file['id'])
-                if pdf_content:
+        pdf_files = await asyncio.to_thread(self.list_pdfs_in_folder, folder_id)
+        if pdf_files is None:
+            # Without a listing nothing can be matched or pruned; leave the
+            # checkpointed templates for the next sync
+            return []
+        
+        # SQLite calls block (writes carry whole template texts), so they run
+        # on worker threads like the listing, one at a time
+        cache = await asyncio.to_thread(TemplateCache, settings.template_cache_path)
+        try:
+            cached = await asyncio.to_thread(cache.folder_contents, folder_id)
+            templates = {}
+            changed_files = []
+            for file in pdf_files:
+                content = cached.get((file['id'], file.get('md5Checksum')))
+                if content is not None:
+                    # Name and size come from the listing, so renames still show up
+                    templates[file['id']] = self._template(file, content)
+                else:
+                    changed_files.append(file)
+            logger.info("%d templates unchanged since the last sync", len(templates))
+            
+            semaphore = asyncio.Semaphore(DOWNLOAD_CONCURRENCY)
+            
+            async def download(client, file):
+                async with semaphore:
+                    logger.info("Processing template: %s", file['name'])
+                    return file, await self._download_file_async(client, file['id'])
+            
+            # One client per sync, so its files reuse a few kept-alive connections
+            async with httpx.AsyncClient(
+                timeout=DOWNLOAD_TIMEOUT,
+                limits=httpx.Limits(max_connections=DOWNLOAD_CONCURRENCY)
+            ) as client:
+                for start in range(0, len(changed_files), CHECKPOINT_BATCH):
+                    # Download a batch of PDFs, then extract them all in parallel
+                    batch = changed_files[start:start + CHECKPOINT_BATCH]
+                    results = await asyncio.gather(*[download(client, file) for file in batch])
+                    downloaded = [(file, pdf_content) for file, pdf_content in results if pdf_content]
+                    
                     try:
-                        # Extract text from PDF
-                        pdf_text = self._extract_pdf_text(pdf_content)
-                        
-                        template = {
-                            'name': file['name'].replace('.pdf', ''),
-                            'content': pdf_text,
-                            'file_id': file['id'],
-                            'size': file.get('size', 0)
-                        }
-                        
-                        templates.append(template)
-                        print(f"Successfully processed template: {template['name']}")
-                        
-                    except Exception as e:
-                        print(f"Error processing template {file['name']}: {e}")
+                        pdf_texts = await asyncio.to_thread(
+                            _extract_pdf_texts, [pdf_content for _, pdf_content in downloaded]
+                        )
+                    except Exception:
+                        # Retried on the next sync, like failed downloads
+                        logger.exception("Error extracting templates")
                         continue
+                    
+                    for (file, _), pdf_text in zip(downloaded, pdf_texts):
+                        templates[file['id']] = self._template(file, pdf_text)
+                        logger.info("Successfully processed template: %s", templates[file['id']]['name'])
+                    await asyncio.to_thread(cache.put_many, folder_id, [
+                        (file['id'], file.get('md5Checksum'), pdf_text)
+                        for (file, _), pdf_text in zip(downloaded, pdf_texts)
+                    ])
+            
+            # Older versions and files no longer in the folder
+            await asyncio.to_thread(
+                cache.prune, folder_id, [(file['id'], file.get('md5Checksum')) for file in pdf_files]
+            )
+        finally:
+            await asyncio.to_thread(cache.close)
         
-        print(f"Successfully processed {len(templates)} templates")
-        return templates
+        # In listing order; files that failed are missing until a later sync
+        result = [templates[file['id']] for file in pdf_files if file['id'] in templates]
+        logger.info("Successfully processed %d templates", len(result))
+        return result
     
     def _extract_pdf_text(self, pdf_content: bytes) -> str:
         """Extract text content from PDF bytes."""
-        try:
-            # Open PDF from bytes
-            pdf_document = fitz.open(stream=pdf_content, filetype="pdf")
-            text = ""
-            
-            # Extract text from all pages
-            for page_num in range(pdf_document.page_count):
-                page = pdf_document[page_num]
-                text += page.get_text()
-            
-            pdf_document.close()
-            return text.strip()
-            
-        except Exception as e:
-            print(f"Error extracting text from PDF: {e}")
-            return ""
+        return _extract_pdf_text(pdf_content)
+    
+    def _file_id_from_url(self, url: str) -> Optional[str]:
+        """Extract file ID from Google Drive URL."""
+        if 'drive.google.com' not in url:
+            return None
+        match = DRIVE_ID_RE.search(url)
+        if match:
+            return match.group(1)
+        
+        logger.warning("Could not extract file ID from URL: %s", url)
+        return None
+    
+    def _document_info(self, file_id: str, file_info: Dict[str, Any], url: str) -> Dict[str, Any]:
+        return {
+            'id': file_id,
+            'name': file_info.get('name', ''),
+            'mimeType': file_info.get('mimeType', ''),
+            'size': file_info.get('size', 0),
+            'url': url
+        }
     
     def get_document_by_url(self, url: str) -> Optional[Dict[str, Any]]:
         """Get document information from a Google Drive URL."""
         try:
-            # Extract file ID from Google Drive URL
-            if 'drive.google.com' in url:
-                if '/file/d/' in url:
-                    file_id = url.split('/file/d/')[1].split('/')[0]
-                elif 'id=' in url:
-                    file_id = url.split('id=')[1].split('&')[0]
-                else:
-                    print(f"Could not extract file ID from URL: {url}")
-                    return None
-                
+            file_id = self._file_id_from_url(url)
+            if file_id:
                 file_info = self.get_file_info(file_id)
                 if file_info:
-                    return {
-                        'id': file_id,
-                        'name': file_info.get('name', ''),
-                        'mimeType': file_info.get('mimeType', ''),
-                        'size': file_info.get('size', 0),
-                        'url': url
-                    }
+                    return self._document_info(file_id, file_info, url)
             
             return None
             
         except Exception as e:
-            print(f"Error getting document from URL {url}: {e}")
+            logger.error("Error getting document from URL %s: %s", url, e)
             return None
-
-# Global instance
-google_drive_service = GoogleDriveService()
\ No newline at end of file
+    
+    def get_documents_by_url(self, urls: List[str]) -> List[Optional[Dict[str, Any]]]:
+        """get_document_by_url for many URLs, fetching metadata in batch requests."""
+        file_ids = [self._file_id_from_url(url) for url in urls]
+        files_info = self.get_files_info_batch([file_id for file_id in file_ids if file_id])
+        
+        return [
+            self._document_info(file_id, files_info[file_id], url) if file_id in files_info else None
+            for file_id, url in zip(file_ids, urls)
+        ]
@@ -0,0 +1,54 @@
+import numpy as np
+from typing import List
+
+# all-MiniLM-L6-v2 truncates at 256 word pieces; keep the ONNX path identical
+MAX_SEQ_LENGTH = 256
+
+class OnnxSentenceEncoder:
+    """Sentence-transformer stand-in running an exported ONNX model.
+    
+    Meant for an INT8-quantized export on CPU-only hosts, e.g.:
+    
+        optimum-cli export onnx --model sentence-transformers/all-MiniLM-L6-v2 --optimize O2 ./onnx_model
+        optimum-cli onnxruntime quantize --onnx_model ./onnx_model --avx512_vnni -o ./onnx_int8
+    
+    The directory must also hold the tokenizer files from the export.
+    
+    encode() takes the SentenceTransformer arguments the embeddings
+    service uses and mean-pools token embeddings the same way.
+    """
+    
+    def __init__(self, model_path: str):
+        # Imported lazily; optimum is only needed when an ONNX export is configured
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+        
+        self.model = ORTModelForFeatureExtraction.from_pretrained(model_path)
+        self.tokenizer = AutoTokenizer.from_pretrained(model_path)
+    
+    def get_sentence_embedding_dimension(self) -> int:
+        return self.model.config.hidden_size
+    
+    def encode(self, sentences: List[str], batch_size: int = 32, show_progress_bar: bool = False,
+               convert_to_numpy: bool = True, normalize_embeddings: bool = False) -> np.ndarray:
+        """Embed sentences into a (len(sentences), dim) float32 array."""
+        batches = []
+        # Length-sorted batches pad less, like SentenceTransformer.encode
+        order = np.argsort([-len(sentence) for sentence in sentences], kind='stable')
+        for start in range(0, len(sentences), batch_size):
+            batch = [sentences[i] for i in order[start:start + batch_size]]
+            inputs = self.tokenizer(batch, padding=True, truncation=True, max_length=MAX_SEQ_LENGTH, return_tensors='np')
+            token_embeddings = self.model(**inputs).last_hidden_state
+            
+            mask = inputs['attention_mask'][..., None].astype(np.float32)
+            pooled = (token_embeddings * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            batches.append(pooled.astype(np.float32))
+        
+        dimension = self.get_sentence_embedding_dimension()
+        embeddings = np.empty((len(sentences), dimension), dtype=np.float32)
+        if batches:
+            embeddings[order] = np.concatenate(batches)
+        
+        if normalize_embeddings:
+            embeddings /= np.clip(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12, None)
+        return embeddings
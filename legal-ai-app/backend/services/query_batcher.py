@@ -0,0 +1,104 @@
+import asyncio
+from typing import Dict, List, Optional, Tuple
+
+from starlette.concurrency import run_in_threadpool
+
+from services import get_embeddings_service
+
+# How long the first query of a batch waits for company, and the batch cap
+BATCH_WINDOW_SECONDS = 0.005
+MAX_BATCH_SIZE = 64
+
+class QueryBatcher:
+    """Coalesce concurrent unfiltered similarity searches into one batch.
+
+    Queries arriving within a few milliseconds of each other are encoded
+    in a single model call and searched with a single (B, d) FAISS call
+    on the threadpool, then each caller gets its own top-k back.
+    """
+
+    def __init__(self):
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker: Optional[asyncio.Task] = None
+
+    async def submit(self, query: str, k: int, snapshot) -> List[Tuple[int, float]]:
+        """Top-k (index, score) pairs for query in snapshot's index, resolved with its batch."""
+        if self._worker is None or self._worker.done():
+            # Created lazily so both live on the running event loop
+            self._queue = asyncio.Queue()
+            self._worker = asyncio.create_task(self._run())
+
+        future = asyncio.get_running_loop().create_future()
+        await self._queue.put((query, k, snapshot, future))
+        return await future
+
+    async def _run(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + BATCH_WINDOW_SECONDS
+            while len(batch) < MAX_BATCH_SIZE:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Drop callers that went away (e.g. client disconnects) before searching
+            batch = [entry for entry in batch if not entry[3].done()]
+            if not batch:
+                continue
+
+            try:
+                results = await run_in_threadpool(self._search, batch)
+            except asyncio.CancelledError:
+                for _, _, _, future in batch:
+                    future.cancel()
+                raise
+            except Exception as e:
+                for _, _, _, future in batch:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+
+            for (_, k, _, future), pairs in zip(batch, results):
+                if not future.done():
+                    future.set_result(pairs[:k])
+
+    @staticmethod
+    def _search(batch) -> List[List[Tuple[int, float]]]:
+        embeddings_service = get_embeddings_service()
+        query_embeddings = embeddings_service.embed_queries([query for query, _, _, _ in batch])
+        
+        # Each caller reads results against the snapshot it submitted with; a
+        # batch straddling an index swap is searched once per snapshot
+        groups: Dict[int, Tuple[object, List[int]]] = {}
+        for position, (_, _, snapshot, _) in enumerate(batch):
+            groups.setdefault(id(snapshot), (snapshot, []))[1].append(position)
+        
+        results: List[List[Tuple[int, float]]] = [[] for _ in batch]
+        for snapshot, positions in groups.values():
+            k = max(batch[position][1] for position in positions)
+            rows = embeddings_service.search_embeddings(query_embeddings[positions], k, snapshot)
+            for position, pairs in zip(positions, rows):
+                results[position] = pairs
+        return results
+
+    async def close(self):
+        """Stop the worker; pending callers get a CancelledError."""
+        if self._worker is not None:
+            self._worker.cancel()
+            try:
+                await self._worker
+            except asyncio.CancelledError:
+                pass
+            self._worker = None
+
+        while self._queue is not None and not self._queue.empty():
+            _, _, _, future = self._queue.get_nowait()
+            future.cancel()
+
+# Global instance
+query_batcher = QueryBatcher()
@@ -0,0 +1,98 @@
+import sqlite3
+import logging
+from typing import Dict, Iterable, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+class TemplateCache:
+    """Extracted template text on disk, keyed by Drive file ID and md5Checksum.
+
+    Rows are committed as each batch of templates is extracted, so a sync
+    cut short (rate limits, a killed process) keeps what it already did and
+    the next run only fetches the rest. A changed file gets a new checksum
+    and therefore misses.
+    """
+
+    def __init__(self, path: str):
+        """Open (creating if needed) the cache; when that fails it caches nothing.
+
+        Calls may come from different threads (one at a time, e.g. through
+        asyncio.to_thread), hence check_same_thread=False.
+        """
+        self.conn: Optional[sqlite3.Connection] = None
+        try:
+            self.conn = sqlite3.connect(path, check_same_thread=False)
+            # WAL lets a concurrent sync read while another one writes
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS templates (
+                    file_id TEXT NOT NULL,
+                    md5_checksum TEXT NOT NULL,
+                    folder_id TEXT NOT NULL,
+                    content TEXT NOT NULL,
+                    PRIMARY KEY (file_id, md5_checksum)
+                )
+                """
+            )
+            self.conn.commit()
+        except sqlite3.Error as e:
+            logger.warning("Error opening template cache at %s, syncing without it: %s", path, e)
+            self.close()
+
+    def folder_contents(self, folder_id: str) -> Dict[Tuple[str, str], str]:
+        """(file_id, md5Checksum) -> extracted text for a folder's cached templates."""
+        if self.conn is None:
+            return {}
+        try:
+            rows = self.conn.execute(
+                "SELECT file_id, md5_checksum, content FROM templates WHERE folder_id = ?",
+                (folder_id,)
+            )
+            return {(file_id, md5_checksum): content for file_id, md5_checksum, content in rows}
+        except sqlite3.Error as e:
+            logger.warning("Error reading template cache, re-downloading templates: %s", e)
+            return {}
+
+    def put_many(self, folder_id: str, entries: Iterable[Tuple[str, Optional[str], str]]):
+        """Store (file_id, md5Checksum, text) entries in one transaction.
+
+        Files Drive reports no checksum for can't be matched later and are skipped.
+        """
+        rows = [
+            (file_id, md5_checksum, folder_id, content)
+            for file_id, md5_checksum, content in entries
+            if md5_checksum
+        ]
+        if self.conn is None or not rows:
+            return
+        try:
+            with self.conn:
+                self.conn.executemany("INSERT OR REPLACE INTO templates VALUES (?, ?, ?, ?)", rows)
+        except sqlite3.Error as e:
+            logger.error("Error saving templates to cache: %s", e)
+
+    def prune(self, folder_id: str, current: Iterable[Tuple[str, Optional[str]]]):
+        """Drop a folder's rows other than the given (file_id, md5Checksum) versions."""
+        if self.conn is None:
+            return
+        keep = set(current)
+        try:
+            with self.conn:
+                stale = [
+                    key for key in self.conn.execute(
+                        "SELECT file_id, md5_checksum FROM templates WHERE folder_id = ?",
+                        (folder_id,)
+                    )
+                    if key not in keep
+                ]
+                self.conn.executemany(
+                    "DELETE FROM templates WHERE file_id = ? AND md5_checksum = ?", stale
+                )
+        except sqlite3.Error as e:
+            logger.error("Error pruning template cache: %s", e)
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
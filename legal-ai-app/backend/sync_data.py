@@ -7,120 +7,124 @@ This script syncs legal documents and templates from Google Drive.
 import os
 import sys
 import asyncio
+import logging
+import multiprocessing
+from logging.handlers import QueueHandler, QueueListener
 from datetime import datetime
 
 # Add the current directory to Python path
 sys.path.append(os.path.dirname(os.path.abspath(__file__)))
 
-from services.google_drive import google_drive_service
+from services import enable_process_pools, get_google_drive_service
 from services.embeddings import embeddings_service
 from services.classifier import classifier_service
 from services.document_generator import document_generator
 from config import settings
 
+logger = logging.getLogger(__name__)
+
 # Google Drive IDs from your links
 LEGAL_DOCUMENTS_FILE_ID = "1yNAwckn4rPnlpSgmW-xyB10WL4CcgRvE"  # From your JSON link
 TEMPLATES_FOLDER_ID = "1hzAIv5AJWGI8Q76M4IjI0k4ZFXw8UBeu"      # From your templates folder
 
 async def sync_legal_documents():
     """Sync legal documents from Google Drive."""
-    print("📚 Syncing legal documents from Google Drive...")
+    logger.info("📚 Syncing legal documents from Google Drive...")
     
     try:
         # Download legal documents
-        documents = google_drive_service.download_legal_documents(LEGAL_DOCUMENTS_FILE_ID)
+        documents = await asyncio.to_thread(get_google_drive_service().download_legal_documents, LEGAL_DOCUMENTS_FILE_ID)
         
         if not documents:
-            print("❌ No documents found or error downloading")
+            logger.error("❌ No documents found or error downloading")
             return False
         
-        print(f"✅ Downloaded {len(documents)} legal documents")
+        logger.info("✅ Downloaded %d legal documents", len(documents))
         
         # Update embeddings index
-        print("🔍 Updating embeddings index...")
-        embeddings_service.update_index(documents)
+        logger.info("🔍 Updating embeddings index...")
+        await asyncio.to_thread(embeddings_service.update_index, documents)
         
-        print("✅ Legal documents synced successfully")
+        logger.info("✅ Legal documents synced successfully")
         return True
         
-    except Exception as e:
-        print(f"❌ Error syncing legal documents: {e}")
+    except Exception:
+        logger.exception("❌ Error syncing legal documents")
         return False
 
 async def sync_templates():
     """Sync document templates from Google Drive."""
-    print("📋 Syncing document templates from Google Drive...")
+    logger.info("📋 Syncing document templates from Google Drive...")
     
     try:
         # Download templates
-        templates = google_drive_service.download_templates(TEMPLATES_FOLDER_ID)
+        templates = await get_google_drive_service().download_templates(TEMPLATES_FOLDER_ID)
         
         if not templates:
-            print("❌ No templates found or error downloading")
+            logger.error("❌ No templates found or error downloading")
             return False
         
-        print(f"✅ Downloaded {len(templates)} templates")
+        logger.info("✅ Downloaded %d templates", len(templates))
         
         # Load templates into document generator
         document_generator.load_templates(templates)
         
-        print("✅ Templates synced successfully")
+        logger.info("✅ Templates synced successfully")
         return True
         
-    except Exception as e:
-        print(f"❌ Error syncing templates: {e}")
+    except Exception:
+        logger.exception("❌ Error syncing templates")
         return False
 
 async def train_ml_models():
     """Train the ML models with synced data."""
-    print("🤖 Training ML models...")
+    logger.info("🤖 Training ML models...")
     
     try:
         if not embeddings_service.documents:
-            print("❌ No documents available for training")
+            logger.error("❌ No documents available for training")
             return False
         
         # Train classifier
         success = classifier_service.train_classifier(embeddings_service.documents)
         
         if success:
-            print("✅ ML models trained successfully")
+            logger.info("✅ ML models trained successfully")
             return True
         else:
-            print("❌ Failed to train ML models")
+            logger.error("❌ Failed to train ML models")
             return False
             
-    except Exception as e:
-        print(f"❌ Error training ML models: {e}")
+    except Exception:
+        logger.exception("❌ Error training ML models")
         return False
 
 async def show_system_status():
     """Show the current system status."""
-    print("\n📊 System Status:")
-    print(f"   Legal documents indexed: {len(embeddings_service.documents) if embeddings_service.documents else 0}")
-    print(f"   Search index available: {'✅' if embeddings_service.faiss_index else '❌'}")
-    print(f"   Templates loaded: {len(document_generator.templates)}")
-    print(f"   Classifier trained: {'✅' if classifier_service.is_trained else '❌'}")
-    print(f"   Google Drive service: {'✅' if google_drive_service.service else '❌'}")
+    logger.info("\n📊 System Status:")
+    logger.info("   Legal documents indexed: %d", len(embeddings_service.documents) if embeddings_service.documents else 0)
+    logger.info("   Search index available: %s", '✅' if embeddings_service.faiss_index else '❌')
+    logger.info("   Templates loaded: %d", len(document_generator.templates))
+    logger.info("   Classifier trained: %s", '✅' if classifier_service.is_trained else '❌')
+    logger.info("   Google Drive service: %s", '✅' if get_google_drive_service().service else '❌')
 
 async def main():
     """Main synchronization function."""
-    print("=" * 60)
-    print("🤖 Legal AI Assistant - Data Synchronization")
-    print("=" * 60)
+    logger.info("=" * 60)
+    logger.info("🤖 Legal AI Assistant - Data Synchronization")
+    logger.info("=" * 60)
     
     # Check Google Drive authentication
+    google_drive_service = get_google_drive_service()
     if not google_drive_service.service:
-        print("❌ Google Drive service not available. Please check your credentials.")
+        logger.error("❌ Google Drive service not available. Please check your credentials.")
         return
     
-    print("✅ Google Drive service authenticated")
-    
-    # Sync legal documents
-    docs_synced = await sync_legal_documents()
+    logger.info("✅ Google Drive service authenticated")
     
-    # Sync templates
-    templates_synced = await sync_templates()
+    # Sync legal documents and templates concurrently; they share no data, and
+    # Drive calls are safe across threads since each uses its own connection
+    docs_synced, templates_synced = await asyncio.gather(sync_legal_documents(), sync_templates())
     
     # Train models if documents are available
     models_trained = False
@@ -130,24 +134,49 @@ async def main():
     # Show final status
     await show_system_status()
     
-    print("\n" + "=" * 60)
+    logger.info("\n" + "=" * 60)
     if docs_synced and templates_synced:
-        print("🎉 Data synchronization completed successfully!")
+        logger.info("🎉 Data synchronization completed successfully!")
         if models_trained:
-            print("🤖 ML models are ready for use!")
+            logger.info("🤖 ML models are ready for use!")
         else:
-            print("⚠️  ML models training failed or not completed")
+            logger.warning("⚠️  ML models training failed or not completed")
     else:
-        print("⚠️  Data synchronization completed with some issues")
+        logger.warning("⚠️  Data synchronization completed with some issues")
         if not docs_synced:
-            print("   - Legal documents sync failed")
+            logger.warning("   - Legal documents sync failed")
         if not templates_synced:
-            print("   - Templates sync failed")
+            logger.warning("   - Templates sync failed")
+    
+    logger.info("\n🚀 You can now start the application with:")
+    logger.info("   uvicorn main:app --reload")
+    logger.info("=" * 60)
+
+def configure_logging() -> QueueListener:
+    """Send log records through a queue that one background thread writes out.
+    
+    Coroutines, threads and forked extraction workers only enqueue, so none
+    of them blocks on the stdout lock. The queue is a multiprocessing one so
+    records from forked workers arrive too.
+    """
+    log_queue = multiprocessing.get_context("fork").Queue()
+    console = logging.StreamHandler()
+    console.setFormatter(logging.Formatter("%(levelname)-7s %(message)s"))
+    listener = QueueListener(log_queue, console)
     
-    print("\n🚀 You can now start the application with:")
-    print("   uvicorn main:app --reload")
-    print("=" * 60)
+    root = logging.getLogger()
+    root.handlers = [QueueHandler(log_queue)]
+    root.setLevel(logging.INFO)
+    listener.start()
+    return listener
 
 if __name__ == "__main__":
-    # Run the async main function
-    asyncio.run(main())
\ No newline at end of file
+    # A short-lived batch job, unlike the server, so it may fork extraction
+    # and preprocessing workers
+    enable_process_pools()
+    listener = configure_logging()
+    try:
+        # Run the async main function
+        asyncio.run(main())
+    finally:
+        listener.stop()
\ No newline at end of file